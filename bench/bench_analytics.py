@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Cost of the incrementally maintained order analytics (common.analytics).
+
+Fills an orders Store with N orders and prints:
+  - inserts/s with and without OrderAnalytics subscribed (per-write cost)
+  - a full rebuild from the snapshot: one Python pass vs NumPy
+  - reads (product totals, top 10 products, daily timeline) from the
+    rollups vs computing the same answer by scanning every order
+The Python and NumPy rebuilds and the incrementally maintained rollups
+must agree (totals within 1e-6 relative, top lists and timelines equal),
+and a timeline with a negative or misaligned bucket width must be
+refused; the script exits non-zero otherwise.
+
+Usage:
+    python bench/bench_analytics.py --orders 1000000
+"""
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import analytics  # noqa: E402
+from common.analytics import OrderAnalytics  # noqa: E402
+from common.records import Order  # noqa: E402
+from common.store import Store  # noqa: E402
+
+START = 1700000000.0
+
+
+def make_orders(count, products, users, seed=1):
+    rng = random.Random(seed)
+    orders = []
+    for i in range(count):
+        quantity = rng.randint(1, 5)
+        price = round(rng.uniform(1, 500), 2)
+        orders.append({"user_id": rng.randint(1, users), "product_id": rng.randint(1, products),
+                       "quantity": quantity, "total_price": price * quantity,
+                       "created_at": START + i * 30 * 24 * 3600 / count})
+    return orders
+
+
+def timed(fn, repeat=1):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return result, (time.perf_counter() - started) / repeat
+
+
+def same_numbers(a, b):
+    """Compare analytics results, floats within 1e-6 relative"""
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(same_numbers(a[k], b[k]) for k in a if k != "last_rebuild")
+    if isinstance(a, list):
+        return len(a) == len(b) and all(same_numbers(x, y) for x, y in zip(a, b))
+    if isinstance(a, float) or isinstance(b, float):
+        return math.isclose(a, b, rel_tol=1e-6, abs_tol=0.01)
+    return a == b
+
+
+def views(rollups, sample_ids):
+    """Everything the endpoints can return, for comparing two rollups"""
+    return {
+        "summary": rollups.summary(),
+        "top": [rollups.top(kind, by, 100) for kind in ("products", "users") for by in analytics.RANKINGS],
+        "sales": [rollups.sales("products", key) for key in sample_ids],
+        "timeline": rollups.timeline(24 * 3600),
+    }
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--orders', type=int, default=1000000)
+    parser.add_argument('--products', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=100000)
+    args = parser.parse_args()
+    failures = []
+
+    rows = make_orders(args.orders, args.products, args.users)
+    plain = Store(record_type=Order)
+    _, plain_elapsed = timed(lambda: [plain.insert(row) for row in rows])
+    store = Store(record_type=Order)
+    incremental = OrderAnalytics(store)
+    incremental.rebuild()
+    _, tracked_elapsed = timed(lambda: [store.insert(row) for row in rows])
+    print(f"inserts: plain={args.orders / plain_elapsed:9.0f}/s  with analytics={args.orders / tracked_elapsed:9.0f}/s"
+          f"  (+{(tracked_elapsed - plain_elapsed) / args.orders * 1e6:.1f}us per order)")
+
+    rebuilt = {}
+    for method, vectorized in (("python", False), ("numpy", True)):
+        if vectorized and analytics.np is None:
+            print("rebuild numpy: skipped (numpy not installed)")
+            continue
+        rebuilt[method] = OrderAnalytics(store)
+        info = rebuilt[method].rebuild(vectorized=vectorized)
+        print(f"rebuild {method:<6} {info['orders']} orders in {info['seconds']:7.3f}s")
+
+    sample_ids = random.Random(2).sample(range(1, args.products + 1), 20)
+    expected = views(incremental, sample_ids)
+    for method, rollups in rebuilt.items():
+        if not same_numbers(expected, views(rollups, sample_ids)):
+            failures.append(f"{method} rebuild disagrees with the incremental rollups")
+
+    for width in (-24 * 3600, -analytics.ANALYTICS_BUCKET_SECONDS, analytics.ANALYTICS_BUCKET_SECONDS + 1):
+        try:
+            incremental.timeline(width)
+            failures.append(f"timeline accepted bucket_seconds={width}")
+        except ValueError:
+            pass
+
+    orders = store.values()
+    product_id = sample_ids[0]
+    reads = [
+        ("product totals", lambda: incremental.sales("products", product_id),
+         lambda: sum(o.total_price for o in orders if o.product_id == product_id)),
+        ("top 10 products", lambda: incremental.top("products", "revenue", 10),
+         lambda: sorted(_scan_revenue(orders).items(), key=lambda item: -item[1])[:10]),
+        ("daily timeline", lambda: incremental.timeline(24 * 3600),
+         lambda: _scan_days(orders)),
+    ]
+    for name, from_rollups, by_scan in reads:
+        _, rollup_elapsed = timed(from_rollups, repeat=100)
+        _, scan_elapsed = timed(by_scan)
+        print(f"{name:<16} rollups={rollup_elapsed * 1e6:10.1f}us  scan={scan_elapsed * 1e3:9.1f}ms")
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+def _scan_revenue(orders):
+    revenue = {}
+    for order in orders:
+        revenue[order.product_id] = revenue.get(order.product_id, 0.0) + order.total_price
+    return revenue
+
+
+def _scan_days(orders):
+    days = {}
+    for order in orders:
+        day = int(order.created_at // 86400) * 86400
+        days[day] = days.get(day, 0.0) + order.total_price
+    return sorted(days.items())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Keeping a replica of the products table current: WatchProducts vs polling.
+
+Starts service_b (GRPC_SERVER_MODE from --mode), seeds --products products
+and runs --writes single-item ReserveStock calls at --rate per second while
+two consumers keep a local copy of the table:
+  - watch: one WatchProducts stream (snapshot, then the changes); halfway
+    through it disconnects and resumes from its last seq and epoch
+  - poll:  ListProducts of the whole table every --poll-interval seconds
+For each it prints the bytes and messages received and how long a stock
+change took to reach the replica (p50/p99).
+
+Then it opens --watchers more WatchProducts streams (by default as many
+as the thread server has workers) and makes --unary-calls GetProduct
+calls while they are open.
+
+Both replicas must equal the table at the end, the watch must see every
+seq exactly once after its snapshot, and every GetProduct call must
+succeed with the watchers open (in thread mode some of them are refused
+with RESOURCE_EXHAUSTED instead); the script exits non-zero otherwise.
+
+Usage:
+    python bench/bench_changefeed.py --products 10000 --writes 2000 --rate 200
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+import grpc
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchlib  # noqa: E402
+
+sys.path.insert(0, os.path.join(benchlib.BASE_DIR, 'service_b', 'proto'))
+import product_pb2  # noqa: E402
+import product_pb2_grpc  # noqa: E402
+
+REST_PORT = 18521
+GRPC_PORT = 50521
+SEED_STOCK = 1000000
+
+
+class Replica:
+    """Local copy of the products table: id -> (name, price, stock)"""
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = {}
+        self.bytes = 0
+        self.messages = 0
+        self.seen = {}  # (product id, stock) -> time it reached the replica
+        self.problems = []
+
+    def apply(self, product, now):
+        self.rows[product.id] = (product.name, product.price, product.stock)
+        self.seen.setdefault((product.id, product.stock), now)
+
+
+def watch(stub, replica, stop, resume_at):
+    """Follow WatchProducts into `replica` until `stop` is set, reconnecting once at `resume_at`"""
+    request = product_pb2.WatchRequest(snapshot=True)
+    last_seq = None
+    while not stop.is_set():
+        stream = stub.WatchProducts(request)
+        try:
+            for message in stream:
+                now = time.monotonic()
+                replica.bytes += message.ByteSize()
+                replica.messages += 1
+                for change in message.changes:
+                    if change.kind != "snapshot":
+                        if last_seq is not None and change.seq != last_seq + 1:
+                            replica.problems.append(f"watch: seq {change.seq} after {last_seq}")
+                        last_seq = change.seq
+                    replica.apply(change.product, now)
+                last_seq = message.last_seq
+                request = product_pb2.WatchRequest(after_seq=last_seq, epoch=message.epoch)
+                if resume_at.is_set() or stop.is_set():
+                    resume_at.clear()
+                    stream.cancel()
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.CANCELLED:
+                replica.problems.append(f"watch: {e.code()} {e.details()}")
+                return
+
+
+def poll(stub, replica, stop, interval):
+    """Refresh `replica` with a full ListProducts every `interval` seconds until `stop` is set"""
+    while True:
+        products = stub.ListProducts(product_pb2.ListProductsRequest())
+        now = time.monotonic()
+        replica.bytes += products.ByteSize()
+        replica.messages += 1
+        replica.rows = {}
+        for product in products.products:
+            replica.apply(product, now)
+        if stop.wait(interval):
+            return
+
+
+def crowd(stub, watchers, calls):
+    """Open `watchers` Watch streams, make `calls` GetProduct calls; returns [problems]"""
+    problems = []
+    streams, refused = [], 0
+    for _ in range(watchers):
+        stream = stub.WatchProducts(product_pb2.WatchRequest(snapshot=True))
+        try:
+            next(stream)
+            streams.append(stream)
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.RESOURCE_EXHAUSTED:
+                problems.append(f"watcher failed with {e.code().name}")
+            refused += 1
+    failed = 0
+    started = time.perf_counter()
+    for i in range(calls):
+        try:
+            stub.GetProduct(product_pb2.GetProductRequest(id=i % 3 + 1), timeout=2)
+        except grpc.RpcError:
+            failed += 1
+    elapsed = time.perf_counter() - started
+    for stream in streams:
+        stream.cancel()
+    print(f"{watchers} watchers: {len(streams)} open, {refused} refused; "
+          f"GetProduct {calls - failed}/{calls} ok in {elapsed:.2f}s")
+    if failed:
+        problems.append(f"{failed} of {calls} GetProduct calls failed with {len(streams)} watchers open")
+    return problems
+
+
+def lag_summary(replica, written):
+    """p50/p99 in ms from a stock change being written to it reaching the replica"""
+    lags = [replica.seen[key] - at for key, at in written.items() if key in replica.seen]
+    if not lags:
+        return "no changes seen"
+    return (f"lag p50={benchlib.percentile(lags, 50) * 1000:8.1f}ms  p99={benchlib.percentile(lags, 99) * 1000:8.1f}ms"
+            f"  ({len(lags)}/{len(written)} changes seen)")
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--products', type=int, default=10000)
+    parser.add_argument('--writes', type=int, default=2000)
+    parser.add_argument('--rate', type=float, default=200, help='ReserveStock calls per second')
+    parser.add_argument('--poll-interval', type=float, default=1.0)
+    parser.add_argument('--mode', choices=['aio', 'thread'], default='aio')
+    parser.add_argument('--watchers', type=int, default=10, help='streams held open during the unary calls')
+    parser.add_argument('--unary-calls', type=int, default=200)
+    args = parser.parse_args()
+
+    env = {'SERVICE_B_PORT': str(REST_PORT), 'SERVICE_B_GRPC_PORT': str(GRPC_PORT), 'GRPC_SERVER_MODE': args.mode,
+           'STORE_ENGINE': 'memory', 'LOG_LEVEL': 'WARNING', 'USER_SERVICE_ADDR': 'localhost:1'}
+    process = benchlib.start_service('service_b', env, [REST_PORT, GRPC_PORT])
+    channel = grpc.insecure_channel(f'localhost:{GRPC_PORT}', options=[("grpc.max_receive_message_length", -1)])
+    stub = product_pb2_grpc.ProductServiceStub(channel)
+    try:
+        with httpx.Client(base_url=f'http://localhost:{REST_PORT}', timeout=60) as client:
+            for start in range(0, args.products, 5000):
+                batch = [{"name": f"product-{i}", "price": 1.0 + i % 100, "stock": SEED_STOCK}
+                         for i in range(start, min(args.products, start + 5000))]
+                client.post('/products/batch', json=batch).raise_for_status()
+
+        stop, resume_at = threading.Event(), threading.Event()
+        watched, polled = Replica("watch"), Replica("poll")
+        consumers = [threading.Thread(target=watch, args=(stub, watched, stop, resume_at)),
+                     threading.Thread(target=poll, args=(stub, polled, stop, args.poll_interval))]
+        for consumer in consumers:
+            consumer.start()
+        time.sleep(1)
+
+        rng = random.Random(1)
+        last_id = args.products + 3
+        written = {}
+        started = time.monotonic()
+        for i in range(args.writes):
+            delay = started + i / args.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if i == args.writes // 2:
+                resume_at.set()
+            product_id = rng.randint(1, last_id)
+            at = time.monotonic()
+            response = stub.ReserveStock(product_pb2.StockRequest(items=[product_pb2.StockItem(
+                product_id=product_id, quantity=1)]))
+            written[product_id, response.products[0].stock] = at
+        time.sleep(args.poll_interval * 2)
+        stop.set()
+        for consumer in consumers:
+            consumer.join(timeout=10)
+
+        final = {product.id: (product.name, product.price, product.stock)
+                 for product in stub.ListProducts(product_pb2.ListProductsRequest()).products}
+        problems = watched.problems + polled.problems
+        for replica in (watched, polled):
+            if replica.rows != final:
+                problems.append(f"{replica.name}: replica differs from the table in "
+                                f"{sum(replica.rows.get(key) != value for key, value in final.items())} products")
+            print(f"{replica.name:<6} {replica.bytes / 1024:10.1f} KiB in {replica.messages:6} messages  "
+                  f"{lag_summary(replica, written)}")
+        problems.extend(crowd(stub, args.watchers, args.unary_calls))
+    finally:
+        channel.close()
+        benchlib.stop_service(process)
+
+    for problem in problems:
+        print(f"FAIL {problem}")
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Upstream read calls made during request bursts, with and without coalescing.
+
+Starts service_a, service_b and service_c with GRPC_COALESCE=0 and then =1.
+The upstream lookup caches are switched off (USER_CACHE_TTL=0,
+PRODUCT_CACHE_TTL=0) so every request misses, as on a cold or just
+expired cache entry. It then sends --bursts bursts of --burst-size
+concurrent requests of each kind:
+  orders            POST /orders for one user and one (popular) product
+                    -> GetUser on service_a (ReserveStock is a write and is
+                       never coalesced)
+  orders-detail     GET /orders-detail -> BatchGetUsers + BatchGetProducts
+  products-w-users  GET /products-with-users on service_b -> ListUsers
+and prints, per kind, the requests, the upstream read calls actually sent
+(grpc_client_handled_total of the calling service) and the latency.
+
+With coalescing, every request must still succeed and the upstream read
+calls must be fewer than the requests; the script exits non-zero if not.
+
+Usage:
+    python bench/bench_coalescing.py --bursts 20 --burst-size 50
+"""
+import argparse
+import asyncio
+import os
+import re
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchlib  # noqa: E402
+
+PORTS = {'service_a': (18531, 50531), 'service_b': (18532, 50532), 'service_c': (18533, 50533)}
+SCENARIOS = [
+    # name, service called, upstream read methods it triggers
+    ("orders", "service_c", ("/user.UserService/GetUser",)),
+    ("orders-detail", "service_c", ("/user.UserService/BatchGetUsers", "/product.ProductService/BatchGetProducts")),
+    ("products-w-users", "service_b", ("/user.UserService/ListUsers",)),
+]
+CLIENT_CALLS = re.compile(r'^grpc_client_handled_total\{method="([^"]+)",code="[^"]+"\} (\S+)$', re.M)
+
+
+def service_env(coalesce):
+    env = {'GRPC_COALESCE': coalesce, 'USER_CACHE_TTL': '0', 'PRODUCT_CACHE_TTL': '0', 'LOG_LEVEL': 'WARNING',
+           'STORE_ENGINE': 'memory', 'RESPONSE_CACHE_ENTRIES': '0',
+           'USER_SERVICE_ADDR': f'localhost:{PORTS["service_a"][1]}',
+           'PRODUCT_SERVICE_ADDR': f'localhost:{PORTS["service_b"][1]}'}
+    for service, (rest_port, grpc_port) in PORTS.items():
+        letter = service[-1].upper()
+        env[f'SERVICE_{letter}_PORT'] = str(rest_port)
+        env[f'SERVICE_{letter}_GRPC_PORT'] = str(grpc_port)
+    return env
+
+
+async def upstream_calls(client, service, methods):
+    """Outbound calls of `methods` made so far by `service`, from its /metrics"""
+    text = (await client.get(f'http://localhost:{PORTS[service][0]}/metrics')).text
+    return sum(float(count) for method, count in CLIENT_CALLS.findall(text) if method in methods)
+
+
+async def run_bursts(client, name, service, bursts, size, product_id):
+    """Send `bursts` bursts of `size` concurrent requests; returns (latencies, errors, elapsed)"""
+    base = f'http://localhost:{PORTS[service][0]}'
+    if name == "orders":
+        def request():
+            return client.post(f'{base}/orders', json={"user_id": 1, "product_id": product_id, "quantity": 1})
+    elif name == "orders-detail":
+        def request():
+            return client.get(f'{base}/orders-detail')
+    else:
+        def request():
+            return client.get(f'{base}/products-with-users')
+
+    async def timed():
+        started = time.perf_counter()
+        response = await request()
+        return time.perf_counter() - started, response.status_code < 300
+
+    latencies, errors = [], 0
+    started = time.perf_counter()
+    for _ in range(bursts):
+        for latency, ok in await asyncio.gather(*(timed() for _ in range(size))):
+            latencies.append(latency)
+            errors += not ok
+    return latencies, errors, time.perf_counter() - started
+
+
+async def measure(args):
+    """Run every scenario against the running services;
+    returns {name: (upstream calls, calls per method, seconds, summary)}"""
+    results = {}
+    limits = httpx.Limits(max_connections=args.burst_size)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        # Enough stock for every order, and one order so /orders-detail has details to fetch
+        products = [{"name": "Popular", "price": 10.0, "stock": 10 ** 9}]
+        response = await client.post(f'http://localhost:{PORTS["service_b"][0]}/products/batch', json=products)
+        product_id = response.json()["data"][0]["data"]["id"]
+        (await client.post(f'http://localhost:{PORTS["service_c"][0]}/orders',
+                           json={"user_id": 1, "product_id": product_id, "quantity": 1})).raise_for_status()
+        for name, service, methods in SCENARIOS:
+            before = await upstream_calls(client, service, methods)
+            latencies, errors, elapsed = await run_bursts(client, name, service, args.bursts, args.burst_size,
+                                                          product_id)
+            calls = await upstream_calls(client, service, methods) - before
+            results[name] = (calls, calls / len(methods), elapsed, benchlib.summarize(latencies, errors, elapsed))
+    return results
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bursts', type=int, default=20)
+    parser.add_argument('--burst-size', type=int, default=50, help='concurrent requests per burst')
+    args = parser.parse_args()
+
+    failures = []
+    for coalesce in ('0', '1'):
+        env = service_env(coalesce)
+        processes = []
+        try:
+            for service, ports in PORTS.items():
+                processes.append(benchlib.start_service(service, env, ports))
+            results = asyncio.run(measure(args))
+        finally:
+            for process in processes:
+                benchlib.stop_service(process)
+        label = "coalesced" if coalesce == '1' else "direct"
+        for name, (calls, per_method, elapsed, summary) in results.items():
+            requests = summary["requests"]
+            print(f"{label:<9} {name:<16} requests={requests:<6} upstream reads={calls:<6.0f} "
+                  f"({per_method / max(requests, 1):.2f}/request/method, {calls / elapsed:7.1f}/s)  "
+                  f"errors={summary['errors']:<4} p50={summary['p50_ms']:8.2f}ms  p99={summary['p99_ms']:8.2f}ms")
+            if summary["errors"]:
+                failures.append(f"{name}: {summary['errors']} failed requests ({label})")
+            if coalesce == '1' and args.burst_size > 1 and per_method >= requests:
+                failures.append(f"{name}: {per_method:.0f} upstream reads per method for {requests} requests "
+                                f"with coalescing")
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
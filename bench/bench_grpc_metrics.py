@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+gRPC server metrics (common.metrics): status labels and per-call cost, and
+the status of the server spans (common.tracing).
+
+Serves a stand-in GetUser on a grpc.aio server and on a thread-pool
+grpc.server, each with and without its metrics interceptor. The handler
+answers OK for id > 0, sets NOT_FOUND on its context and returns normally
+for id 0, and aborts with INVALID_ARGUMENT for id < 0. For each server it
+drives --calls calls through both (best of --repeat runs) and prints
+calls/s and the cost of the interceptor per call. Since over loopback that
+difference is small next to the noise of the call itself, the cost is
+also measured in-process: the interceptor and a no-op handler called
+directly, against the handler alone; that figure must stay under
+--max-cost-us.
+
+A third run per server sends a sampled traceparent through the tracing
+interceptor. grpc_server_handled_total and the spans in the trace buffer
+must count every call under the code the client saw (OK, NOT_FOUND,
+INVALID_ARGUMENT); the script exits non-zero otherwise.
+
+Usage:
+    python bench/bench_grpc_metrics.py --calls 5000 --repeat 3
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+from concurrent import futures
+
+import grpc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.metrics import GRPC_SERVER_HANDLED, AioServerMetricsInterceptor, ServerMetricsInterceptor  # noqa: E402
+from common.tracing import TRACEPARENT, AioServerTracingInterceptor, ServerTracingInterceptor, recent_spans  # noqa: E402
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'service_a', 'proto'))
+import user_pb2  # noqa: E402
+import user_pb2_grpc  # noqa: E402
+
+PORT = 50631
+METHOD = "/user.UserService/GetUser"
+CODES = ("OK", "NOT_FOUND", "INVALID_ARGUMENT")
+
+
+def code_for(user_id):
+    """Status the stand-in answers `user_id` with"""
+    return "OK" if user_id > 0 else "NOT_FOUND" if user_id == 0 else "INVALID_ARGUMENT"
+
+
+class ThreadUserService(user_pb2_grpc.UserServiceServicer):
+    def GetUser(self, request, context):
+        if request.id < 0:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, "negative id")
+        if request.id == 0:
+            context.set_code(grpc.StatusCode.NOT_FOUND)
+            context.set_details("no user 0")
+            return user_pb2.UserResponse()
+        return user_pb2.UserResponse(code=200, user=user_pb2.User(id=request.id))
+
+
+class AioUserService(user_pb2_grpc.UserServiceServicer):
+    async def GetUser(self, request, context):
+        if request.id < 0:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, "negative id")
+        if request.id == 0:
+            context.set_code(grpc.StatusCode.NOT_FOUND)
+            context.set_details("no user 0")
+            return user_pb2.UserResponse()
+        return user_pb2.UserResponse(code=200, user=user_pb2.User(id=request.id))
+
+
+def ids(calls):
+    """Ids of the calls: mostly found, every 10th missing, every 25th invalid"""
+    return [0 if i % 10 == 0 else -1 if i % 25 == 1 else i for i in range(calls)]
+
+
+def handled():
+    """Current grpc_server_handled_total of GetUser per code"""
+    return {code: GRPC_SERVER_HANDLED.labels(METHOD, code).value for code in CODES}
+
+
+def traced(trace_id):
+    """Status of each GetUser span of `trace_id` in the trace buffer"""
+    counts = dict.fromkeys(CODES, 0)
+    for span in recent_spans(trace_id, limit=0):
+        if span["name"] == METHOD:
+            counts[span["status"]] = counts.get(span["status"], 0) + 1
+    return counts
+
+
+def drive_thread(user_ids, interceptors, metadata=None):
+    """Calls/s and client-side codes against a thread-pool server"""
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4), interceptors=interceptors)
+    user_pb2_grpc.add_UserServiceServicer_to_server(ThreadUserService(), server)
+    server.add_insecure_port(f'localhost:{PORT}')
+    server.start()
+    seen = dict.fromkeys(CODES, 0)
+    try:
+        with grpc.insecure_channel(f'localhost:{PORT}') as channel:
+            stub = user_pb2_grpc.UserServiceStub(channel)
+            started = time.perf_counter()
+            for user_id in user_ids:
+                try:
+                    stub.GetUser(user_pb2.GetUserRequest(id=user_id), metadata=metadata)
+                    seen["OK"] += 1
+                except grpc.RpcError as e:
+                    seen[e.code().name] += 1
+            elapsed = time.perf_counter() - started
+    finally:
+        server.stop(None)
+    return len(user_ids) / elapsed, seen
+
+
+async def drive_aio(user_ids, interceptors, metadata=None):
+    """Calls/s and client-side codes against a grpc.aio server"""
+    server = grpc.aio.server(interceptors=interceptors)
+    user_pb2_grpc.add_UserServiceServicer_to_server(AioUserService(), server)
+    server.add_insecure_port(f'localhost:{PORT}')
+    await server.start()
+    seen = dict.fromkeys(CODES, 0)
+    try:
+        async with grpc.aio.insecure_channel(f'localhost:{PORT}') as channel:
+            stub = user_pb2_grpc.UserServiceStub(channel)
+            started = time.perf_counter()
+            for user_id in user_ids:
+                try:
+                    await stub.GetUser(user_pb2.GetUserRequest(id=user_id), metadata=metadata)
+                    seen["OK"] += 1
+                except grpc.aio.AioRpcError as e:
+                    seen[e.code().name] += 1
+            elapsed = time.perf_counter() - started
+    finally:
+        await server.stop(None)
+    return len(user_ids) / elapsed, seen
+
+
+class _Context:
+    """Stand-in servicer context of the in-process measurement (no code set)"""
+
+    def code(self):
+        return None
+
+
+class _CallDetails:
+    method = METHOD
+    invocation_metadata = ()
+
+
+def in_process_cost(mode, calls):
+    """Microseconds the metrics interceptor adds to a call, called directly without a server"""
+    context, details = _Context(), _CallDetails()
+    if mode == "thread":
+        handler = grpc.unary_unary_rpc_method_handler(lambda request, context: request)
+        interceptor = ServerMetricsInterceptor()
+
+        def run(intercepted):
+            started = time.perf_counter()
+            for _ in range(calls):
+                wrapped = interceptor.intercept_service(lambda _: handler, details) if intercepted else handler
+                wrapped.unary_unary(None, context)
+            return time.perf_counter() - started
+    else:
+        async def behavior(request, context):
+            return request
+        handler = grpc.unary_unary_rpc_method_handler(behavior)
+        interceptor = AioServerMetricsInterceptor()
+
+        async def continuation(_):
+            return handler
+
+        async def timed(intercepted):
+            started = time.perf_counter()
+            for _ in range(calls):
+                wrapped = await interceptor.intercept_service(continuation, details) if intercepted else handler
+                await wrapped.unary_unary(None, context)
+            return time.perf_counter() - started
+
+        def run(intercepted):
+            return asyncio.run(timed(intercepted))
+    plain = min(run(False) for _ in range(3))
+    observed = min(run(True) for _ in range(3))
+    return (observed - plain) / calls * 1e6
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--max-cost-us', type=float, default=5.0)
+    args = parser.parse_args()
+
+    user_ids = ids(args.calls)
+    expected = dict.fromkeys(CODES, 0)
+    for user_id in user_ids:
+        expected[code_for(user_id)] += 1
+
+    failures = []
+    modes = (
+        ("thread", drive_thread, ServerMetricsInterceptor, ServerTracingInterceptor),
+        ("aio", lambda *a: asyncio.run(drive_aio(*a)), AioServerMetricsInterceptor, AioServerTracingInterceptor),
+    )
+    for mode, drive, metrics_interceptor, tracing_interceptor in modes:
+        plain = rate = 0
+        for _ in range(args.repeat):
+            plain = max(plain, drive(user_ids, [])[0])
+            before = handled()
+            run_rate, seen = drive(user_ids, [metrics_interceptor()])
+            rate = max(rate, run_rate)
+            counted = {code: int(handled()[code] - before[code]) for code in CODES}
+        cost = in_process_cost(mode, 100000)
+        print(f"{mode:<6} plain={plain:8.0f}/s  with metrics={rate:8.0f}/s  "
+              f"({(1 / rate - 1 / plain) * 1e6:+.1f}us per call, {cost:.1f}us in-process)  handled_total {counted}")
+        if cost > args.max_cost_us:
+            failures.append(f"{mode}: the metrics interceptor costs {cost:.1f}us per call (max {args.max_cost_us})")
+        if seen != expected:
+            failures.append(f"{mode}: the stand-in answered {seen}, expected {expected}")
+        if counted != seen:
+            failures.append(f"{mode}: grpc_server_handled_total counted {counted}, clients saw {seen}")
+        # A sampled trace of its own per server
+        trace_id = uuid.uuid4().hex
+        _, seen = drive(user_ids, [tracing_interceptor()], ((TRACEPARENT, f"00-{trace_id}-{trace_id[:16]}-01"),))
+        spans = traced(trace_id)
+        print(f"{'':<6} span status {spans}")
+        if spans != seen:
+            failures.append(f"{mode}: server spans have status {spans}, clients saw {seen}")
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
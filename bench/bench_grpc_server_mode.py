@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Compare gRPC throughput of service_a in thread-pool mode and aio mode.
+
+Starts service_a twice as a subprocess on local ports, once with
+GRPC_SERVER_MODE=thread and once with GRPC_SERVER_MODE=aio, and drives
+GetUser and StreamUsers from many concurrent grpc.aio clients. The last
+scenario runs GetUser and REST GET /users/{id} at the same time to show how
+the two servers interfere inside one process.
+
+Usage:
+    python bench/bench_grpc_server_mode.py --requests 20000 --concurrency 200
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+import grpc
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchlib  # noqa: E402
+
+sys.path.insert(0, os.path.join(benchlib.BASE_DIR, 'service_a'))
+sys.path.insert(0, os.path.join(benchlib.BASE_DIR, 'service_a', 'proto'))
+from proto import user_pb2, user_pb2_grpc  # noqa: E402
+
+REST_PORT = 18001
+GRPC_PORT = 50251
+
+
+async def measure(args):
+    channel = grpc.aio.insecure_channel(f'localhost:{GRPC_PORT}')
+    stub = user_pb2_grpc.UserServiceStub(channel)
+    await channel.channel_ready()
+
+    async def get_user(i):
+        await stub.GetUser(user_pb2.GetUserRequest(id=i % 3 + 1))
+
+    async def stream_users(i):
+        async for _ in stub.StreamUsers(user_pb2.ListUsersRequest()):
+            pass
+
+    results = {
+        'GetUser': await benchlib.drive(get_user, args.requests, args.concurrency),
+        'StreamUsers': await benchlib.drive(stream_users, args.requests // 10, args.concurrency),
+    }
+
+    limits = httpx.Limits(max_connections=args.concurrency // 2)
+    async with httpx.AsyncClient(base_url=f'http://localhost:{REST_PORT}', limits=limits) as client:
+        async def rest_get_user(i):
+            response = await client.get(f'/users/{i % 3 + 1}')
+            response.raise_for_status()
+
+        results['mixed/GetUser'], results['mixed/REST'] = await asyncio.gather(
+            benchlib.drive(get_user, args.requests // 2, args.concurrency // 2),
+            benchlib.drive(rest_get_user, args.requests // 10, args.concurrency // 2),
+        )
+    await channel.close()
+    return results
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    args = parser.parse_args()
+
+    for mode in ('thread', 'aio'):
+        process = benchlib.start_service('service_a', env={
+            'GRPC_SERVER_MODE': mode,
+            'SERVICE_A_PORT': str(REST_PORT),
+            'SERVICE_A_GRPC_PORT': str(GRPC_PORT),
+        }, wait_ports=(REST_PORT, GRPC_PORT))
+        try:
+            results = asyncio.run(measure(args))
+        finally:
+            benchlib.stop_service(process)
+        for rpc, result in results.items():
+            benchlib.report(f"{mode}/{rpc}", *result)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
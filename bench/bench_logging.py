@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Per-call logging overhead on the request thread.
+
+Logs the GetUser hot-path message N times and reports the time the calling
+thread spends per call, and the time until every record has been written:
+  sync f-string   - the old setup: logging.basicConfig-style StreamHandler,
+                    message built with an f-string on the caller
+  queue json      - common.logs pipeline, lazy %-args, JSON written by the
+                    listener thread
+  queue enqueue   - same with the writer thread paused until the loop ends:
+                    the caller's share alone, as seen when the writer runs
+                    on another core
+  queue json 1%   - same with LOG_SAMPLING=rpc=0.01
+  level off       - rpc logger above INFO (the floor for any logging call)
+Output goes to os.devnull so terminal speed does not count.
+
+Usage:
+    python bench/bench_logging.py --calls 200000
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchlib  # noqa: E402
+
+sys.path.insert(0, benchlib.BASE_DIR)
+
+
+def run(name, calls, log_call, listener=None, pause_writer=False):
+    """Time `calls` invocations of log_call(i) and, if given, the listener draining its queue"""
+    if pause_writer:
+        listener.stop()
+    started = time.perf_counter()
+    for i in range(calls):
+        log_call(i)
+    caller = time.perf_counter() - started
+    if pause_writer:
+        listener.start()
+    if listener is not None:
+        listener.queue.join()
+    total = time.perf_counter() - started
+    print(f"{name:<14} caller={caller / calls * 1e6:7.2f}us/call  written={total / calls * 1e6:7.2f}us/record")
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=200000)
+    args = parser.parse_args()
+    # Queue every record so the caller-side time is not flattered by drops
+    os.environ['LOG_QUEUE_SIZE'] = str(args.calls + 1)
+    from common.logs import configure_logging  # noqa: E402
+
+    devnull = open(os.devnull, 'w')
+    root = logging.getLogger()
+    legacy_logger = logging.getLogger("legacy")
+    root.handlers[:] = [logging.StreamHandler(devnull)]
+    root.handlers[0].setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+    root.setLevel(logging.INFO)
+    run("sync f-string", args.calls, lambda i: legacy_logger.info(f"gRPC GetUser called with id={i}"))
+
+    listener = configure_logging("bench", stream=devnull, sampling="")
+    # Created after configure_logging(), like the services' loggers
+    rpc_logger = logging.getLogger("rpc")
+    run("queue json", args.calls, lambda i: rpc_logger.info("gRPC GetUser called with id=%s", i), listener)
+    run("queue enqueue", args.calls, lambda i: rpc_logger.info("gRPC GetUser called with id=%s", i), listener,
+        pause_writer=True)
+
+    listener = configure_logging("bench", stream=devnull, sampling="rpc=0.01")
+    run("queue json 1%", args.calls, lambda i: rpc_logger.info("gRPC GetUser called with id=%s", i), listener)
+
+    rpc_logger.setLevel(logging.WARNING)
+    run("level off", args.calls, lambda i: rpc_logger.info("gRPC GetUser called with id=%s", i))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Benchmark service_c order creation against local stand-in upstream servers.
+
+Compares the old sequential validation path (GetUser, then GetProduct, no
+deadlines) with the current concurrent path in service_c/main.py (GetUser
+alongside ReserveStock, with deadlines), and prints p50/p99 latency for
+both. The stand-in servers add a fixed delay per call and a small fraction
+of very slow calls so the effect of deadlines is visible.
+
+The stand-in Product Service applies a reservation before its delay, as a
+real one whose answer is late would, and keeps a ledger by reservation id.
+After the concurrent run the stock still held must equal the orders that
+were created: every reservation cut off by a deadline or the budget has
+to be released. Exits non-zero if it is not.
+
+Usage:
+    python bench/bench_order_fanout.py --requests 500 --concurrency 20
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICE_C_DIR = os.path.join(BASE_DIR, 'service_c')
+
+USER_PORT = 50151
+PRODUCT_PORT = 50152
+
+os.environ.setdefault('USER_SERVICE_ADDR', f'localhost:{USER_PORT}')
+os.environ.setdefault('PRODUCT_SERVICE_ADDR', f'localhost:{PRODUCT_PORT}')
+os.environ.setdefault('GRPC_CALL_TIMEOUT', '0.25')
+os.environ.setdefault('ORDER_REQUEST_BUDGET', '0.5')
+
+sys.path.insert(0, SERVICE_C_DIR)
+import grpc  # noqa: E402
+from fastapi import HTTPException  # noqa: E402
+import main as order_service  # noqa: E402
+from proto import user_pb2, user_pb2_grpc, product_pb2, product_pb2_grpc  # noqa: E402
+
+
+class StandInUserService(user_pb2_grpc.UserServiceServicer):
+    """User service that answers every id after a configurable delay"""
+
+    def __init__(self, delay, slow_ratio, slow_delay):
+        self.delay = delay
+        self.slow_ratio = slow_ratio
+        self.slow_delay = slow_delay
+
+    async def GetUser(self, request, context):
+        slow = random.random() < self.slow_ratio
+        await asyncio.sleep(self.slow_delay if slow else self.delay)
+        user = user_pb2.User(id=request.id, name=f"user-{request.id}", email=f"{request.id}@example.com")
+        return user_pb2.UserResponse(code=200, message="Success", user=user)
+
+
+class StandInProductService(product_pb2_grpc.ProductServiceServicer):
+    """Product service that answers every id after a configurable delay,
+    keeping the quantity each reservation holds"""
+
+    def __init__(self, delay, slow_ratio, slow_delay):
+        self.delay = delay
+        self.slow_ratio = slow_ratio
+        self.slow_delay = slow_delay
+        self.held = {}
+        self.released = set()
+
+    async def GetProduct(self, request, context):
+        slow = random.random() < self.slow_ratio
+        await asyncio.sleep(self.slow_delay if slow else self.delay)
+        product = product_pb2.Product(id=request.id, name=f"product-{request.id}", price=10.0, stock=1_000_000)
+        return product_pb2.ProductResponse(code=200, message="Success", product=product)
+
+    async def ReserveStock(self, request, context):
+        if request.reservation_id in self.released:
+            return product_pb2.StockResponse(code=410, message="Reservation was released")
+        self.held.setdefault(request.reservation_id, sum(item.quantity for item in request.items))
+        slow = random.random() < self.slow_ratio
+        await asyncio.sleep(self.slow_delay if slow else self.delay)
+        products = [
+            product_pb2.Product(id=item.product_id, name=f"product-{item.product_id}", price=10.0, stock=1_000_000)
+            for item in request.items
+        ]
+        return product_pb2.StockResponse(code=200, message="Success", products=products)
+
+    async def ReleaseStock(self, request, context):
+        self.released.add(request.reservation_id)
+        self.held.pop(request.reservation_id, None)
+        return product_pb2.StockResponse(code=200, message="Success")
+
+
+async def start_stand_ins(args):
+    """Start the stand-in User and Product gRPC servers; returns (servers, product servicer)"""
+    servers = []
+    user_server = grpc.aio.server()
+    user_pb2_grpc.add_UserServiceServicer_to_server(
+        StandInUserService(args.delay, args.slow_ratio, args.slow_delay), user_server)
+    user_server.add_insecure_port(f'localhost:{USER_PORT}')
+    servers.append(user_server)
+
+    product_server = grpc.aio.server()
+    products = StandInProductService(args.delay, args.slow_ratio, args.slow_delay)
+    product_pb2_grpc.add_ProductServiceServicer_to_server(products, product_server)
+    product_server.add_insecure_port(f'localhost:{PRODUCT_PORT}')
+    servers.append(product_server)
+
+    for server in servers:
+        await server.start()
+    return servers, products
+
+
+async def create_order_sequential(order):
+    """The pre-fan-out validation path: two awaited calls, no deadlines"""
+    user_response = await order_service.user_service_stub.GetUser(user_pb2.GetUserRequest(id=order["user_id"]))
+    if user_response.code != 200:
+        raise HTTPException(status_code=404, detail="User not found")
+    product_response = await order_service.product_service_stub.GetProduct(
+        product_pb2.GetProductRequest(id=order["product_id"]))
+    if product_response.code != 200:
+        raise HTTPException(status_code=404, detail="Product not found")
+    return product_response.product.price * order["quantity"]
+
+
+async def run(create, total, concurrency):
+    """Drive `create` with bounded concurrency and collect per-call latencies"""
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        nonlocal errors
+        order = {"user_id": i % 100 + 1, "product_id": i % 50 + 1, "quantity": 1}
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await create(order)
+            except HTTPException:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    return latencies, errors, time.perf_counter() - started
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an unsorted list"""
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def report(name, latencies, errors, elapsed):
+    """Print a one-line latency summary"""
+    print(f"{name:<12} n={len(latencies):<6} errors={errors:<5} "
+          f"rps={len(latencies) / elapsed:8.1f}  "
+          f"p50={percentile(latencies, 50) * 1000:7.1f}ms  "
+          f"p99={percentile(latencies, 99) * 1000:7.1f}ms  "
+          f"mean={statistics.mean(latencies) * 1000:7.1f}ms")
+
+
+async def main_async(args):
+    """Run both paths; returns False if the concurrent one left stock reserved without an order"""
+    servers, products = await start_stand_ins(args)
+    try:
+        await order_service.init_service_connections()
+        # Warm up both channels
+        await run(order_service.create_order, 20, 5)
+
+        print(f"Stand-in delay {args.delay * 1000:.0f}ms, {args.slow_ratio:.1%} of calls "
+              f"take {args.slow_delay * 1000:.0f}ms; per-call timeout "
+              f"{order_service.GRPC_CALL_TIMEOUT * 1000:.0f}ms, budget "
+              f"{order_service.ORDER_REQUEST_BUDGET * 1000:.0f}ms")
+        report("sequential", *await run(create_order_sequential, args.requests, args.concurrency))
+        products.held.clear()
+        latencies, errors, elapsed = await run(order_service.create_order, args.requests, args.concurrency)
+        report("concurrent", latencies, errors, elapsed)
+
+        # Let the last releases and the cut-off reservations finish
+        await asyncio.sleep(args.slow_delay)
+        while order_service.background_releases:
+            await asyncio.gather(*order_service.background_releases)
+        held = sum(products.held.values())
+        created = len(latencies) - errors
+        print(f"stock held by reservations: {held}, orders created: {created}")
+        return held == created
+    finally:
+        await order_service.user_service_pool.close()
+        await order_service.product_service_pool.close()
+        for server in servers:
+            await server.stop(None)
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--delay', type=float, default=0.01, help='stand-in latency per call (s)')
+    parser.add_argument('--slow-ratio', type=float, default=0.01, help='fraction of very slow calls')
+    parser.add_argument('--slow-delay', type=float, default=2.0, help='latency of a slow call (s)')
+    args = parser.parse_args()
+    if not asyncio.run(main_async(args)):
+        print("FAIL reservations were left without an order")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
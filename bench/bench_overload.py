@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Goodput and /health under overload, with and without admission control.
+
+Starts service_a, service_b and service_c with ADMISSION_CONTROL=0 and
+then =1. For each it first measures the capacity of POST /orders (closed
+loop, --concurrency requests at a time, for --warmup seconds), then
+offers --overload times the first run's capacity, so both runs get the
+same load, open loop (requests keep arriving whether or not earlier
+ones finished, as from many independent clients) for --seconds seconds.
+Each order has --slo seconds to complete, after which its client hangs
+up; one that answers 2xx within it counts as goodput. /health is probed
+every 0.2s throughout.
+
+Per mode it prints the capacity, the goodput (also as a share of the
+capacity the load was set from), the requests shed (503), timed out or
+failed, and the /health latency. With admission control the goodput
+must stay above --min-goodput of that capacity and every /health probe
+must answer within 1s; the script exits non-zero if not.
+
+A shed request still costs its connection and HTTP parsing, about a
+third of an order on a small machine running the load generator too, so
+the goodput possible falls as --overload rises.
+
+Usage:
+    python bench/bench_overload.py --overload 2 --seconds 10
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchlib  # noqa: E402
+
+PORTS = {'service_a': (18541, 50541), 'service_b': (18542, 50542), 'service_c': (18543, 50543)}
+HEALTH_INTERVAL = 0.2
+HEALTH_SLO = 1.0
+
+
+def service_env(admission):
+    env = {'ADMISSION_CONTROL': admission, 'LOG_LEVEL': 'WARNING', 'STORE_ENGINE': 'memory',
+           'USER_SERVICE_ADDR': f'localhost:{PORTS["service_a"][1]}',
+           'PRODUCT_SERVICE_ADDR': f'localhost:{PORTS["service_b"][1]}'}
+    for service, (rest_port, grpc_port) in PORTS.items():
+        letter = service[-1].upper()
+        env[f'SERVICE_{letter}_PORT'] = str(rest_port)
+        env[f'SERVICE_{letter}_GRPC_PORT'] = str(grpc_port)
+    return env
+
+
+class RawClient:
+    """Minimal keep-alive HTTP/1.1 client for one local port.
+
+    httpx spends more CPU per request than the services do; on a small
+    machine it would be the load generator, not the services, that
+    overloads. Requests are sent as pre-encoded bytes over a pool of
+    connections, opening another whenever all are busy.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self._idle = []
+
+    @staticmethod
+    def encode(method, path, body=b""):
+        head = f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+        return (head + f"Content-Length: {len(body)}\r\n\r\n").encode() + body
+
+    async def _exchange(self, connection, request):
+        reader, writer = connection
+        writer.write(request)
+        head = await reader.readuntil(b"\r\n\r\n")
+        at = head.lower().find(b"content-length:")
+        length = int(head[at + 15:head.index(b"\r\n", at)]) if at >= 0 else 0
+        await reader.readexactly(length)
+        return int(head[9:12])
+
+    async def send(self, request, timeout):
+        """Status code of the response, None if none came within `timeout` seconds, 0 if refused"""
+        try:
+            connection = self._idle.pop() if self._idle else await asyncio.open_connection("127.0.0.1", self.port)
+        except OSError:
+            return 0
+        try:
+            status = await asyncio.wait_for(self._exchange(connection, request), timeout)
+        except (asyncio.TimeoutError, OSError, asyncio.IncompleteReadError):
+            # The client gives up and hangs up; the server may still be working on it
+            connection[1].close()
+            return None
+        self._idle.append(connection)
+        return status
+
+    def close(self):
+        for _, writer in self._idle:
+            writer.close()
+
+
+async def probe_health(stop):
+    """GET /health on service_c every HEALTH_INTERVAL until `stop` is set; returns (latencies, failures)"""
+    client = RawClient(PORTS["service_c"][0])
+    request = RawClient.encode("GET", "/health")
+    latencies, failures = [], 0
+    while not stop.is_set():
+        started = time.perf_counter()
+        status = await client.send(request, 5)
+        latency = time.perf_counter() - started
+        latencies.append(latency)
+        failures += status != 200 or latency > HEALTH_SLO
+        await asyncio.sleep(HEALTH_INTERVAL)
+    client.close()
+    return latencies, failures
+
+
+async def measure(args, rate=None):
+    """Capacity, then an open-loop overload run at `rate` (default: --overload times the capacity);
+    returns (capacity, rate, outcome counts, seconds, health)"""
+    async with httpx.AsyncClient(timeout=30) as client:
+        products = [{"name": "Overload", "price": 1.0, "stock": 10 ** 9}]
+        response = await client.post(f'http://localhost:{PORTS["service_b"][0]}/products/batch', json=products)
+        product_id = response.json()["data"][0]["data"]["id"]
+    client = RawClient(PORTS["service_c"][0])
+    order = RawClient.encode("POST", "/orders", json.dumps({"user_id": 1, "product_id": product_id,
+                                                             "quantity": 1}).encode())
+
+    async def place(_):
+        if await client.send(order, 30) != 200:
+            raise RuntimeError("order failed")
+
+    started = time.perf_counter()
+    latencies, errors, elapsed = [], 0, 0.0
+    while time.perf_counter() - started < args.warmup:
+        batch = await benchlib.drive(place, args.concurrency * 20, args.concurrency)
+        latencies += batch[0]
+        errors += batch[1]
+        elapsed += batch[2]
+    capacity = (len(latencies) - errors) / elapsed
+
+    outcomes = {"ok": 0, "shed": 0, "timeout": 0, "error": 0}
+
+    async def offered():
+        status = await client.send(order, args.slo)
+        if status is None:
+            outcomes["timeout"] += 1
+        elif status == 503:
+            outcomes["shed"] += 1
+        else:
+            outcomes["ok" if status < 300 else "error"] += 1
+
+    stop = asyncio.Event()
+    health = asyncio.create_task(probe_health(stop))
+    rate = rate or capacity * args.overload
+    tasks = []
+    started = time.perf_counter()
+    for i in range(int(rate * args.seconds)):
+        delay = started + i / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(offered()))
+    elapsed = time.perf_counter() - started
+    await asyncio.gather(*tasks)
+    stop.set()
+    client.close()
+    return capacity, rate, outcomes, elapsed, await health
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--overload', type=float, default=2.0, help='offered load as a multiple of capacity')
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--warmup', type=float, default=3.0)
+    parser.add_argument('--concurrency', type=int, default=16, help='closed-loop concurrency for the capacity')
+    parser.add_argument('--slo', type=float, default=1.0, help='seconds an order may take to count as goodput')
+    parser.add_argument('--min-goodput', type=float, default=0.3, help='required goodput / capacity with admission')
+    args = parser.parse_args()
+
+    failures = []
+    rate = None
+    for admission in ('0', '1'):
+        env = service_env(admission)
+        processes = []
+        try:
+            for service, ports in PORTS.items():
+                processes.append(benchlib.start_service(service, env, ports))
+            # Both runs are offered the same rate, set by the first one's capacity
+            capacity, rate, outcomes, elapsed, (health, health_failures) = asyncio.run(measure(args, rate))
+        finally:
+            for process in processes:
+                benchlib.stop_service(process)
+        label = "admission" if admission == '1' else "unlimited"
+        goodput = outcomes["ok"] / elapsed
+        reference = rate / args.overload
+        print(f"{label:<9} capacity={capacity:7.1f}/s  offered={rate:7.1f}/s  "
+              f"goodput={goodput:7.1f}/s ({goodput / reference:4.0%})  "
+              + "  ".join(f"{name}={count}" for name, count in outcomes.items()))
+        print(f"{'':<9} /health p50={benchlib.percentile(health, 50) * 1000:7.1f}ms  "
+              f"max={max(health) * 1000:7.1f}ms  failed or slower than {HEALTH_SLO:g}s: {health_failures}")
+        if admission == '1':
+            if goodput < args.min_goodput * reference:
+                failures.append(f"goodput {goodput:.1f}/s is below {args.min_goodput:.0%} of capacity {reference:.1f}/s")
+            if health_failures:
+                failures.append(f"{health_failures} /health probes failed or took over {HEALTH_SLO:g}s")
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Memory and conversion cost of dict rows vs the compact records (common.records).
+
+For users, products and orders it fills one Store with dict rows and one
+with record objects (N each) and prints:
+  - bytes per row (tracemalloc; table dict and row values included)
+  - rows/s converted to protobuf the old way (one dict lookup per field)
+    and with to_proto(), and list messages serialized per second
+  - JSON pages of 1000 rows encoded per second with common.responses.dumps:
+    dict rows, records the first time they are sent (the page is encoded
+    whole and split into the JSON each record keeps) and after that (the
+    page joins the kept JSON), and bytes per row with the JSON kept
+Then it serves ListOrders from each store over a local gRPC server and
+prints list RPCs per second for --page orders per call.
+
+Exits non-zero if a record store, with or without the records' JSON kept,
+is not smaller than the dict store, a record converts to different
+protobuf bytes or JSON than its dict, or record JSON pages, once encoded,
+are sent at less than --min-json-ratio of the dict rate.
+
+Usage:
+    python bench/bench_records.py --records 200000 --page 1000
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from concurrent import futures
+
+import grpc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.pagination import iter_after  # noqa: E402
+from common.records import Order, Product, User  # noqa: E402
+from common.responses import dumps  # noqa: E402
+from common.store import Store  # noqa: E402
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for service in ('service_a', 'service_b', 'service_c'):
+    sys.path.insert(0, os.path.join(BASE_DIR, service, 'proto'))
+import order_pb2  # noqa: E402
+import order_pb2_grpc  # noqa: E402
+import product_pb2  # noqa: E402
+import user_pb2  # noqa: E402
+
+GRPC_PORT = 50611
+
+
+def user_fields(i):
+    return {"name": f"user-{i}", "email": f"user-{i}@example.com"}
+
+
+def product_fields(i):
+    return {"name": f"product-{i}", "price": 9.99 + i % 1000, "stock": i % 5000}
+
+
+def order_fields(i):
+    return {"user_id": i % 100000 + 1, "product_id": i % 5000 + 1, "quantity": i % 10 + 1,
+            "total_price": 19.98 + i % 500, "created_at": 1700000000.0 + i}
+
+
+# Conversions as ListUsers/ListProducts/ListOrders did them on dict rows
+def user_from_dict(user):
+    return user_pb2.User(id=user["id"], name=user["name"], email=user["email"])
+
+
+def product_from_dict(product):
+    return product_pb2.Product(id=product["id"], name=product["name"], price=product["price"], stock=product["stock"])
+
+
+def order_from_dict(order):
+    return order_pb2.Order(id=order["id"], user_id=order["user_id"], product_id=order["product_id"],
+                           quantity=order["quantity"], total_price=order["total_price"],
+                           created_at=order["created_at"])
+
+
+TABLES = [
+    # name, fields, record type, list message, dict conversion, proto message
+    ("users", user_fields, User, lambda rows: user_pb2.UserList(users=rows), user_from_dict, user_pb2.User),
+    ("products", product_fields, Product, lambda rows: product_pb2.ProductList(products=rows),
+     product_from_dict, product_pb2.Product),
+    ("orders", order_fields, Order, lambda rows: order_pb2.OrderList(orders=rows), order_from_dict, order_pb2.Order),
+]
+
+
+def fill(record_type, make_fields, count):
+    """Return (store, bytes per row) for a Store of `count` rows of `record_type`"""
+    gc.collect()
+    tracemalloc.start()
+    store = Store(record_type=record_type)
+    store.insert_many(make_fields(i) for i in range(count))
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return store, size / count
+
+
+def rate(count, fn):
+    """count / seconds taken by fn(), with the garbage collector paused (as timeit does)"""
+    gc.collect()
+    gc.disable()
+    try:
+        started = time.perf_counter()
+        fn()
+        return count / (time.perf_counter() - started)
+    finally:
+        gc.enable()
+
+
+def bench_table(name, make_fields, record_type, make_list, from_dict, message_class, count, min_json_ratio):
+    """Print the numbers for one table; returns (dict store, record store, [failed checks])"""
+    failures = []
+    dict_store, dict_bytes = fill(dict, make_fields, count)
+    record_store, record_bytes = fill(record_type, make_fields, count)
+    print(f"{name:<9} bytes/row: dict={dict_bytes:6.0f} record={record_bytes:6.0f} "
+          f"({record_bytes / dict_bytes:.0%})")
+    if record_bytes >= dict_bytes:
+        failures.append(f"{name}: records use {record_bytes:.0f} bytes/row, dicts {dict_bytes:.0f}")
+
+    dict_rows = dict_store.values()
+    records = record_store.values()
+    old = rate(count, lambda: [from_dict(row) for row in dict_rows])
+    new = rate(count, lambda: [record.to_proto(message_class) for record in records])
+    old_list = rate(count, lambda: make_list([from_dict(row) for row in dict_rows]).SerializeToString())
+    new_list = rate(count, lambda: make_list([record.to_proto(message_class) for record in records]).SerializeToString())
+    print(f"          to proto: dict lookups={old:9.0f}/s to_proto={new:9.0f}/s  "
+          f"list+serialize: {old_list:9.0f}/s -> {new_list:9.0f}/s")
+
+    pages = [dict_rows[i:i + 1000] for i in range(0, count, 1000)]
+    record_pages = [records[i:i + 1000] for i in range(0, count, 1000)]
+    old_json = rate(len(pages), lambda: [dumps({"data": page}) for page in pages])
+    first_json = rate(len(pages), lambda: [dumps({"data": page}) for page in record_pages])
+    kept_bytes = sum(sys.getsizeof(record._json_members) for record in records) / count
+    new_json = rate(len(pages), lambda: [dumps({"data": page}) for page in record_pages])
+    print(f"          JSON pages of 1000: dict={old_json:7.0f}/s record first={first_json:7.0f}/s "
+          f"({first_json / old_json:.0%}) after={new_json:7.0f}/s ({new_json / old_json:.0%})  "
+          f"bytes/row with JSON kept: {record_bytes + kept_bytes:.0f}")
+    if record_bytes + kept_bytes >= dict_bytes:
+        failures.append(f"{name}: records with their JSON kept use {record_bytes + kept_bytes:.0f} bytes/row, "
+                        f"dicts {dict_bytes:.0f}")
+    if new_json < min_json_ratio * old_json:
+        failures.append(f"{name}: record JSON pages at {new_json / old_json:.0%} of dict pages "
+                        f"(minimum {min_json_ratio:.0%})")
+
+    if dumps({"data": pages[0]}) != dumps({"data": record_pages[0]}):
+        failures.append(f"{name}: a page of records encodes to different JSON")
+    for row, record in zip(dict_rows[:1000], records[:1000]):
+        if from_dict(row).SerializeToString() != record.to_proto(message_class).SerializeToString():
+            failures.append(f"{name}: record {record.id} converts to different protobuf bytes")
+            break
+        if dumps(row) != dumps(record):
+            failures.append(f"{name}: record {record.id} encodes to different JSON")
+            break
+    return dict_store, record_store, failures
+
+
+class ListOrdersServicer(order_pb2_grpc.OrderServiceServicer):
+    """ListOrders over a Store, converting rows with `convert`"""
+
+    def __init__(self):
+        self.store = None
+        self.convert = None
+
+    def ListOrders(self, request, context):
+        orders = [self.convert(order) for order in iter_after(self.store, request.after_id, request.limit)]
+        return order_pb2.OrderList(orders=orders)
+
+
+def bench_list_rpc(dict_store, record_store, page, calls):
+    """Print ListOrders calls/s served from each store"""
+    servicer = ListOrdersServicer()
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+    order_pb2_grpc.add_OrderServiceServicer_to_server(servicer, server)
+    server.add_insecure_port(f'localhost:{GRPC_PORT}')
+    server.start()
+    channel = grpc.insecure_channel(f'localhost:{GRPC_PORT}',
+                                    options=[("grpc.max_receive_message_length", 64 * 1024 * 1024)])
+    stub = order_pb2_grpc.OrderServiceStub(channel)
+    try:
+        last = len(record_store)
+        for label, store, convert in (("dict", dict_store, order_from_dict),
+                                      ("record", record_store, lambda order: order.to_proto(order_pb2.Order))):
+            servicer.store, servicer.convert = store, convert
+            requests = [order_pb2.ListOrdersRequest(after_id=(i * page) % max(1, last - page), limit=page)
+                        for i in range(calls)]
+            per_second = rate(calls, lambda: [stub.ListOrders(request) for request in requests])
+            print(f"ListOrders({page}) {label:<6} {per_second:8.1f} calls/s  {per_second * page:10.0f} orders/s")
+    finally:
+        channel.close()
+        server.stop(None)
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=200000)
+    parser.add_argument('--page', type=int, default=1000, help='orders per ListOrders call')
+    parser.add_argument('--calls', type=int, default=200, help='ListOrders calls per store')
+    parser.add_argument('--min-json-ratio', type=float, default=1.0,
+                        help='slowest record JSON page encoding allowed once the records are encoded, '
+                             'as a fraction of dict rows')
+    args = parser.parse_args()
+
+    failures = []
+    for table in TABLES:
+        dict_store, record_store, failed = bench_table(*table, args.records, args.min_json_ratio)
+        failures.extend(failed)
+    bench_list_rpc(dict_store, record_store, args.page, args.calls)
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
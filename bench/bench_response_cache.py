@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Requests/sec of cached versus uncached list and item reads in service_a.
+
+Starts service_a as a subprocess, loads it with users through
+POST /users/batch and drives GET /users?limit=N and GET /users/{id}:
+  uncached - RESPONSE_CACHE_ENTRIES=0, every request is built and encoded
+  cached   - body served from the response cache (200 with full body)
+  304      - client sends If-None-Match with the ETag it already holds
+It also times encoding one page in-process with FastAPI's default path
+(jsonable_encoder + json.dumps) against common.responses.dumps.
+
+Usage:
+    python bench/bench_response_cache.py --users 5000 --page 1000 --requests 2000
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import httpx
+from fastapi.encoders import jsonable_encoder
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchlib  # noqa: E402
+
+sys.path.insert(0, benchlib.BASE_DIR)
+from common.responses import dumps  # noqa: E402
+
+REST_PORT = 18011
+GRPC_PORT = 50261
+
+
+async def measure(args):
+    """Run the read scenarios against the running service; return {name: drive() result}"""
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=f'http://localhost:{REST_PORT}', limits=limits, timeout=30) as client:
+        users = [{"name": f"user-{i}", "email": f"user-{i}@example.com"} for i in range(args.users)]
+        (await client.post('/users/batch', json=users)).raise_for_status()
+        etags = {}
+
+        async def get_page(i):
+            response = await client.get('/users', params={'limit': args.page})
+            response.raise_for_status()
+            etags['page'] = response.headers.get('etag')
+
+        async def get_item(i):
+            response = await client.get(f'/users/{i % args.users + 1}')
+            response.raise_for_status()
+
+        async def get_page_304(i):
+            response = await client.get('/users', params={'limit': args.page},
+                                        headers={'If-None-Match': etags['page']})
+            if response.status_code != 304:
+                raise RuntimeError(f"expected 304, got {response.status_code}")
+
+        results = {
+            'list': await benchlib.drive(get_page, args.requests, args.concurrency),
+            'item': await benchlib.drive(get_item, args.requests * 5, args.concurrency),
+        }
+        if etags.get('page'):
+            results['list 304'] = await benchlib.drive(get_page_304, args.requests, args.concurrency)
+        return results
+
+
+def bench_encoders(page, rounds):
+    """Print the time to encode one page with FastAPI's default path and with dumps()"""
+    content = {"data": [{"id": i, "name": f"user-{i}", "email": f"user-{i}@example.com"}
+                        for i in range(1, page + 1)], "next_cursor": page}
+    for name, encode in (('jsonable+json', lambda: json.dumps(jsonable_encoder(content)).encode()),
+                         ('responses.dumps', lambda: dumps(content))):
+        started = time.perf_counter()
+        for _ in range(rounds):
+            encode()
+        elapsed = time.perf_counter() - started
+        print(f"encode {name:<16} {elapsed / rounds * 1000:8.3f}ms per {page}-row page")
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--page', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    args = parser.parse_args()
+
+    bench_encoders(args.page, 200)
+    for mode, entries in (('uncached', '0'), ('cached', '1024')):
+        process = benchlib.start_service('service_a', env={
+            'RESPONSE_CACHE_ENTRIES': entries,
+            'STORE_ENGINE': 'memory',
+            'SERVICE_A_PORT': str(REST_PORT),
+            'SERVICE_A_GRPC_PORT': str(GRPC_PORT),
+        }, wait_ports=(REST_PORT,))
+        try:
+            results = asyncio.run(measure(args))
+        finally:
+            benchlib.stop_service(process)
+        for name, result in results.items():
+            benchlib.report(f"{mode} {name}", *result)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
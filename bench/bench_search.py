@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Product search index (common.search) vs a linear scan.
+
+Fills a products Store with N products (English, Thai and full-width
+names) and prints:
+  - the time and memory (tracemalloc, on a second build) to index the table
+  - inserts/s with and without the index subscribed (per-write cost)
+  - per-query latency of the index and of a linear scan over the
+    already normalized names, for substring, prefix, price range and
+    combined queries
+Then it renames and reprices some products and checks a few hundred
+random queries (with cursors) against the scan; the script exits
+non-zero if any page differs, or if a query that normalizes to nothing
+(punctuation or spaces only) matches any product.
+
+Usage:
+    python bench/bench_search.py --products 1000000
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.records import Product  # noqa: E402
+from common.search import GRAM, SearchIndex, normalize  # noqa: E402
+from common.store import Store  # noqa: E402
+
+WORDS = ["wireless", "mouse", "keyboard", "usb", "cable", "monitor", "stand", "laptop", "bag", "pad",
+         "speaker", "charger", "hub", "ssd", "webcam", "ＰＲＯ", "Große", "ℌub",
+         "หมา", "แมว", "น้ำปลา", "ไม้กวาด", "กระเป๋า", "หูฟัง", "สาย", "ชาร์จ", "จอ", "เมาส์"]
+
+
+def make_products(count, seed=1):
+    rng = random.Random(seed)
+    return [{"name": f"{' '.join(rng.sample(WORDS, rng.randint(1, 3)))} {rng.randint(1, 99999)}",
+             "price": round(rng.uniform(1, 2000), 2), "stock": rng.randint(0, 100)} for _ in range(count)]
+
+
+def timed(fn, repeat=1):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return result, (time.perf_counter() - started) / repeat
+
+
+def scan(store, names, query="", prefix=False, low=None, high=None, after_id=0, limit=20):
+    """The same search as SearchIndex.search(), by checking every product"""
+    text = normalize(query) if query else ""
+    if query and not text:
+        return []
+    by_prefix = prefix or len(text) < GRAM
+    found = []
+    for product in store.values():
+        if product.id <= after_id:
+            continue
+        if text:
+            name = names[product.id]
+            if by_prefix:
+                if not (name.startswith(text) or " " + text in name):
+                    continue
+            elif text not in name:
+                continue
+        if low is not None and product.price < low or high is not None and product.price > high:
+            continue
+        found.append(product)
+        if len(found) == limit:
+            break
+    return found
+
+
+def random_query(rng, last_id):
+    word = normalize(rng.choice(WORDS))
+    start = rng.randrange(len(word))
+    query = word[start:start + rng.randint(1, 6)]
+    low = round(rng.uniform(0, 2000), 2)
+    choice = rng.random()
+    return {
+        "query": query if choice < 0.8 else "",
+        "prefix": rng.random() < 0.3,
+        "low": low if choice > 0.5 else None,
+        "high": low + rng.choice([1, 20, 500]) if choice > 0.6 else None,
+        "after_id": rng.choice([0, 0, rng.randint(0, last_id)]),
+        "limit": rng.choice([1, 20, 100]),
+    }
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--products', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=300, help='random queries checked against the scan')
+    args = parser.parse_args()
+    failures = []
+
+    rows = make_products(args.products)
+    store = Store(record_type=Product)
+    store.insert_many(rows)
+    # Memory is measured on a separate build: tracing allocations slows it down several times
+    gc.collect()
+    tracemalloc.start()
+    index = SearchIndex(store, "name", "price")
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    store.unsubscribe(index._on_write)
+    del index
+    gc.collect()
+    index, elapsed = timed(lambda: SearchIndex(store, "name", "price"))
+    print(f"index {len(index)} products in {elapsed:6.2f}s  {size / 2 ** 20:7.1f} MiB ({size / len(index):.0f} bytes/product)")
+
+    extra = make_products(20000, seed=2)
+    plain = Store(record_type=Product)
+    _, plain_elapsed = timed(lambda: [plain.insert(row) for row in extra])
+    _, indexed_elapsed = timed(lambda: [store.insert(row) for row in extra])
+    print(f"inserts: plain={len(extra) / plain_elapsed:9.0f}/s  indexed={len(extra) / indexed_elapsed:9.0f}/s"
+          f"  (+{(indexed_elapsed - plain_elapsed) / len(extra) * 1e6:.1f}us per product)")
+
+    names = {product.id: normalize(product.name) for product in store.values()}
+    queries = [
+        ("substring common", {"query": "mouse"}),
+        ("substring rare", {"query": "e 4242"}),
+        ("substring thai", {"query": "ปลา"}),
+        ("prefix 1 char", {"query": "ห", "prefix": True}),
+        ("no match", {"query": "zzzz"}),
+        ("price narrow", {"low": 100.0, "high": 100.5}),
+        ("price wide", {"low": 10.0, "high": 1900.0}),
+        ("thai + price", {"query": "หมา", "low": 500.0, "high": 510.0}),
+        ("rare + wide price", {"query": "e 4242", "low": 10.0}),
+        ("punctuation only", {"query": "!!!"}),
+        ("spaces + price", {"query": " - ", "low": 10.0}),
+    ]
+    for name, kwargs in queries:
+        result, index_elapsed = timed(lambda: index.search(**kwargs), repeat=50)
+        expected, scan_elapsed = timed(lambda: scan(store, names, **kwargs))
+        print(f"{name:<18} hits={len(result):<3} index={index_elapsed * 1e6:9.1f}us  scan={scan_elapsed * 1e3:8.1f}ms")
+        if [p.id for p in result] != [p.id for p in expected]:
+            failures.append(f"{name}: index and scan disagree")
+        if "query" in kwargs and not normalize(kwargs["query"]) and result:
+            failures.append(f"{name}: a query with no letters or digits matched {len(result)} products")
+
+    rng = random.Random(3)
+    for product_id in rng.sample(range(1, store.last_id + 1), 2000):
+        if rng.random() < 0.5:
+            store.update(product_id, name=make_products(1, seed=product_id)[0]["name"])
+        else:
+            store.update(product_id, price=round(rng.uniform(1, 2000), 2))
+        names[product_id] = normalize(store[product_id].name)
+    for _ in range(args.queries):
+        kwargs = random_query(rng, store.last_id)
+        if [p.id for p in index.search(**kwargs)] != [p.id for p in scan(store, names, **kwargs)]:
+            failures.append(f"random query {kwargs}: index and scan disagree")
+    print(f"random queries checked against the scan: {args.queries}, mismatches: {len(failures)}")
+
+    for failure in failures[:20]:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
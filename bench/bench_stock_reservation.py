@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Contention benchmark for ProductService.ReserveStock in service_b.
+
+Reserves one unit at a time, either spread over many products or all on a
+single hot product, with per-product stock locks (--stripes stripes) and
+with a single lock (1 stripe, i.e. what a table-wide lock gives), in two
+layouts:
+  - threads: --threads worker threads on one in-memory Store, as in
+    GRPC_SERVER_MODE=thread; also an unlocked read, check and update (the
+    baseline: what the locks cost, and what they prevent)
+  - processes: --processes worker processes on one SharedStore, as with
+    WORKERS>1 and STORE_ENGINE=shared, where the stripes are byte-range
+    file locks (0 skips this layout)
+Every run starts with less stock than requested and checks that exactly
+that much was sold. Exits non-zero if ReserveStock oversells; the unlocked
+baseline may.
+
+It also releases --reservations ids that were never reserved on each
+store engine and checks that the reservations table stays within
+RESERVATION_MAX_ROWS, that a reservation is still applied once, and that
+rows older than RESERVATION_TTL are deleted (from disk too).
+
+Usage:
+    python bench/bench_stock_reservation.py --threads 16 --processes 4 --reservations 100000
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchlib  # noqa: E402
+
+SERVICE_B_DIR = os.path.join(benchlib.BASE_DIR, 'service_b')
+sys.path.insert(0, SERVICE_B_DIR)
+import main as product_service  # noqa: E402
+from common.records import Product  # noqa: E402
+from common.shared_store import STORE_SHARED_DIR, SharedStore  # noqa: E402
+from common.storage import SQLiteEngine  # noqa: E402
+from common.store import Store  # noqa: E402
+from proto import product_pb2  # noqa: E402
+
+
+def seed(product_ids, stock):
+    """Rows of the products a run reserves from"""
+    return {product_id: {"id": product_id, "name": f"p{product_id}", "price": 1.0, "stock": stock}
+            for product_id in product_ids}
+
+
+def use_store(store, stripes):
+    """Point service_b at `store`, with `stripes` stock lock stripes"""
+    product_service.products_db = store
+    product_service.stock_locks = store.key_locks(stripes)
+
+
+def unlocked_reserve(request):
+    """ReserveStock without the locks: read, check, then write (the baseline)"""
+    item = request.items[0]
+    product = product_service.products_db[item.product_id]
+    if product.stock < item.quantity:
+        return product_pb2.StockResponse(code=409)
+    product_service.products_db.update(item.product_id, stock=product.stock - item.quantity)
+    return product_pb2.StockResponse(code=200)
+
+
+def reserve_many(reserve, product_ids, start, count):
+    """Make `count` one-unit reservations round-robin from `start`; return (reserved, rejected)"""
+    reserved = rejected = 0
+    for i in range(start, start + count):
+        product_id = product_ids[i % len(product_ids)]
+        request = product_pb2.StockRequest(items=[product_pb2.StockItem(product_id=product_id, quantity=1)])
+        if reserve(request).code == 200:
+            reserved += 1
+        else:
+            rejected += 1
+    return reserved, rejected
+
+
+def run_threads(threads, reservations, product_ids, stock, stripes):
+    """Reserve from `threads` threads (stripes=0: unlocked); return (reserved, rejected, elapsed, remaining)"""
+    use_store(Store(seed(product_ids, stock), record_type=Product), max(1, stripes))
+    servicer = product_service.ProductServiceImpl()
+    reserve = (lambda request: servicer.ReserveStock(request, None)) if stripes else unlocked_reserve
+    per_thread = reservations // threads
+    counts = []
+    barrier = threading.Barrier(threads)
+
+    def worker(worker_id):
+        barrier.wait()
+        counts.append(reserve_many(reserve, product_ids, worker_id * per_thread, per_thread))
+
+    workers = [threading.Thread(target=worker, args=(w,)) for w in range(threads)]
+    started = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - started
+    remaining = sum(product_service.products_db[p]["stock"] for p in product_ids)
+    return sum(c[0] for c in counts), sum(c[1] for c in counts), elapsed, remaining
+
+
+def process_worker(directory, stripes, product_ids, start, count, barrier, results):
+    """One worker process: open the shared table and reserve from it"""
+    logging.disable(logging.INFO)
+    use_store(SharedStore("products", directory=directory, record_type=Product), stripes)
+    servicer = product_service.ProductServiceImpl()
+    barrier.wait()
+    results.put(reserve_many(lambda request: servicer.ReserveStock(request, None), product_ids, start, count))
+
+
+def run_processes(processes, reservations, product_ids, stock, stripes):
+    """Reserve from `processes` processes on one SharedStore; return (reserved, rejected, elapsed, remaining)"""
+    directory = tempfile.mkdtemp(prefix="bench-stock-", dir=STORE_SHARED_DIR if os.path.isdir(STORE_SHARED_DIR) else None)
+    try:
+        store = SharedStore("products", seed(product_ids, stock), directory=directory, record_type=Product)
+        context = multiprocessing.get_context("fork")
+        barrier = context.Barrier(processes + 1)
+        results = context.Queue()
+        per_process = reservations // processes
+        workers = [context.Process(target=process_worker, args=(
+            directory, stripes, product_ids, p * per_process, per_process, barrier, results))
+            for p in range(processes)]
+        for w in workers:
+            w.start()
+        barrier.wait()
+        started = time.perf_counter()
+        counts = [results.get() for _ in workers]
+        elapsed = time.perf_counter() - started
+        for w in workers:
+            w.join()
+        remaining = sum(store[p]["stock"] for p in product_ids)
+        store.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return sum(c[0] for c in counts), sum(c[1] for c in counts), elapsed, remaining
+
+
+def check_reservations(open_reservations, persistent, releases, max_rows=1000):
+    """Drive release_once/reserve_once against a fresh reservations table; return failures"""
+    failures = []
+    use_store(Store(seed([1], releases), record_type=Product), 64)
+    store = open_reservations()
+    product_service.reservations_db = store
+    product_service.reservation_locks = store.key_locks(64)
+    product_service.RESERVATION_MAX_ROWS = max_rows
+    product_service.RESERVATION_TTL = 600
+    product_service.next_reservation_sweep = 0.0
+    for i in range(releases):
+        product_service.release_once(f"unknown-{i}")
+    if len(store) > max_rows:
+        failures.append(f"{len(store)} rows after {releases} unknown releases (max {max_rows})")
+    items = [product_pb2.StockItem(product_id=1, quantity=1)]
+    codes = [product_service.reserve_once("kept", items).code for _ in range(2)]
+    if codes != [200, 200] or product_service.products_db[1]["stock"] != releases - 1:
+        failures.append(f"repeated reservation: codes {codes}, stock {product_service.products_db[1]['stock']}")
+    product_service.RESERVATION_TTL = 0.05
+    time.sleep(0.1)
+    product_service.next_reservation_sweep = 0.0
+    product_service.release_once("last")
+    if [row["reservation_id"] for row in store.values()] != ["last"]:
+        failures.append(f"{len(store)} rows left after RESERVATION_TTL, expected only the newest")
+    store.close()
+    if persistent:
+        reopened = open_reservations()
+        if len(reopened) != 1:
+            failures.append(f"{len(reopened)} rows after reopening, expected 1")
+        reopened.close()
+    return failures
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--reservations', type=int, default=100000)
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--stripes', type=int, default=64)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    ok = True
+    scenarios = [
+        ('many', list(range(1, args.products + 1)), max(1, args.reservations // args.products // 2)),
+        ('hot', [1], args.reservations // 2),
+    ]
+    layouts = [('threads', args.threads, run_threads, (args.stripes, 1, 0))]
+    if args.processes:
+        layouts.append(('processes', args.processes, run_processes, (args.stripes, 1)))
+    for layout, workers, run, lock_modes in layouts:
+        print(f"{layout} ({workers}):")
+        for name, product_ids, stock in scenarios:
+            for stripes in lock_modes:
+                reserved, rejected, elapsed, remaining = run(workers, args.reservations, product_ids, stock, stripes)
+                initial = stock * len(product_ids)
+                oversold = reserved + remaining != initial or remaining < 0
+                ok = ok and not (stripes and oversold)
+                label = f"{stripes} stripes" if stripes > 1 else "one lock" if stripes else "unlocked"
+                print(f"  {name:<5} {label:<11} reserved={reserved:<8} rejected={rejected:<8} "
+                      f"rate={(reserved + rejected) / elapsed:9.0f}/s  remaining={remaining:<8} "
+                      f"{'OVERSOLD' if oversold else 'OK'}")
+
+    logging.disable(logging.WARNING)
+    directory = tempfile.mkdtemp(prefix="bench-reservations-")
+    engines = [
+        ('memory', False, lambda: Store(indexes=("reservation_id",))),
+        ('sqlite', True, lambda: Store(engine=SQLiteEngine(os.path.join(directory, "reservations.db"), "reservations"),
+                                 indexes=("reservation_id",))),
+        ('shared', True, lambda: SharedStore("reservations", indexes=("reservation_id",), directory=directory)),
+    ]
+    try:
+        for engine, persistent, open_reservations in engines:
+            failures = check_reservations(open_reservations, persistent, args.reservations)
+            print(f"reservations ({engine}): {'; '.join(failures) or 'OK'}")
+            ok = ok and not failures
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Insert, read and warm-start throughput of the Store persistence engines.
+
+For each engine the script inserts N order-shaped records, flushes, reads
+them back by id, and (for sqlite) reopens the table to time a warm start.
+
+Usage:
+    python bench/bench_store_engines.py --records 200000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.storage import MemoryEngine, SQLiteEngine  # noqa: E402
+from common.store import Store  # noqa: E402
+
+
+def bench_engine(name, make_engine, records):
+    """Print insert/read/warm-start rates for one engine"""
+    store = Store(engine=make_engine())
+    started = time.perf_counter()
+    for i in range(records):
+        store.insert({"user_id": i % 1000 + 1, "product_id": i % 500 + 1, "quantity": 1, "total_price": 9.99})
+    store.flush()
+    insert_elapsed = time.perf_counter() - started
+
+    ids = [random.randint(1, records) for _ in range(records)]
+    started = time.perf_counter()
+    for record_id in ids:
+        store.get(record_id)
+    read_elapsed = time.perf_counter() - started
+    store.close()
+
+    started = time.perf_counter()
+    reopened = Store(engine=make_engine())
+    warm_elapsed = time.perf_counter() - started
+    reopened.close()
+    warm = f"{len(reopened)} rows in {warm_elapsed:6.2f}s" if len(reopened) else "n/a"
+
+    print(f"{name:<8} insert={records / insert_elapsed:10.0f}/s  "
+          f"read={records / read_elapsed:10.0f}/s  warm start: {warm}")
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=200000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'orders.db')
+        bench_engine('memory', MemoryEngine, args.records)
+        bench_engine('sqlite', lambda: SQLiteEngine(path, 'orders'), args.records)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Client-side load balancing of service_c over several service_a replicas.
+
+Starts REPLICAS copies of service_a, one service_b and a service_c whose
+USER_SERVICE_ADDR lists every service_a replica, with the upstream caches
+disabled so each GET /orders-detail makes one BatchGetUsers call. For each
+load balancing policy it:
+  1. drives --requests calls and checks every replica served at least
+     --min-share of the BatchGetUsers calls (read from their /metrics)
+  2. kills one replica, drives --requests more calls and checks that none
+     came back degraded (reads sent to the dead replica are retried on
+     another one) and that /upstreams shows the dead replica ejected
+Exits non-zero if a check fails.
+
+Usage:
+    python bench/bench_upstream_replicas.py --requests 600 --concurrency 20
+"""
+import argparse
+import asyncio
+import os
+import re
+import sys
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchlib  # noqa: E402
+
+REPLICAS = 3
+USER_PORTS = [(18411 + i, 50411 + i) for i in range(REPLICAS)]
+PRODUCT_PORTS = (18421, 50421)
+ORDER_PORTS = (18431, 50431)
+BATCH_GET_USERS = re.compile(
+    r'grpc_server_handled_total\{method="/user\.UserService/BatchGetUsers",code="OK"\} (\S+)')
+
+
+def handled_calls(rest_port):
+    """BatchGetUsers calls a service_a replica answered OK"""
+    text = httpx.get(f'http://localhost:{rest_port}/metrics').text
+    match = BATCH_GET_USERS.search(text)
+    return int(float(match.group(1))) if match else 0
+
+
+async def drive_orders_detail(total, concurrency):
+    """GET /orders-detail `total` times; returns (report tuple, [indexes of degraded responses])"""
+    degraded = []
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=f'http://localhost:{ORDER_PORTS[0]}', limits=limits, timeout=30) as client:
+        async def get_detail(i):
+            response = await client.get('/orders-detail')
+            response.raise_for_status()
+            if response.json().get('degraded'):
+                degraded.append(i)
+
+        result = await benchlib.drive(get_detail, total, concurrency)
+    return result, degraded
+
+
+def run_policy(policy, args):
+    """Start the services with `policy`, run both phases; returns a list of failed checks"""
+    failures = []
+    common = {'STORE_ENGINE': 'memory', 'LOG_LEVEL': 'WARNING'}
+    replicas = [benchlib.start_service('service_a', env={
+        **common, 'SERVICE_A_PORT': str(rest), 'SERVICE_A_GRPC_PORT': str(grpc_port),
+    }, wait_ports=(rest, grpc_port)) for rest, grpc_port in USER_PORTS]
+    processes = list(replicas)
+    try:
+        processes.append(benchlib.start_service('service_b', env={
+            **common, 'SERVICE_B_PORT': str(PRODUCT_PORTS[0]), 'SERVICE_B_GRPC_PORT': str(PRODUCT_PORTS[1]),
+            'USER_SERVICE_ADDR': f'localhost:{USER_PORTS[0][1]}',
+        }, wait_ports=PRODUCT_PORTS))
+        processes.append(benchlib.start_service('service_c', env={
+            **common, 'SERVICE_C_PORT': str(ORDER_PORTS[0]), 'SERVICE_C_GRPC_PORT': str(ORDER_PORTS[1]),
+            'USER_SERVICE_ADDR': ','.join(f'localhost:{grpc_port}' for _, grpc_port in USER_PORTS),
+            'PRODUCT_SERVICE_ADDR': f'localhost:{PRODUCT_PORTS[1]}',
+            'USER_CACHE_TTL': '0', 'PRODUCT_CACHE_TTL': '0',
+            'GRPC_LB_POLICY': policy, 'EJECTION_TIME': '30',
+        }, wait_ports=ORDER_PORTS))
+
+        result, degraded = asyncio.run(drive_orders_detail(args.requests, args.concurrency))
+        benchlib.report(f"{policy} healthy", *result)
+        counts = [handled_calls(rest) for rest, _ in USER_PORTS]
+        total = sum(counts) or 1
+        print(f"  BatchGetUsers per replica: {counts}")
+        if result[1] or degraded:
+            failures.append(f"{policy}: {result[1]} errors, {len(degraded)} degraded with all replicas up")
+        if min(counts) < args.min_share * total:
+            failures.append(f"{policy}: uneven spread {counts}")
+
+        benchlib.stop_service(replicas[-1])
+        result, degraded = asyncio.run(drive_orders_detail(args.requests, args.concurrency))
+        benchlib.report(f"{policy} one down", *result)
+        print(f"  degraded responses after the kill: {len(degraded)}")
+        upstreams = httpx.get(f'http://localhost:{ORDER_PORTS[0]}/upstreams').json()['user-service']
+        dead = upstreams['replicas'][-1]
+        print(f"  dead replica: ejected_for={dead['ejected_for']}s connectivity={dead['connectivity']}")
+        if result[1]:
+            failures.append(f"{policy}: {result[1]} errors with one replica down")
+        if degraded:
+            failures.append(f"{policy}: {len(degraded)} degraded responses with one replica down")
+        if not dead['ejected_for']:
+            failures.append(f"{policy}: dead replica not ejected: {dead}")
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                benchlib.stop_service(process)
+    return failures
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=600)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--min-share', type=float, default=0.2,
+                        help='smallest fraction of calls each healthy replica must serve')
+    args = parser.parse_args()
+
+    failures = []
+    for policy in ('round_robin', 'least_outstanding'):
+        failures.extend(run_policy(policy, args))
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+Bytes on the wire and encode/decode CPU: JSON vs protobuf REST responses,
+and gRPC responses with and without compression.
+
+REST: starts service_a, service_b and service_c (GRPC_COMPRESSION=gzip
+between them), seeds --rows users, products and orders, and fetches
+  /users, /products, /orders   one page of --page rows
+  /orders-detail               every order with its user and product
+once with Accept: application/json and once with application/x-protobuf.
+Per endpoint it prints the body size of each and the CPU time to encode
+it (the services' own converters, in this process) and to decode it
+(json.loads vs Message.FromString).
+
+gRPC: starts service_a with GRPC_COMPRESSION=none, gzip and deflate and
+calls ListUsers (--page users) and GetUser --calls times each, through
+a TCP proxy (its own process) that counts the bytes. Per mode it prints
+the bytes sent and received per call, HTTP/2 framing included, and the
+server and client CPU per call.
+
+Both formats must carry the same rows, every gRPC mode must return the
+same responses, compression must shrink ListUsers and must leave GetUser
+(below GRPC_COMPRESSION_MIN_BYTES) alone; the script exits non-zero if
+not. Server CPU is read from /proc (Linux).
+
+Usage:
+    python bench/bench_wire_formats.py --rows 5000 --page 1000 --calls 200
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import grpc
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchlib  # noqa: E402
+
+sys.path.insert(0, benchlib.BASE_DIR)
+sys.path.insert(0, os.path.join(benchlib.BASE_DIR, 'service_c', 'proto'))
+import order_pb2  # noqa: E402
+import product_pb2  # noqa: E402
+import user_pb2  # noqa: E402
+import user_pb2_grpc  # noqa: E402
+from common.records import Order, Product, User  # noqa: E402
+from common.responses import dumps  # noqa: E402
+
+PORTS = {'service_a': (18551, 50551), 'service_b': (18552, 50552), 'service_c': (18553, 50553)}
+PROXY_PORT = 50559
+PROTOBUF = {"accept": "application/x-protobuf"}
+JSON = {"accept": "application/json"}
+
+
+def service_env(compression):
+    env = {'GRPC_COMPRESSION': compression, 'LOG_LEVEL': 'WARNING', 'STORE_ENGINE': 'memory',
+           'ADMISSION_CONTROL': '0', 'USER_SERVICE_ADDR': f'localhost:{PORTS["service_a"][1]}',
+           'PRODUCT_SERVICE_ADDR': f'localhost:{PORTS["service_b"][1]}'}
+    for service, (rest_port, grpc_port) in PORTS.items():
+        letter = service[-1].upper()
+        env[f'SERVICE_{letter}_PORT'] = str(rest_port)
+        env[f'SERVICE_{letter}_GRPC_PORT'] = str(grpc_port)
+    return env
+
+
+def url(service, path):
+    return f'http://localhost:{PORTS[service][0]}{path}'
+
+
+def seed(client, rows, services):
+    """Insert `rows` users (and products and orders, if those services run)"""
+    for start in range(0, rows, 5000):
+        count = min(rows, start + 5000) - start
+        client.post(url('service_a', '/users/batch'), json=[
+            {"name": f"User {start + i}", "email": f"user{start + i}@example.com"}
+            for i in range(count)]).raise_for_status()
+        if 'service_b' in services:
+            client.post(url('service_b', '/products/batch'), json=[
+                {"name": f"Product {start + i}", "price": 1.0 + (start + i) % 500 / 4, "stock": 10 ** 6}
+                for i in range(count)]).raise_for_status()
+    if 'service_c' in services:
+        for start in range(0, rows, 5000):
+            orders = [{"user_id": 1 + i % rows, "product_id": 1 + i * 7 % rows, "quantity": 1 + i % 3}
+                      for i in range(start, min(rows, start + 5000))]
+            response = client.post(url('service_c', '/orders/batch'), json=orders)
+            response.raise_for_status()
+            if response.json()["failed"]:
+                raise RuntimeError(f"{response.json()['failed']} orders failed to seed")
+
+
+def order_details_message(content):
+    """The OrderDetailList service_c builds for /orders-detail"""
+    message = order_pb2.OrderDetailList(degraded=content.get("degraded", ()))
+    add = message.orders.add
+    for detail in content["data"]:
+        add(order={field: detail[field] for field in Order.FIELDS}, user=detail.get("user"),
+            product=detail.get("product"))
+    return message
+
+
+# name, service, path, record type, message class, message builder, rows of a decoded message
+ENDPOINTS = [
+    ("users", "service_a", "/users?limit={page}", User, user_pb2.UserList,
+     lambda content: user_pb2.UserList(users=[r.to_proto(user_pb2.User) for r in content["data"]]),
+     lambda message: message.users),
+    ("products", "service_b", "/products?limit={page}", Product, product_pb2.ProductList,
+     lambda content: product_pb2.ProductList(products=[r.to_proto(product_pb2.Product) for r in content["data"]]),
+     lambda message: message.products),
+    ("orders", "service_c", "/orders?limit={page}", Order, order_pb2.OrderList,
+     lambda content: order_pb2.OrderList(orders=[r.to_proto(order_pb2.Order) for r in content["data"]]),
+     lambda message: message.orders),
+    ("orders-detail", "service_c", "/orders-detail", None, order_pb2.OrderDetailList, order_details_message,
+     lambda message: message.orders),
+]
+
+
+def as_dict(message):
+    """Plain dict of a (possibly nested) protobuf message, unset fields included"""
+    result = {}
+    for field in message.DESCRIPTOR.fields:
+        value = getattr(message, field.name)
+        if field.message_type is not None:
+            if message.HasField(field.name):
+                result[field.name] = as_dict(value)
+        else:
+            result[field.name] = value
+    return result
+
+
+def proto_rows(name, rows):
+    """Decoded protobuf rows in the shape of the JSON rows"""
+    if name != "orders-detail":
+        return [as_dict(row) for row in rows]
+    result = []
+    for row in rows:
+        detail = as_dict(row.order)
+        for part in ("user", "product"):
+            if row.HasField(part):
+                detail[part] = as_dict(getattr(row, part))
+        result.append(detail)
+    return result
+
+
+def cpu_ms(function, repeat):
+    """Median CPU time of function() in ms"""
+    times = []
+    for _ in range(repeat):
+        started = time.process_time()
+        function()
+        times.append(time.process_time() - started)
+    return benchlib.percentile(times, 50) * 1000
+
+
+def compare_rest(args, failures):
+    env = service_env('gzip')
+    processes = []
+    try:
+        for service, ports in PORTS.items():
+            processes.append(benchlib.start_service(service, env, ports))
+        with httpx.Client(timeout=120) as client:
+            seed(client, args.rows, PORTS)
+            print(f"{'endpoint':<14} {'rows':>6} {'JSON bytes':>11} {'protobuf':>10} {'ratio':>6}   "
+                  f"encode ms JSON / protobuf   decode ms JSON / protobuf")
+            for name, service, path, record_type, message_class, to_message, rows_of in ENDPOINTS:
+                path = path.format(page=args.page)
+                as_json = client.get(url(service, path), headers=JSON)
+                as_proto = client.get(url(service, path), headers=PROTOBUF)
+                for response in (as_json, as_proto):
+                    response.raise_for_status()
+                if as_proto.headers["content-type"] != "application/x-protobuf":
+                    failures.append(f"{name}: got {as_proto.headers['content-type']} for {PROTOBUF['accept']}")
+                    continue
+                content = as_json.json()
+                message = message_class.FromString(as_proto.content)
+                if proto_rows(name, rows_of(message)) != content["data"]:
+                    failures.append(f"{name}: protobuf and JSON bodies differ")
+                if str(content.get("next_cursor")) != as_proto.headers.get("x-next-cursor", "None"):
+                    failures.append(f"{name}: X-Next-Cursor {as_proto.headers.get('x-next-cursor')} "
+                                    f"!= next_cursor {content.get('next_cursor')}")
+
+                # Encode from what the service holds: records for the list pages, dicts for /orders-detail
+                if record_type is not None:
+                    content = {**content, "data": [record_type.from_dict(row) for row in content["data"]]}
+                encode_json = cpu_ms(lambda: dumps(content), args.repeat)
+                encode_proto = cpu_ms(lambda: to_message(content).SerializeToString(), args.repeat)
+                decode_json = cpu_ms(lambda: json.loads(as_json.content), args.repeat)
+                decode_proto = cpu_ms(lambda: message_class.FromString(as_proto.content), args.repeat)
+                print(f"{name:<14} {len(content['data']):>6} {len(as_json.content):>11} {len(as_proto.content):>10} "
+                      f"{len(as_proto.content) / len(as_json.content):>6.2f}   "
+                      f"{encode_json:>9.2f} / {encode_proto:<8.2f}         {decode_json:>9.2f} / {decode_proto:<8.2f}")
+    finally:
+        for process in processes:
+            benchlib.stop_service(process)
+
+
+def run_proxy(port, target_port, sent, received):
+    """Forward connections on `port` to `target_port`, adding the bytes each way to
+    `sent` / `received` (multiprocessing.Value); runs until killed"""
+    async def pipe(reader, writer, counter):
+        try:
+            while data := await reader.read(65536):
+                with counter.get_lock():
+                    counter.value += len(data)
+                writer.write(data)
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def forward(reader, writer):
+        upstream_reader, upstream_writer = await asyncio.open_connection('127.0.0.1', target_port)
+        await asyncio.gather(pipe(reader, upstream_writer, sent), pipe(upstream_reader, writer, received),
+                             return_exceptions=True)
+
+    async def serve():
+        server = await asyncio.start_server(forward, '127.0.0.1', port)
+        await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+def cpu_seconds(pid):
+    """CPU time a process has used so far"""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def compare_grpc(args, failures):
+    print(f"\n{'compression':<12} {'call':<10} {'bytes sent/call':>16} {'received/call':>14} "
+          f"{'server CPU ms/call':>19} {'client CPU ms/call':>19}")
+    sent, received = multiprocessing.Value('q', 0), multiprocessing.Value('q', 0)
+    proxy = multiprocessing.Process(target=run_proxy, args=(PROXY_PORT, PORTS['service_a'][1], sent, received),
+                                    daemon=True)
+    proxy.start()
+    results = {}
+    for compression in ('none', 'gzip', 'deflate'):
+        env = service_env(compression)
+        process = benchlib.start_service('service_a', env, PORTS['service_a'])
+        benchlib.wait_for_port(PROXY_PORT)
+        channel = grpc.insecure_channel(f'localhost:{PROXY_PORT}', options=[("grpc.max_receive_message_length", -1)])
+        try:
+            with httpx.Client(timeout=120) as client:
+                seed(client, args.rows, ['service_a'])
+            stub = user_pb2_grpc.UserServiceStub(channel)
+            calls = [("ListUsers", stub.ListUsers, user_pb2.ListUsersRequest(limit=args.page)),
+                     ("GetUser", stub.GetUser, user_pb2.GetUserRequest(id=1))]
+            for name, method, request in calls:
+                response = method(request)  # connect and warm up
+                sent_before, received_before = sent.value, received.value
+                server_cpu, started = cpu_seconds(process.pid), time.process_time()
+                for _ in range(args.calls):
+                    method(request)
+                client_cpu = time.process_time() - started
+                server_cpu = cpu_seconds(process.pid) - server_cpu
+                received_per_call = (received.value - received_before) / args.calls
+                results[compression, name] = (received_per_call, response)
+                print(f"{compression:<12} {name:<10} {(sent.value - sent_before) / args.calls:>16.0f} "
+                      f"{received_per_call:>14.0f} {server_cpu * 1000 / args.calls:>19.3f} "
+                      f"{client_cpu * 1000 / args.calls:>19.3f}")
+        finally:
+            channel.close()
+            benchlib.stop_service(process)
+    proxy.kill()
+
+    for compression in ('gzip', 'deflate'):
+        for name in ('ListUsers', 'GetUser'):
+            if results[compression, name][1] != results['none', name][1]:
+                failures.append(f"{name} response differs with {compression}")
+        listed, plain = results[compression, 'ListUsers'][0], results['none', 'ListUsers'][0]
+        if listed >= plain * 0.8:
+            failures.append(f"ListUsers with {compression}: {listed:.0f} bytes/call vs {plain:.0f} uncompressed")
+        small, plain = results[compression, 'GetUser'][0], results['none', 'GetUser'][0]
+        if abs(small - plain) > plain * 0.1:
+            failures.append(f"GetUser with {compression}: {small:.0f} bytes/call vs {plain:.0f} uncompressed "
+                            f"(should not be compressed)")
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=5000, help='users, products and orders to seed')
+    parser.add_argument('--page', type=int, default=1000, help='rows per list page / ListUsers call')
+    parser.add_argument('--calls', type=int, default=200, help='gRPC calls per method and compression')
+    parser.add_argument('--repeat', type=int, default=20, help='encode/decode repetitions (median reported)')
+    args = parser.parse_args()
+
+    failures = []
+    compare_rest(args, failures)
+    compare_grpc(args, failures)
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
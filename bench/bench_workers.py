@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Throughput of service_a as the number of worker processes grows.
+
+Starts service_a with STORE_ENGINE=shared and WORKERS=N for each N in
+--workers (plus the single-process memory store as a baseline) and drives
+a REST mix of 90% GET /users/{id} and 10% POST /users, each POST followed
+by a GET of the new user, plus gRPC GetUser over several channels. Every
+worker must see every write: a read-after-write that misses, a duplicate
+id or a final user count that does not match the writes fails the run
+(exit status 1).
+
+Scaling is bounded by the cores available (os.cpu_count() is printed);
+the load generator runs on the same machine and takes its share.
+
+Usage:
+    python bench/bench_workers.py --workers 1,2,4 --requests 4000
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+
+import grpc
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchlib  # noqa: E402
+
+sys.path.insert(0, os.path.join(benchlib.BASE_DIR, 'service_a', 'proto'))
+import user_pb2  # noqa: E402
+import user_pb2_grpc  # noqa: E402
+
+REST_PORT = 18511
+GRPC_PORT = 50511
+
+
+async def measure(args):
+    """Run the REST and gRPC scenarios; returns ({name: drive() result}, [consistency errors])"""
+    problems = []
+    created = []
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=f'http://localhost:{REST_PORT}', limits=limits, timeout=30) as client:
+        async def rest_mix(i):
+            if i % 10:
+                response = await client.get(f'/users/{i % 3 + 1}')
+                response.raise_for_status()
+                return
+            response = await client.post('/users', json={"name": f"user-{i}", "email": f"user-{i}@example.com"})
+            response.raise_for_status()
+            user_id = response.json()["data"]["id"]
+            created.append(user_id)
+            if (await client.get(f'/users/{user_id}')).status_code != 200:
+                problems.append(f"user {user_id} not visible right after it was created")
+
+        results = {'rest': await benchlib.drive(rest_mix, args.requests, args.concurrency)}
+
+        listed = []
+        cursor = 0
+        while cursor is not None:
+            page = (await client.get('/users', params={'cursor': cursor, 'limit': 1000})).json()
+            listed.extend(user["id"] for user in page["data"])
+            cursor = page["next_cursor"]
+        if len(set(created)) != len(created):
+            problems.append("duplicate ids handed out")
+        missing = set(created) - set(listed)
+        if missing:
+            problems.append(f"{len(missing)} created users missing from GET /users")
+
+    channels = [grpc.aio.insecure_channel(f'localhost:{GRPC_PORT}',
+                                          options=[("grpc.use_local_subchannel_pool", 1)])
+                for _ in range(args.channels)]
+    stubs = [user_pb2_grpc.UserServiceStub(channel) for channel in channels]
+
+    async def grpc_get(i):
+        response = await stubs[i % len(stubs)].GetUser(user_pb2.GetUserRequest(id=created[i % len(created)] if created else 1))
+        if response.code != 200:
+            problems.append(f"gRPC GetUser({response.user.id}) returned {response.code}")
+
+    results['grpc'] = await benchlib.drive(grpc_get, args.requests, args.concurrency)
+    for channel in channels:
+        await channel.close()
+    return results, problems
+
+
+def run(label, env, args):
+    """Start service_a with `env`, measure it and print the results; returns the consistency problems"""
+    process = benchlib.start_service('service_a', env={
+        'SERVICE_A_PORT': str(REST_PORT), 'SERVICE_A_GRPC_PORT': str(GRPC_PORT),
+        'LOG_LEVEL': 'WARNING', **env,
+    }, wait_ports=(REST_PORT, GRPC_PORT))
+    try:
+        results, problems = asyncio.run(measure(args))
+    finally:
+        benchlib.stop_service(process)
+    for name, result in results.items():
+        benchlib.report(f"{label} {name}", *result)
+    for problem in problems[:5]:
+        print(f"  FAIL {problem}")
+    return problems
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', default='1,2,4', help='comma-separated worker counts')
+    parser.add_argument('--requests', type=int, default=4000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--channels', type=int, default=8, help='gRPC channels (connections) to spread')
+    args = parser.parse_args()
+
+    print(f"cores available: {os.cpu_count()}")
+    failed = bool(run("memory x1", {'STORE_ENGINE': 'memory', 'WORKERS': '1'}, args))
+    for workers in (int(n) for n in args.workers.split(',')):
+        directory = tempfile.mkdtemp(prefix='bench-workers-', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        try:
+            failed |= bool(run(f"shared x{workers}", {
+                'STORE_ENGINE': 'shared', 'STORE_SHARED_DIR': directory, 'WORKERS': str(workers),
+            }, args))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
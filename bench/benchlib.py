@@ -0,0 +1,106 @@
+"""
+Small helpers shared by the benchmark scripts in this directory
+"""
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an unsorted list"""
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(latencies, errors, elapsed):
+    """Throughput and latency percentiles (ms) of one run, as a dict"""
+    if not latencies:
+        return {"requests": 0, "errors": errors, "rps": 0.0, "p50_ms": None, "p95_ms": None, "p99_ms": None}
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+def report(name, latencies, errors, elapsed):
+    """Print a one-line throughput and latency summary"""
+    print(f"{name:<20} n={len(latencies):<7} errors={errors:<5} "
+          f"rps={len(latencies) / elapsed:9.1f}  "
+          f"p50={percentile(latencies, 50) * 1000:7.2f}ms  "
+          f"p99={percentile(latencies, 99) * 1000:7.2f}ms")
+
+
+async def drive(call, total, concurrency):
+    """Await `call(i)` for i in range(total) with bounded concurrency.
+
+    Returns (latencies, errors, elapsed); any exception counts as an error.
+    """
+    latencies = []
+    errors = 0
+    next_index = 0
+
+    async def worker():
+        nonlocal errors, next_index
+        while next_index < total:
+            i = next_index
+            next_index += 1
+            start = time.perf_counter()
+            try:
+                await call(i)
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - started
+
+
+def wait_for_port(port, timeout=15.0):
+    """Block until something accepts TCP connections on localhost:port"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(('127.0.0.1', port)) == 0:
+                return
+        time.sleep(0.05)
+    raise TimeoutError(f"nothing listening on port {port}")
+
+
+def start_service(service, env=None, wait_ports=()):
+    """Run `python main.py` for a service as a subprocess and wait for its ports"""
+    full_env = dict(os.environ)
+    full_env.update(env or {})
+    process = subprocess.Popen(
+        [sys.executable, 'main.py'],
+        cwd=os.path.join(BASE_DIR, service),
+        env=full_env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        for port in wait_ports:
+            wait_for_port(port)
+    except Exception:
+        process.kill()
+        raise
+    return process
+
+
+def stop_service(process):
+    """Terminate a subprocess started by start_service()"""
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Replay a JSONL request mix against service_a/b/c over REST and gRPC.
+
+By default the three services are started as local subprocesses on spare
+ports (STORE_ENGINE=memory, seeded with --users users and --products
+products); with --external the mix runs against services that are already
+up on --host (e.g. docker-compose on the default ports).
+
+Each line of the mix file is one JSON object:
+  {"name": "rest_get_user", "weight": 20, "service": "service_a",
+   "protocol": "rest", "method": "GET", "path": "/users/{user_id}"}
+  {"name": "grpc_get_user", "weight": 20, "service": "service_a",
+   "protocol": "grpc", "method": "GetUser", "request": {"id": "{user_id}"}}
+REST lines may carry a JSON "body"; gRPC lines name an RPC of the
+service's proto and give its request as a dict. "{user_id}",
+"{product_id}" and "{i}" (request number) are filled in per request; a
+string that is exactly a placeholder becomes an int. Requests are drawn by
+weight from a seeded RNG (or in file order with --order sequential), so a
+run with the same mix, seed and --requests replays the same requests.
+
+Per-scenario and overall RPS and p50/p95/p99 are printed and saved to
+bench/results/<timestamp>-<label>.json; --compare reads an earlier result
+and prints the change, --max-regression makes the run fail on a drop.
+
+Usage:
+    python bench/loadgen.py --mix bench/mixes/default.jsonl --requests 20000 --concurrency 50
+    python bench/loadgen.py --label after --compare bench/results/<earlier>.json --max-regression 0.1
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+import grpc
+import httpx
+from google.protobuf import json_format
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchlib  # noqa: E402
+
+# service_c carries the protos of all three services
+sys.path.insert(0, os.path.join(benchlib.BASE_DIR, 'service_c', 'proto'))
+import order_pb2, order_pb2_grpc, product_pb2, product_pb2_grpc, user_pb2, user_pb2_grpc  # noqa: E402,E401
+
+RESULTS_DIR = os.path.join(benchlib.BASE_DIR, 'bench', 'results')
+
+# Ports used when the harness starts the services itself
+LOCAL_PORTS = {
+    'service_a': (18201, 50401),
+    'service_b': (18202, 50402),
+    'service_c': (18203, 50403),
+}
+# Ports of an already running deployment (docker-compose defaults)
+EXTERNAL_PORTS = {
+    'service_a': (8001, 50051),
+    'service_b': (8002, 50052),
+    'service_c': (8003, 50053),
+}
+GRPC_SERVICES = {
+    'service_a': (user_pb2, user_pb2_grpc.UserServiceStub, 'UserService'),
+    'service_b': (product_pb2, product_pb2_grpc.ProductServiceStub, 'ProductService'),
+    'service_c': (order_pb2, order_pb2_grpc.OrderServiceStub, 'OrderService'),
+}
+
+PLACEHOLDER = re.compile(r"\{(\w+)\}")
+
+
+def load_mix(path):
+    """Read and check the scenarios of a JSONL mix file"""
+    mix = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            scenario = json.loads(line)
+            missing = {"name", "service", "protocol", "method"} - scenario.keys()
+            if missing or scenario["service"] not in GRPC_SERVICES or scenario["protocol"] not in ("rest", "grpc"):
+                raise SystemExit(f"{path}:{number}: bad scenario {scenario} (missing {sorted(missing)})")
+            scenario.setdefault("weight", 1)
+            mix.append(scenario)
+    if not mix:
+        raise SystemExit(f"{path}: no scenarios")
+    return mix
+
+
+def fill(value, ids):
+    """Substitute {placeholders} in strings, dicts and lists"""
+    if isinstance(value, str):
+        whole = PLACEHOLDER.fullmatch(value)
+        if whole:
+            return ids[whole.group(1)]
+        return PLACEHOLDER.sub(lambda m: str(ids[m.group(1)]), value)
+    if isinstance(value, dict):
+        return {key: fill(item, ids) for key, item in value.items()}
+    if isinstance(value, list):
+        return [fill(item, ids) for item in value]
+    return value
+
+
+def build_schedule(mix, args):
+    """The exact list of (scenario, prepared request) to send, derived from the seed"""
+    rng = random.Random(args.seed)
+    weights = [scenario["weight"] for scenario in mix]
+    schedule = []
+    for i in range(args.warmup + args.requests):
+        if args.order == 'sequential':
+            scenario = mix[i % len(mix)]
+        else:
+            scenario = rng.choices(mix, weights)[0]
+        ids = {"user_id": rng.randint(1, args.users), "product_id": rng.randint(1, args.products), "i": i}
+        if scenario["protocol"] == "rest":
+            prepared = (fill(scenario["path"], ids), fill(scenario.get("body"), ids))
+        else:
+            pb2, _, service_name = GRPC_SERVICES[scenario["service"]]
+            method = pb2.DESCRIPTOR.services_by_name[service_name].methods_by_name[scenario["method"]]
+            request = json_format.ParseDict(fill(scenario.get("request", {}), ids), getattr(pb2, method.input_type.name)())
+            prepared = (request, method.server_streaming)
+        schedule.append((scenario, prepared))
+    return schedule
+
+
+class Targets:
+    """HTTP client and gRPC stubs for the three services"""
+
+    def __init__(self, host, ports, concurrency):
+        self.base_urls = {service: f'http://{host}:{rest}' for service, (rest, _) in ports.items()}
+        self.http = httpx.AsyncClient(limits=httpx.Limits(max_connections=concurrency), timeout=30)
+        self.channels = {service: grpc.aio.insecure_channel(f'{host}:{port}') for service, (_, port) in ports.items()}
+        self.stubs = {service: GRPC_SERVICES[service][1](channel) for service, channel in self.channels.items()}
+
+    async def send(self, scenario, prepared):
+        """Send one prepared request; raise on an error status"""
+        service = scenario["service"]
+        if scenario["protocol"] == "rest":
+            path, body = prepared
+            response = await self.http.request(scenario["method"], self.base_urls[service] + path, json=body)
+            if response.status_code >= 400:
+                raise RuntimeError(f"HTTP {response.status_code}")
+            return
+        request, streaming = prepared
+        rpc = getattr(self.stubs[service], scenario["method"])
+        if streaming:
+            async for _ in rpc(request):
+                pass
+            return
+        response = await rpc(request)
+        if getattr(response, "code", 200) >= 400:
+            raise RuntimeError(f"code {response.code}")
+
+    async def seed(self, users, products):
+        """Create users and products (with ample stock) through the batch endpoints"""
+        new_users = [{"name": f"load-user-{i}", "email": f"load-{i}@example.com"} for i in range(users)]
+        new_products = [{"name": f"load-product-{i}", "price": 9.99, "stock": 10 ** 9} for i in range(products)]
+        for service, path, items in (('service_a', '/users/batch', new_users),
+                                     ('service_b', '/products/batch', new_products)):
+            for start in range(0, len(items), 5000):
+                response = await self.http.post(self.base_urls[service] + path, json=items[start:start + 5000])
+                response.raise_for_status()
+
+    async def close(self):
+        await self.http.aclose()
+        for channel in self.channels.values():
+            await channel.close()
+
+
+async def replay(targets, schedule, warmup, concurrency):
+    """Send the schedule; returns ({name: summary}, overall summary, elapsed)"""
+    if warmup:
+        await benchlib.drive(lambda i: targets.send(*schedule[i]), warmup, concurrency)
+    measured = schedule[warmup:]
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+
+    async def one(i):
+        scenario, prepared = measured[i]
+        started = time.perf_counter()
+        try:
+            await targets.send(scenario, prepared)
+        except Exception:
+            errors[scenario["name"]] += 1
+            raise
+        finally:
+            latencies[scenario["name"]].append(time.perf_counter() - started)
+
+    all_latencies, all_errors, elapsed = await benchlib.drive(one, len(measured), concurrency)
+    scenarios = {name: benchlib.summarize(values, errors[name], elapsed) for name, values in sorted(latencies.items())}
+    return scenarios, benchlib.summarize(all_latencies, all_errors, elapsed), elapsed
+
+
+def start_services():
+    """Start service_a/b/c on LOCAL_PORTS; returns the processes"""
+    env = {
+        'STORE_ENGINE': 'memory',
+        'LOG_LEVEL': os.getenv('LOG_LEVEL', 'WARNING'),
+        'USER_SERVICE_ADDR': f"localhost:{LOCAL_PORTS['service_a'][1]}",
+        'PRODUCT_SERVICE_ADDR': f"localhost:{LOCAL_PORTS['service_b'][1]}",
+    }
+    for service, (rest, port) in LOCAL_PORTS.items():
+        letter = service[-1].upper()
+        env[f'SERVICE_{letter}_PORT'] = str(rest)
+        env[f'SERVICE_{letter}_GRPC_PORT'] = str(port)
+    processes = []
+    try:
+        for service, ports in LOCAL_PORTS.items():
+            processes.append(benchlib.start_service(service, env, ports))
+    except Exception:
+        for process in processes:
+            benchlib.stop_service(process)
+        raise
+    return processes
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=benchlib.BASE_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(result, baseline=None):
+    """Print the per-scenario table, with the change against `baseline` if given"""
+    rows = list(result["scenarios"].items()) + [("TOTAL", result["total"])]
+    header = f"{'scenario':<26} {'n':>7} {'err':>5} {'rps':>9} {'p50ms':>8} {'p95ms':>8} {'p99ms':>8}"
+    print(header + ("   d_rps   d_p99" if baseline else ""))
+    for name, row in rows:
+        line = (f"{name:<26} {row['requests']:>7} {row['errors']:>5} {row['rps']:>9.1f} "
+                f"{row['p50_ms'] or 0:>8.2f} {row['p95_ms'] or 0:>8.2f} {row['p99_ms'] or 0:>8.2f}")
+        old = (baseline["scenarios"].get(name) if name != "TOTAL" else baseline["total"]) if baseline else None
+        if old and old["rps"] and old["p99_ms"]:
+            line += f" {row['rps'] / old['rps'] - 1:>+7.1%} {(row['p99_ms'] or 0) / old['p99_ms'] - 1:>+7.1%}"
+        print(line)
+
+
+def regressed(result, baseline, tolerance):
+    """True if total RPS fell or total p99 rose by more than `tolerance` (a fraction)"""
+    new, old = result["total"], baseline["total"]
+    return new["rps"] < old["rps"] * (1 - tolerance) or (new["p99_ms"] or 0) > old["p99_ms"] * (1 + tolerance)
+
+
+async def run(args, mix):
+    ports = EXTERNAL_PORTS if args.external else LOCAL_PORTS
+    targets = Targets(args.host if args.external else 'localhost', ports, args.concurrency)
+    try:
+        if args.seed_data:
+            await targets.seed(args.users, args.products)
+        return await replay(targets, build_schedule(mix, args), args.warmup, args.concurrency)
+    finally:
+        await targets.close()
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mix', default=os.path.join(benchlib.BASE_DIR, 'bench', 'mixes', 'default.jsonl'))
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--warmup', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1, help='RNG seed for the request schedule')
+    parser.add_argument('--order', choices=('weighted', 'sequential'), default='weighted')
+    parser.add_argument('--users', type=int, default=1000, help='user ids are drawn from 1..N')
+    parser.add_argument('--products', type=int, default=1000, help='product ids are drawn from 1..N')
+    parser.add_argument('--external', action='store_true', help='use services already running on --host')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--label', default='run')
+    parser.add_argument('--compare', help='earlier result file to compare against')
+    parser.add_argument('--max-regression', type=float, help='fail if RPS/p99 is this fraction worse than --compare')
+    args = parser.parse_args()
+    # Local services start with 3 users/products; seed the rest of the id range
+    args.seed_data = not args.external
+    mix = load_mix(args.mix)
+
+    processes = [] if args.external else start_services()
+    try:
+        scenarios, total, elapsed = asyncio.run(run(args, mix))
+    finally:
+        for process in processes:
+            benchlib.stop_service(process)
+
+    result = {
+        "label": args.label,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git": git_revision(),
+        "mix": os.path.relpath(args.mix, benchlib.BASE_DIR),
+        "config": {key: getattr(args, key) for key in
+                   ('requests', 'warmup', 'concurrency', 'seed', 'order', 'users', 'products', 'external')},
+        "elapsed_s": round(elapsed, 3),
+        "total": total,
+        "scenarios": scenarios,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_table(result, baseline)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{args.label}.json")
+    with open(path, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f"saved {os.path.relpath(path, benchlib.BASE_DIR)}")
+
+    if baseline and args.max_regression is not None and regressed(result, baseline, args.max_regression):
+        print(f"REGRESSION: worse than {args.compare} by more than {args.max_regression:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Concurrency stress test for common.store.Store id allocation.
+
+Many threads (standing in for gRPC workers) and an asyncio loop (standing in
+for the REST handlers) insert into one Store at the same time. The script
+checks that every insert got a distinct id, that no record was lost and that
+ids are contiguous, then prints insert throughput. It also fails batch
+inserts partway (a malformed row, an engine error) and checks that the
+table's version moved whenever its rows did, so cached views cannot go
+stale. Exits non-zero on failure.
+
+With --legacy it also runs the old `max(db.keys()) + 1` scheme on a plain
+dict for comparison; that one is expected to lose records.
+
+Usage:
+    python bench/stress_store_ids.py --threads 16 --inserts 20000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.records import Product  # noqa: E402
+from common.storage import MemoryEngine  # noqa: E402
+from common.store import Store  # noqa: E402
+
+SEED_ROWS = {
+    1: {"id": 1, "name": "a"},
+    2: {"id": 2, "name": "b"},
+}
+
+
+def store_insert(db, worker, i):
+    return db.insert({"worker": worker, "seq": i})["id"]
+
+
+def legacy_insert(db, worker, i):
+    new_id = max(db.keys()) + 1 if db else 1
+    db[new_id] = {"id": new_id, "worker": worker, "seq": i}
+    return new_id
+
+
+def hammer(db, insert, threads, inserts):
+    """Insert from `threads` threads plus one asyncio loop; return allocated ids and elapsed time"""
+    allocated = []
+    allocated_lock = threading.Lock()
+    barrier = threading.Barrier(threads + 1)
+
+    def thread_worker(worker):
+        barrier.wait()
+        ids = [insert(db, worker, i) for i in range(inserts)]
+        with allocated_lock:
+            allocated.extend(ids)
+
+    async def loop_worker():
+        ids = []
+        for i in range(inserts):
+            ids.append(insert(db, 'loop', i))
+            if i % 64 == 0:
+                await asyncio.sleep(0)
+        return ids
+
+    def run_loop():
+        barrier.wait()
+        ids = asyncio.run(loop_worker())
+        with allocated_lock:
+            allocated.extend(ids)
+
+    workers = [threading.Thread(target=thread_worker, args=(w,)) for w in range(threads - 1)]
+    workers.append(threading.Thread(target=run_loop))
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    for worker in workers:
+        worker.join()
+    return allocated, time.perf_counter() - started
+
+
+def check(name, db, allocated, expected, elapsed):
+    """Print a summary and return True when ids are unique, complete and contiguous"""
+    duplicates = len(allocated) - len(set(allocated))
+    lost = expected - (len(db) - len(SEED_ROWS))
+    ids = sorted(db.keys())
+    contiguous = ids == list(range(1, len(ids) + 1))
+    ok = duplicates == 0 and lost == 0 and contiguous
+    print(f"{name:<8} inserts={expected:<8} duplicates={duplicates:<6} lost={lost:<6} "
+          f"contiguous={contiguous!s:<5} rate={expected / elapsed:10.0f}/s  {'OK' if ok else 'FAIL'}")
+    return ok
+
+
+class FailingEngine(MemoryEngine):
+    """Engine whose `fail_at`-th write raises"""
+
+    def __init__(self, fail_at):
+        self.writes = 0
+        self.fail_at = fail_at
+
+    def write(self, record):
+        self.writes += 1
+        if self.writes == self.fail_at:
+            raise OSError("disk full")
+
+
+def check_failed_batches():
+    """insert_many that fails partway: the version moves with the rows; return failures"""
+    failures = []
+    row = {"name": "p", "price": 1.0, "stock": 1}
+    for name, db, batch in [
+        ("malformed row", Store(record_type=Product), [row, row, {"name": "no price"}, row]),
+        ("engine error", Store(engine=FailingEngine(3), record_type=Product), [row] * 5),
+    ]:
+        db.insert(row)
+        before = (len(db), db.version, db.last_id)
+        try:
+            db.insert_many(batch)
+            failures.append(f"{name}: insert_many did not fail")
+        except (TypeError, OSError):
+            pass
+        after = (len(db), db.version, db.last_id)
+        if after[0] != before[0] and after[1] == before[1]:
+            failures.append(f"{name}: {after[0] - before[0]} rows added but the version stayed {after[1]}")
+        if after[0] == before[0] and after[2] != before[2]:
+            failures.append(f"{name}: no rows added but ids {before[2] + 1}-{after[2]} were used up")
+        print(f"failed batch ({name}): rows {before[0]} -> {after[0]}, version {before[1]} -> {after[1]}")
+    return failures
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--inserts', type=int, default=20000, help='inserts per thread')
+    parser.add_argument('--legacy', action='store_true', help='also run the old max()+1 scheme')
+    args = parser.parse_args()
+
+    # Switch threads often so that races have a chance to show up
+    sys.setswitchinterval(1e-6)
+    expected = args.threads * args.inserts
+
+    db = Store(SEED_ROWS)
+    allocated, elapsed = hammer(db, store_insert, args.threads, args.inserts)
+    ok = check('Store', db, allocated, expected, elapsed)
+
+    failures = check_failed_batches()
+    for failure in failures:
+        print(f"FAIL {failure}")
+    ok = ok and not failures
+
+    if args.legacy:
+        legacy_db = {k: dict(v) for k, v in SEED_ROWS.items()}
+        allocated, elapsed = hammer(legacy_db, legacy_insert, args.threads, max(1, args.inserts // 20))
+        check('legacy', legacy_db, allocated, args.threads * max(1, args.inserts // 20), elapsed)
+
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,400 @@
+"""
+Admission control: adaptive concurrency limits and load shedding.
+
+Every REST route and every gRPC method has its own AdaptiveLimit, the
+number of its requests allowed to run at once. The limit follows the
+latency those requests see (a gradient limiter):
+  - while the recent latency stays within ADMISSION_TOLERANCE times its
+    long-run average and the route is busy, the limit grows by about
+    sqrt(limit) / 5 per completed request
+  - when latency rises past that, the limit shrinks in proportion, by at
+    most 10% per completed request
+and it stays between ADMISSION_MIN_LIMIT and ADMISSION_MAX_LIMIT.
+
+Requests also queue before any limit sees them, waiting for the event
+loop (REST and the aio gRPC server share it). LoopLag measures how late
+the loop runs a timer, which is about how long a request reaching a
+limit now has already waited. Past ADMISSION_MAX_LOOP_LAG, while tasks
+are piling up on the loop, a share of the requests is shed at once,
+growing with the lag until all are shed at twice ADMISSION_MAX_LOOP_LAG,
+so the loop catches up while still doing as much useful work as it can.
+
+A request over the limit waits in a FIFO queue of at most
+ADMISSION_QUEUE_SIZE for up to ADMISSION_QUEUE_TIMEOUT seconds (or what
+is left of a gRPC call's deadline, if sooner). When the queue is full or
+the wait runs out it is shed at once, before any work is done: REST
+answers 503 with Retry-After, gRPC RESOURCE_EXHAUSTED. A gRPC call whose
+deadline has already passed is shed without running.
+
+  AdmissionMiddleware             - ASGI middleware for the FastAPI app
+  AioServerAdmissionInterceptor   - grpc.aio server interceptor
+  ServerAdmissionInterceptor      - thread-pool grpc.server interceptor; a
+                                    waiting call would hold a worker
+                                    thread, so calls over the limit are
+                                    shed at once (the executor queue is
+                                    bounded in common.grpc_server instead)
+
+Routes listed in ADMISSION_EXEMPT (/health, /metrics and /admission by
+default) and server-streaming RPCs (Watch*, StreamOrders), whose
+duration is not a latency, are never limited. ADMISSION_CONTROL=0 turns
+it all off.
+"""
+import asyncio
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import grpc
+from starlette.responses import JSONResponse
+from starlette.routing import Match
+
+from common.metrics import REGISTRY, Counter, Gauge, WrappedHandlers, handler_behavior, rebuild_handler
+
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "1") == "1"
+ADMISSION_INITIAL_LIMIT = int(os.getenv("ADMISSION_INITIAL_LIMIT", "20"))
+ADMISSION_MIN_LIMIT = int(os.getenv("ADMISSION_MIN_LIMIT", "4"))
+ADMISSION_MAX_LIMIT = int(os.getenv("ADMISSION_MAX_LIMIT", "500"))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "50"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "0.2"))
+# How many times its long-run average the latency may reach before the limit shrinks
+ADMISSION_TOLERANCE = float(os.getenv("ADMISSION_TOLERANCE", "2.0"))
+# Event loop lag above which REST and aio gRPC requests start to be shed at once (0 disables)
+ADMISSION_MAX_LOOP_LAG = float(os.getenv("ADMISSION_MAX_LOOP_LAG", "0.02"))
+# Routes never limited, comma-separated (route templates, e.g. /users/{user_id})
+ADMISSION_EXEMPT = frozenset(filter(None, os.getenv("ADMISSION_EXEMPT", "/health,/metrics,/admission").split(",")))
+
+# Completed requests averaged into the recent latency
+SHORT_WINDOW = 10
+# Fastest the baseline latency may rise, per second (it falls at once)
+BASELINE_DRIFT = 0.1
+# Weight of each new limit estimate
+SMOOTHING = 0.2
+# Seconds between event loop lag samples
+LAG_INTERVAL = 0.02
+
+ADMISSION_LIMIT = REGISTRY.register(Gauge(
+    "admission_concurrency_limit", "Current concurrency limit by route or gRPC method", ("name",)))
+ADMISSION_SHED = REGISTRY.register(Counter(
+    "admission_shed_total", "Requests shed by admission control by route or gRPC method and reason",
+    ("name", "reason")))
+
+
+class AdaptiveLimit:
+    """Latency-driven concurrency limit with a bounded wait queue for one route or method.
+
+    try_acquire()/acquire() take a slot, release(latency) gives it back and
+    feeds the latency into the limit. A slot freed while requests wait is
+    handed to the oldest of them, so newcomers never overtake the queue.
+    Safe to use from threads and from event loops.
+    """
+
+    def __init__(self, name, initial=ADMISSION_INITIAL_LIMIT, min_limit=ADMISSION_MIN_LIMIT,
+                 max_limit=ADMISSION_MAX_LIMIT, queue_size=ADMISSION_QUEUE_SIZE, tolerance=ADMISSION_TOLERANCE):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.queue_size = queue_size
+        self.tolerance = tolerance
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.in_flight = 0
+        self.admitted = 0
+        self.shed = 0
+        self._recent = None
+        self._baseline = None
+        self._updated = time.monotonic()
+        self._waiters = deque()
+        self._lock = threading.Lock()
+        self._gauge = ADMISSION_LIMIT.labels(name)
+        self._gauge.set(int(self.limit))
+
+    def _take(self):
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            return True
+        return False
+
+    def try_acquire(self):
+        """Take a slot if one is free now; otherwise count the request as shed"""
+        with self._lock:
+            if self._take():
+                return True
+        self.reject("limit")
+        return False
+
+    async def acquire(self, timeout):
+        """Take a slot, waiting in the queue for up to `timeout` seconds; False if shed"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._take():
+                return True
+            full = len(self._waiters) >= self.queue_size
+            if not full and timeout > 0:
+                entry = (loop, loop.create_future())
+                self._waiters.append(entry)
+        if full or timeout <= 0:
+            self.reject("queue_full" if full else "timeout")
+            return False
+        try:
+            await asyncio.wait_for(entry[1], timeout)
+            return True
+        except asyncio.TimeoutError:
+            self.reject("timeout")
+            return False
+        finally:
+            with self._lock:
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+
+    def release(self, latency=None):
+        """Give a slot back; `latency` (seconds the request ran) adjusts the limit"""
+        granted = []
+        with self._lock:
+            if latency is not None:
+                self._update(latency)
+            self.in_flight -= 1
+            while self._waiters and self.in_flight < int(self.limit):
+                # The slot passes straight to the oldest waiter
+                granted.append(self._waiters.popleft())
+                self.in_flight += 1
+                self.admitted += 1
+        self._gauge.set(int(self.limit))
+        for loop, future in granted:
+            loop.call_soon_threadsafe(_grant, future, self)
+
+    def reject(self, reason):
+        """Count a request shed for `reason`"""
+        self.shed += 1
+        ADMISSION_SHED.labels(self.name, reason).inc()
+
+    def _update(self, latency):
+        now = time.monotonic()
+        if self._baseline is None:
+            self._recent = self._baseline = latency
+            self._updated = now
+            return
+        self._recent += (latency - self._recent) * 2 / (SHORT_WINDOW + 1)
+        # The baseline is the lowest recent latency, allowed to creep up slowly so that a
+        # route that became slower for good (a larger table) is not held at its old speed
+        self._baseline = min(self._recent, self._baseline * (1 + BASELINE_DRIFT * (now - self._updated)))
+        self._updated = now
+        gradient = max(0.5, min(1.0, self.tolerance * self._baseline / max(self._recent, 1e-9)))
+        if gradient == 1.0 and self.in_flight * 2 < self.limit:
+            # Far from the limit: nothing shows a larger one would be safe
+            return
+        estimate = self.limit * gradient + math.sqrt(self.limit)
+        self.limit = min(self.max_limit, max(self.min_limit, self.limit * (1 - SMOOTHING) + estimate * SMOOTHING))
+
+    def snapshot(self):
+        """State for the /admission endpoint"""
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "latency_ms": round(self._recent * 1000, 3) if self._recent is not None else None,
+            "baseline_ms": round(self._baseline * 1000, 3) if self._baseline is not None else None,
+        }
+
+
+def _grant(future, limit):
+    if future.done():
+        # The waiter gave up (timed out or cancelled) after the slot was handed to it
+        limit.release()
+    else:
+        future.set_result(None)
+
+
+class LoopLag:
+    """How late the running event loop fires a LAG_INTERVAL timer, sampled continuously.
+
+    `lag` is the smaller of the last two samples, so one long blocking call
+    (a large list response) does not count as overload once the loop has
+    caught up. The sampling task starts on the first overloaded() call from
+    a coroutine on the loop (after any worker fork).
+    """
+
+    def __init__(self, max_lag=ADMISSION_MAX_LOOP_LAG):
+        self.max_lag = max_lag
+        self.lag = 0.0
+        self.backlog = 0
+        self._last = 0.0
+        self._idle_tasks = None
+        self._task = None
+
+    def overloaded(self):
+        """Whether to shed a request now: never below max_lag, always at twice it, in proportion between"""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._sample())
+        if self.max_lag <= 0 or self.lag <= self.max_lag:
+            return False
+        if self.backlog < 2:
+            # No one is queued behind this request: what held the loop up (one client's
+            # large requests back to back) is not a crowd to shed
+            return False
+        return random.random() < (self.lag - self.max_lag) / self.max_lag
+
+    async def _sample(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + LAG_INTERVAL
+            await asyncio.sleep(LAG_INTERVAL)
+            sample = max(0.0, loop.time() - expected)
+            self.lag = min(sample, self._last)
+            self._last = sample
+            # Every REST request and aio RPC runs in its own task: tasks above the idle count
+            # are requests in progress or waiting for the loop
+            tasks = len(asyncio.all_tasks(loop))
+            self._idle_tasks = tasks if self._idle_tasks is None else min(self._idle_tasks, tasks)
+            self.backlog = tasks - self._idle_tasks
+
+
+loop_lag = LoopLag()
+
+_limits = {}
+_limits_lock = threading.Lock()
+
+
+def limit_for(name):
+    """The AdaptiveLimit of a route ("GET /users/{user_id}") or gRPC method, created on first use"""
+    limit = _limits.get(name)
+    if limit is None:
+        with _limits_lock:
+            limit = _limits.get(name)
+            if limit is None:
+                limit = _limits[name] = AdaptiveLimit(name)
+    return limit
+
+
+def admission_snapshot():
+    """State of every limit, for the /admission endpoint"""
+    return {"enabled": ADMISSION_CONTROL, "loop_lag_ms": round(loop_lag.lag * 1000, 3), "loop_backlog": loop_lag.backlog,
+            "limits": {name: limit.snapshot() for name, limit in list(_limits.items())}}
+
+
+class AdmissionMiddleware:
+    """ASGI middleware applying a per-route AdaptiveLimit to every REST request.
+
+    Added before MetricsMiddleware and TracingMiddleware so that shed
+    requests are still counted and traced under their route. `routes` is
+    the app's route list (app.routes), matched here the way the router
+    will match it.
+    """
+
+    def __init__(self, app, routes):
+        self.app = app
+        self.routes = routes
+
+    def _route(self, scope):
+        for route in self.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not ADMISSION_CONTROL:
+            await self.app(scope, receive, send)
+            return
+        route = self._route(scope)
+        if route is None or route.path in ADMISSION_EXEMPT:
+            await self.app(scope, receive, send)
+            return
+        limit = limit_for(f"{scope['method']} {route.path}")
+        if loop_lag.overloaded():
+            limit.reject("loop_lag")
+            admitted = False
+        else:
+            admitted = await limit.acquire(ADMISSION_QUEUE_TIMEOUT)
+        if not admitted:
+            scope["route"] = route
+            response = JSONResponse({"detail": f"Overloaded: {limit.name} is at its concurrency limit"},
+                                    status_code=503, headers={"Retry-After": "1"})
+            await response(scope, receive, send)
+            return
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limit.release(time.perf_counter() - started)
+
+
+def _deadline_passed(context):
+    remaining = context.time_remaining()
+    return remaining is not None and remaining <= 0
+
+
+def _admit_aio(method, handler):
+    limit = limit_for(method)
+    behavior = handler_behavior(handler)
+
+    async def admitted(request, context):
+        remaining = context.time_remaining()
+        if remaining is not None and remaining <= 0:
+            limit.reject("deadline")
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, "Overloaded: deadline passed before start")
+        if loop_lag.overloaded():
+            limit.reject("loop_lag")
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, "Overloaded: event loop is behind")
+        timeout = ADMISSION_QUEUE_TIMEOUT if remaining is None else min(ADMISSION_QUEUE_TIMEOUT, remaining)
+        if not await limit.acquire(timeout):
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED,
+                                f"Overloaded: {limit.name} is at its concurrency limit")
+        started = time.perf_counter()
+        try:
+            return await behavior(request, context)
+        finally:
+            limit.release(time.perf_counter() - started)
+
+    return rebuild_handler(handler, admitted)
+
+
+def _admit_threaded(method, handler):
+    limit = limit_for(method)
+    behavior = handler_behavior(handler)
+
+    def admitted(request, context):
+        if _deadline_passed(context):
+            # It waited in the executor queue until its caller gave up
+            limit.reject("deadline")
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, "Overloaded: deadline passed before start")
+        if not limit.try_acquire():
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED,
+                          f"Overloaded: {limit.name} is at its concurrency limit")
+        started = time.perf_counter()
+        try:
+            return behavior(request, context)
+        finally:
+            limit.release(time.perf_counter() - started)
+
+    return rebuild_handler(handler, admitted)
+
+
+class AioServerAdmissionInterceptor(grpc.aio.ServerInterceptor):
+    """Applies a per-method AdaptiveLimit to calls on a grpc.aio server"""
+
+    def __init__(self):
+        self._handlers = WrappedHandlers()
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None or handler.response_streaming or not ADMISSION_CONTROL:
+            return handler
+        return self._handlers.wrap(handler_call_details.method, handler, _admit_aio)
+
+
+class ServerAdmissionInterceptor(grpc.ServerInterceptor):
+    """Applies a per-method AdaptiveLimit to calls on a thread-pool grpc.server (no waiting)"""
+
+    def __init__(self):
+        self._handlers = WrappedHandlers()
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None or handler.response_streaming or not ADMISSION_CONTROL:
+            return handler
+        return self._handlers.wrap(handler_call_details.method, handler, _admit_threaded)
@@ -0,0 +1,311 @@
+"""
+Sales rollups of the orders table, updated on every order write.
+
+OrderAnalytics subscribes to the orders Store (Store.subscribe) and keeps:
+  - revenue, units and order count per product, per user and in total
+  - the same per time bucket of ANALYTICS_BUCKET_SECONDS (by created_at;
+    orders without a creation time are left out of the timeline)
+  - the ANALYTICS_TOP_MAX best products and users by revenue and by units
+so a lookup is O(1), a top-N read O(N) and a timeline read O(buckets),
+whatever the number of orders. Applying one write costs a few dict
+updates; a top-N list only moves the entry whose total went up.
+
+rebuild() recomputes everything from a snapshot of the table: vectorized
+with NumPy when it is installed (group sums with bincount), otherwise one
+Python pass. It runs when the service starts, so a warm start from a
+large store does not replay orders one by one; writes that arrive while
+it runs are queued and applied on top.
+"""
+import os
+import threading
+import time
+from heapq import nlargest
+from itertools import chain
+from operator import attrgetter
+
+try:
+    import numpy as np
+except ImportError:  # numpy is in service_c's requirements.txt; fall back to a Python pass
+    np = None
+
+ANALYTICS_BUCKET_SECONDS = int(os.getenv("ANALYTICS_BUCKET_SECONDS", "3600"))
+ANALYTICS_TOP_MAX = int(os.getenv("ANALYTICS_TOP_MAX", "100"))
+
+RANKINGS = ("revenue", "units")
+
+order_columns = attrgetter("product_id", "user_id", "quantity", "total_price", "created_at")
+ORDER_COLUMNS = 5
+
+
+class Sales:
+    """Running totals of one product, user, time bucket or of everything"""
+
+    __slots__ = ("revenue", "units", "orders")
+
+    def __init__(self, revenue=0.0, units=0, orders=0):
+        self.revenue = revenue
+        self.units = units
+        self.orders = orders
+
+    def to_dict(self):
+        return {"revenue": round(self.revenue, 2), "units": self.units, "orders": self.orders}
+
+
+class TopK:
+    """The `size` best keys of `stats` by one Sales field, best first (ties: lower key first).
+
+    Totals normally only grow, and a key outside the list whose total did
+    not change can never overtake one inside it, so raised() just moves the
+    raised key up. A total that went down (an order changed) marks the list
+    stale, and it is recomputed from `stats` on the next read.
+    """
+
+    def __init__(self, stats, field, size):
+        self._stats = stats
+        self._field = field
+        self._size = size
+        self._keys = []
+        self._members = set()
+        self._stale = False
+
+    def raised(self, key):
+        if self._stale or self._size <= 0:
+            return
+        stats, field, keys = self._stats, self._field, self._keys
+        score = getattr(stats[key], field)
+        if key in self._members:
+            position = keys.index(key)
+        elif len(keys) < self._size:
+            keys.append(key)
+            self._members.add(key)
+            position = len(keys) - 1
+        else:
+            last = keys[-1]
+            last_score = getattr(stats[last], field)
+            if score < last_score or (score == last_score and key > last):
+                return
+            self._members.discard(last)
+            self._members.add(key)
+            position = len(keys) - 1
+        while position > 0:
+            above = keys[position - 1]
+            above_score = getattr(stats[above], field)
+            if score < above_score or (score == above_score and key > above):
+                break
+            keys[position] = above
+            position -= 1
+        keys[position] = key
+
+    def lowered(self):
+        self._stale = True
+
+    def reset(self, keys):
+        """Replace the list with `keys`, already best first"""
+        self._keys = list(keys[:self._size])
+        self._members = set(self._keys)
+        self._stale = False
+
+    def top(self, limit):
+        if self._stale:
+            field = self._field
+            self.reset(nlargest(self._size, self._stats, key=lambda key: (getattr(self._stats[key], field), -key)))
+        return self._keys[:limit]
+
+
+class Rollup:
+    """All aggregates of one snapshot of the orders (swapped whole by rebuild)"""
+
+    def __init__(self, bucket_seconds, top_max):
+        self.bucket_seconds = bucket_seconds
+        self.total = Sales()
+        self.products = {}
+        self.users = {}
+        self.buckets = {}
+        self.top = {
+            (name, field): TopK(stats, field, top_max)
+            for name, stats in (("products", self.products), ("users", self.users))
+            for field in RANKINGS
+        }
+        self._product_tops = [self.top["products", field] for field in RANKINGS]
+        self._user_tops = [self.top["users", field] for field in RANKINGS]
+
+    def add(self, order, sign=1):
+        """Count `order` in every aggregate (sign=-1 takes it out again)"""
+        revenue = sign * order.total_price
+        units = sign * order.quantity
+        self._add(self.total, revenue, units, sign)
+        self._count(self.products, self._product_tops, order.product_id, revenue, units, sign)
+        self._count(self.users, self._user_tops, order.user_id, revenue, units, sign)
+        if order.created_at:
+            start = int(order.created_at // self.bucket_seconds) * self.bucket_seconds
+            entry = self.buckets.get(start)
+            if entry is None:
+                entry = self.buckets[start] = Sales()
+            self._add(entry, revenue, units, sign)
+
+    @classmethod
+    def _count(cls, stats, tops, key, revenue, units, sign):
+        entry = stats.get(key)
+        if entry is None:
+            entry = stats[key] = Sales()
+        cls._add(entry, revenue, units, sign)
+        for top in tops:
+            if sign > 0:
+                top.raised(key)
+            else:
+                top.lowered()
+
+    @staticmethod
+    def _add(entry, revenue, units, count):
+        entry.revenue += revenue
+        entry.units += units
+        entry.orders += count
+
+
+class OrderAnalytics:
+    """Incrementally maintained sales rollups over an orders Store (see module docstring)"""
+
+    def __init__(self, store, bucket_seconds=ANALYTICS_BUCKET_SECONDS, top_max=ANALYTICS_TOP_MAX):
+        self.store = store
+        self.bucket_seconds = bucket_seconds
+        self.top_max = top_max
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self._rollup = Rollup(bucket_seconds, top_max)
+        self._pending = None
+        self.last_rebuild = {}
+
+    # ---- keeping up with the store
+
+    def _on_write(self, old, order):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((old, order))
+                return
+            self._apply(self._rollup, old, order)
+
+    @staticmethod
+    def _apply(rollup, old, order):
+        if old is not None:
+            rollup.add(old, -1)
+        rollup.add(order)
+
+    def rebuild(self, vectorized=True):
+        """Recompute every aggregate from a snapshot of the store; returns timing info.
+
+        Writes made while it runs are queued and applied to the new rollup,
+        so none is lost or counted twice.
+        """
+        with self._rebuild_lock:
+            self.store.unsubscribe(self._on_write)
+            with self._lock:
+                self._pending = []
+            orders = self.store.subscribe(self._on_write)
+            started = time.perf_counter()
+            if vectorized and np is not None:
+                rollup, method = self._rollup_numpy(orders), "numpy"
+            else:
+                rollup, method = self._rollup_python(orders), "python"
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                for old, order in self._pending:
+                    self._apply(rollup, old, order)
+                self._pending = None
+                self._rollup = rollup
+            self.last_rebuild = {"orders": len(orders), "method": method, "seconds": round(elapsed, 4)}
+            return self.last_rebuild
+
+    def _rollup_python(self, orders):
+        rollup = Rollup(self.bucket_seconds, self.top_max)
+        for order in orders:
+            rollup.add(order)
+        return rollup
+
+    def _rollup_numpy(self, orders):
+        rollup = Rollup(self.bucket_seconds, self.top_max)
+        if not orders:
+            return rollup
+        # One pass over the records; the group sums below are all vectorized
+        columns = np.fromiter(chain.from_iterable(map(order_columns, orders)), dtype=np.float64,
+                              count=len(orders) * ORDER_COLUMNS).reshape(-1, ORDER_COLUMNS)
+        product_ids = columns[:, 0].astype(np.int64)
+        user_ids = columns[:, 1].astype(np.int64)
+        quantities = columns[:, 2]
+        prices = columns[:, 3]
+        created = columns[:, 4]
+
+        rollup.total = Sales(float(prices.sum()), int(quantities.sum()), len(orders))
+        for name, stats, ids in (("products", rollup.products, product_ids), ("users", rollup.users, user_ids)):
+            keys, revenue, units, counts = _group_sums(ids, prices, quantities)
+            stats.update(zip(keys.tolist(), map(Sales, revenue.tolist(), units.astype(np.int64).tolist(),
+                                                counts.tolist())))
+            for field, values in (("revenue", revenue), ("units", units)):
+                # Best first, ties by lower key: lexsort sorts by its last key first
+                best = np.lexsort((keys, -values))[:self.top_max]
+                rollup.top[name, field].reset(keys[best].tolist())
+
+        timed = created > 0
+        if timed.any():
+            starts = (created[timed] // self.bucket_seconds).astype(np.int64) * self.bucket_seconds
+            keys, revenue, units, counts = _group_sums(starts, prices[timed], quantities[timed])
+            rollup.buckets.update(zip(keys.tolist(), map(Sales, revenue.tolist(), units.astype(np.int64).tolist(),
+                                                         counts.tolist())))
+        return rollup
+
+    # ---- reads
+
+    def _current(self):
+        # A shared store replays other workers' orders (and so calls _on_write) on access
+        self.store.version
+        return self._rollup
+
+    def summary(self):
+        rollup = self._current()
+        with self._lock:
+            return {**rollup.total.to_dict(), "products": len(rollup.products), "users": len(rollup.users),
+                    "buckets": len(rollup.buckets), "bucket_seconds": rollup.bucket_seconds,
+                    "last_rebuild": self.last_rebuild}
+
+    def sales(self, kind, key):
+        """Totals of one product or user ("products"/"users"); zeros if it has no orders"""
+        rollup = self._current()
+        with self._lock:
+            entry = getattr(rollup, kind).get(key)
+            return {"id": key, **(entry or Sales()).to_dict()}
+
+    def top(self, kind, by="revenue", limit=10):
+        """Best `limit` products or users by revenue or units (at most ANALYTICS_TOP_MAX)"""
+        if by not in RANKINGS:
+            raise ValueError(f"by must be one of {', '.join(RANKINGS)}")
+        rollup = self._current()
+        with self._lock:
+            stats = getattr(rollup, kind)
+            return [{"id": key, **stats[key].to_dict()}
+                    for key in rollup.top[kind, by].top(max(0, min(limit, self.top_max)))]
+
+    def timeline(self, bucket_seconds=0, since=0.0, until=0.0):
+        """Totals per time bucket in [since, until), oldest first. `bucket_seconds`
+        must be a multiple of ANALYTICS_BUCKET_SECONDS (0 = that width)."""
+        if bucket_seconds < 0:
+            raise ValueError("bucket_seconds must not be negative")
+        rollup = self._current()
+        width = bucket_seconds or rollup.bucket_seconds
+        if width % rollup.bucket_seconds:
+            raise ValueError(f"bucket_seconds must be a multiple of {rollup.bucket_seconds}")
+        merged = {}
+        with self._lock:
+            for start, entry in rollup.buckets.items():
+                if start < since or (until and start >= until):
+                    continue
+                bucket = merged.get(start // width * width)
+                if bucket is None:
+                    bucket = merged[start // width * width] = Sales()
+                Rollup._add(bucket, entry.revenue, entry.units, entry.orders)
+        return [{"start": start, **merged[start].to_dict()} for start in sorted(merged)]
+
+
+def _group_sums(keys, revenue, units):
+    """(unique keys, revenue sums, unit sums, counts) of rows grouped by `keys`"""
+    unique, inverse = np.unique(keys, return_inverse=True)
+    return (unique, np.bincount(inverse, weights=revenue), np.bincount(inverse, weights=units),
+            np.bincount(inverse))
@@ -0,0 +1,244 @@
+"""
+Change log of a Store, streamed to consumers by the Watch* RPCs.
+
+ChangeLog subscribes to a Store (Store.subscribe) and numbers every insert
+and update with a sequence number: 1, 2, 3, ... from service start. The
+last CHANGE_LOG_SIZE changes are kept in a ring buffer, each with its
+kind ("created" or "updated"), the fields that changed and the new record.
+
+A consumer keeps a replica of the table current with one stream:
+  - first call with snapshot=true: every current record (kind "snapshot",
+    all numbered with the sequence number the snapshot was taken at),
+    then the changes after it
+  - on reconnect, after_seq = the last seq it applied and epoch = the
+    epoch it was sent, to get exactly the changes it missed
+Changes are delivered in order, in batches of up to WATCH_BATCH_SIZE;
+a change made while the snapshot is read can come both in the snapshot
+and after it, so a consumer applies them in order as upserts by id.
+An empty batch is sent every WATCH_HEARTBEAT_SECONDS while nothing
+changes.
+
+The log lives in memory: a restarted service starts a new one under a
+new epoch, and with WORKERS > 1 each worker numbers the changes it sees
+in its own log. A request whose epoch is not the current one, or whose
+after_seq has already left the ring buffer (a consumer that fell behind
+by more than CHANGE_LOG_SIZE changes), ends with OUT_OF_RANGE and must
+start again from a snapshot.
+
+On the thread-pool gRPC server (GRPC_SERVER_MODE=thread) every open
+stream holds a worker thread, so at most WATCH_MAX_THREAD_STREAMS streams
+(always fewer than GRPC_MAX_WORKERS) are served at once per process,
+leaving threads for the unary calls; more are refused with
+RESOURCE_EXHAUSTED. The aio server has no such limit.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+import grpc
+
+from common.grpc_server import GRPC_MAX_WORKERS
+from common.storage import STORE_ENGINE
+
+CHANGE_LOG_SIZE = int(os.getenv("CHANGE_LOG_SIZE", "100000"))
+WATCH_BATCH_SIZE = int(os.getenv("WATCH_BATCH_SIZE", "500"))
+WATCH_HEARTBEAT_SECONDS = float(os.getenv("WATCH_HEARTBEAT_SECONDS", "5"))
+# With STORE_ENGINE=shared, how often an idle watch checks for other workers' writes
+WATCH_POLL_SECONDS = float(os.getenv("WATCH_POLL_SECONDS", "0.1"))
+WATCH_MAX_THREAD_STREAMS = min(int(os.getenv("WATCH_MAX_THREAD_STREAMS", str(GRPC_MAX_WORKERS // 2))),
+                               GRPC_MAX_WORKERS - 1)
+
+rpc_logger = logging.getLogger("rpc")
+
+# Watch streams of all change logs share the thread-pool server's workers
+_thread_streams = threading.BoundedSemaphore(WATCH_MAX_THREAD_STREAMS) if WATCH_MAX_THREAD_STREAMS > 0 else None
+
+Change = namedtuple("Change", "seq kind fields record")
+
+
+class ResyncRequired(Exception):
+    """The requested position is not in the change log; start again from a snapshot"""
+
+
+class ChangeLog:
+    """Bounded, numbered log of the writes to a Store (see module docstring)"""
+
+    def __init__(self, store, name, size=CHANGE_LOG_SIZE):
+        self.store = store
+        self.name = name
+        self.size = size
+        self.epoch = uuid.uuid4().hex
+        self._ring = [None] * size
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._waiters = []
+        # Other workers' writes reach this process only when the store is read
+        self._poll_seconds = WATCH_POLL_SECONDS if STORE_ENGINE == "shared" else None
+        store.subscribe(self._on_write)
+
+    def _on_write(self, old, record):
+        if old is None:
+            kind, fields = "created", ()
+        else:
+            kind, fields = "updated", tuple(field for field in record.keys() if old[field] != record[field])
+        with self._cond:
+            self._seq += 1
+            self._ring[self._seq % self.size] = Change(self._seq, kind, fields, record)
+            self._cond.notify_all()
+            waiters, self._waiters = self._waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_wake, future)
+
+    @property
+    def last_seq(self):
+        """Sequence number of the latest change (0 before the first)"""
+        return self._seq
+
+    def read(self, after_seq, limit=WATCH_BATCH_SIZE):
+        """Up to `limit` changes after `after_seq`, oldest first"""
+        after_seq = max(after_seq, 0)
+        # A shared store replays other workers' writes (and so calls _on_write) on access
+        self.store.version
+        with self._cond:
+            if after_seq < self._seq - self.size:
+                raise ResyncRequired(f"{self.name} changes after {after_seq} are no longer in the change log "
+                                     f"(it keeps the last {self.size})")
+            if after_seq > self._seq:
+                raise ResyncRequired(f"{self.name} change log is at {self._seq}, before {after_seq}")
+            end = min(self._seq, after_seq + limit)
+            return [self._ring[seq % self.size] for seq in range(after_seq + 1, end + 1)]
+
+    def snapshot(self):
+        """(seq, records): every record, and the seq of the last change they are sure to include"""
+        self.store.version
+        seq = self._seq
+        return seq, self.store.values()
+
+    def wait(self, after_seq, timeout, context=None):
+        """Block until there is a change after `after_seq`, `timeout` passes or
+        the RPC of `context` ends"""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: self._seq > after_seq or (context is not None and not context.is_active()), timeout)
+
+    def _wake_all(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    async def wait_async(self, after_seq, timeout):
+        """wait() for the event loop"""
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            if self._seq > after_seq:
+                return True
+            entry = (loop, loop.create_future())
+            self._waiters.append(entry)
+        try:
+            await asyncio.wait_for(entry[1], timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._cond:
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+        return self._seq > after_seq
+
+    # ---- Watch* RPC handlers: follow() on the thread server, follow_async() on the aio server
+
+    def follow(self, request, context, to_message):
+        """Yield to_message(epoch, last_seq, changes) for a WatchRequest until the client leaves"""
+        rpc_logger.info("gRPC Watch %s called with after_seq=%s snapshot=%s", self.name, request.after_seq,
+                        request.snapshot)
+        if _thread_streams is None or not _thread_streams.acquire(blocking=False):
+            context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+            context.set_details(f"At most {WATCH_MAX_THREAD_STREAMS} Watch streams at once in thread mode "
+                                f"(GRPC_SERVER_MODE=aio has no limit)")
+            return
+        try:
+            context.add_callback(self._wake_all)
+            watch = _Watch(self, request, to_message)
+            while context.is_active():
+                message = watch.next()
+                if message is None:
+                    self.wait(watch.after, watch.timeout(), context)
+                    message = watch.heartbeat()
+                if message is not None:
+                    yield message
+        except ResyncRequired as e:
+            context.set_code(grpc.StatusCode.OUT_OF_RANGE)
+            context.set_details(str(e))
+        finally:
+            _thread_streams.release()
+
+    async def follow_async(self, request, context, to_message):
+        """follow() as an async generator, waiting on the event loop"""
+        rpc_logger.info("gRPC Watch %s called with after_seq=%s snapshot=%s", self.name, request.after_seq,
+                        request.snapshot)
+        try:
+            watch = _Watch(self, request, to_message)
+            while True:
+                message = watch.next()
+                if message is None:
+                    await self.wait_async(watch.after, watch.timeout())
+                    message = watch.heartbeat()
+                if message is not None:
+                    yield message
+        except ResyncRequired as e:
+            context.set_code(grpc.StatusCode.OUT_OF_RANGE)
+            context.set_details(str(e))
+
+
+class _Watch:
+    """Position of one Watch stream; next() never blocks"""
+
+    def __init__(self, log, request, to_message):
+        self._log = log
+        self._to_message = to_message
+        self._snapshot = None
+        self._heartbeat_at = time.monotonic() + WATCH_HEARTBEAT_SECONDS
+        if request.epoch and request.epoch != log.epoch:
+            raise ResyncRequired(f"{log.name} change log epoch is {log.epoch}, not {request.epoch} "
+                                 f"(restarted, or another worker)")
+        if request.snapshot:
+            self.after, self._snapshot = log.snapshot()
+        else:
+            self.after = request.after_seq
+            log.read(self.after, 0)
+
+    def next(self):
+        """The next message to send, or None when there is nothing new"""
+        if self._snapshot is not None:
+            records = self._snapshot[:WATCH_BATCH_SIZE]
+            del self._snapshot[:WATCH_BATCH_SIZE]
+            if not self._snapshot:
+                self._snapshot = None
+            return self._send([Change(self.after, "snapshot", (), record) for record in records])
+        changes = self._log.read(self.after)
+        if not changes:
+            return None
+        self.after = changes[-1].seq
+        return self._send(changes)
+
+    def heartbeat(self):
+        """An empty message if nothing was sent for WATCH_HEARTBEAT_SECONDS, else None"""
+        if time.monotonic() < self._heartbeat_at:
+            return None
+        return self._send([])
+
+    def timeout(self):
+        """How long to wait for a change before the next heartbeat or poll"""
+        remaining = max(0.0, self._heartbeat_at - time.monotonic())
+        return remaining if self._log._poll_seconds is None else min(remaining, self._log._poll_seconds)
+
+    def _send(self, changes):
+        self._heartbeat_at = time.monotonic() + WATCH_HEARTBEAT_SECONDS
+        return self._to_message(self._log.epoch, self.after, changes)
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
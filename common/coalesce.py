@@ -0,0 +1,99 @@
+"""
+Request coalescing ("singleflight") for upstream gRPC reads.
+
+When a popular product or user is looked up by many requests at once (an
+order burst while its cache entry is cold or expired), every request would
+send the same GetUser/BatchGetProducts/ListUsers call upstream.
+CoalescingStub wraps an async stub (e.g. UpstreamPool.stub) so that
+concurrent calls of the same read RPC with the same request bytes share
+one in-flight call: the first caller starts it, later callers wait for it,
+and all of them get its response or its error. Nothing is cached; the next
+call after it finishes goes upstream again.
+
+Only read RPCs (common.resilience.is_idempotent: Get*, List*, BatchGet*)
+are coalesced; writes such as ReserveStock always go through. The shared
+call runs as its own task with the first caller's timeout and trace
+context, so a caller that gives up (cancelled, or its own deadline) does
+not cancel it for the others. The response message is shared: callers
+must not modify it.
+
+GRPC_COALESCE=0 turns coalescing off (calls go straight to the stub).
+"""
+import asyncio
+import os
+
+from common.metrics import REGISTRY, Counter
+from common.resilience import is_idempotent
+
+GRPC_COALESCE = os.getenv("GRPC_COALESCE", "1") == "1"
+
+COALESCE_CALLS = REGISTRY.register(Counter(
+    "grpc_client_coalesce_calls_total", "Read calls sent upstream by the coalescing layer", ("upstream", "method")))
+COALESCED_CALLS = REGISTRY.register(Counter(
+    "grpc_client_coalesced_total", "Read calls that shared an identical call already in flight",
+    ("upstream", "method")))
+
+
+class Singleflight:
+    """At most one in-flight call per key; concurrent callers of a key share its outcome"""
+
+    def __init__(self, name):
+        self.name = name
+        self._in_flight = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key, call, label=""):
+        """Return the outcome of call() (a coroutine function), or of the one already running for `key`"""
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(call())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+            self.calls += 1
+            COALESCE_CALLS.labels(self.name, label).inc()
+        else:
+            self.coalesced += 1
+            COALESCED_CALLS.labels(self.name, label).inc()
+        return await asyncio.shield(task)
+
+    def _finished(self, key, task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if not task.cancelled():
+            # Mark the error as retrieved even if every caller gave up waiting
+            task.exception()
+
+    def stats(self):
+        """Counters for the /cache-stats endpoint"""
+        total = self.calls + self.coalesced
+        return {
+            "enabled": GRPC_COALESCE,
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "coalesced_ratio": round(self.coalesced / total, 4) if total else 0.0,
+            "in_flight": len(self._in_flight),
+        }
+
+
+class CoalescingStub:
+    """Stand-in for an async stub whose read RPCs are coalesced (see module docstring)"""
+
+    def __init__(self, stub, name, enabled=GRPC_COALESCE):
+        self._stub = stub
+        self.flight = Singleflight(name)
+        self._enabled = enabled
+
+    def __getattr__(self, method):
+        target = getattr(self._stub, method)
+        if not self._enabled or not is_idempotent(method):
+            return target
+        flight = self.flight
+
+        async def invoke(request, **kwargs):
+            key = (method, request.SerializeToString(deterministic=True))
+            return await flight.do(key, lambda: target(request, **kwargs), method)
+
+        invoke.__name__ = method
+        setattr(self, method, invoke)
+        return invoke
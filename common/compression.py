@@ -0,0 +1,113 @@
+"""
+gRPC message compression between the services.
+
+GRPC_COMPRESSION picks the algorithm: none (default), gzip or deflate.
+Only messages of at least GRPC_COMPRESSION_MIN_BYTES serialized bytes are
+compressed; below that (GetUser, ReserveStock, ...) compression costs
+more CPU than the bytes it saves. Both directions are covered:
+  - requests: UpstreamPool.call passes compression= per call
+    (request_compression)
+  - responses: the servers compress with COMPRESSION, and
+    AioServerCompressionInterceptor / ServerCompressionInterceptor
+    serialize each response once and turn compression off for it if it
+    is small, handing the bytes on to gRPC unchanged (grpc.aio ignores
+    a per-call set_compression(), so it cannot work the other way round)
+gRPC clients always accept gzip and deflate, so either side can be
+switched on alone. Server-streaming responses are decided per message.
+"""
+import os
+
+import grpc
+
+from common.metrics import WrappedHandlers, handler_behavior, rebuild_handler
+
+GRPC_COMPRESSION = os.getenv("GRPC_COMPRESSION", "none")
+GRPC_COMPRESSION_MIN_BYTES = int(os.getenv("GRPC_COMPRESSION_MIN_BYTES", "1024"))
+
+ALGORITHMS = {"none": None, "gzip": grpc.Compression.Gzip, "deflate": grpc.Compression.Deflate}
+if GRPC_COMPRESSION not in ALGORITHMS:
+    raise ValueError(f"Unknown GRPC_COMPRESSION: {GRPC_COMPRESSION} (expected none, gzip or deflate)")
+# compression= argument of the gRPC servers and of large upstream calls (None: off)
+COMPRESSION = ALGORITHMS[GRPC_COMPRESSION]
+
+
+def request_compression(request):
+    """compression= argument for an outbound call carrying `request`"""
+    if COMPRESSION is not None and request.ByteSize() >= GRPC_COMPRESSION_MIN_BYTES:
+        return COMPRESSION
+    return None
+
+
+def _passthrough(serializer):
+    """Response serializer that leaves already serialized bytes alone"""
+    def serialize(response):
+        return response if isinstance(response, bytes) else serializer(response)
+    return serialize
+
+
+def _compress_aio(method, handler):
+    behavior = handler_behavior(handler)
+    serializer = handler.response_serializer
+
+    if handler.response_streaming:
+        async def compressed(request, context):
+            async for response in behavior(request, context):
+                data = serializer(response)
+                if len(data) < GRPC_COMPRESSION_MIN_BYTES:
+                    context.disable_next_message_compression()
+                yield data
+    else:
+        async def compressed(request, context):
+            data = serializer(await behavior(request, context))
+            if len(data) < GRPC_COMPRESSION_MIN_BYTES:
+                context.disable_next_message_compression()
+            return data
+
+    return rebuild_handler(handler, compressed, _passthrough(serializer))
+
+
+def _compress_threaded(method, handler):
+    behavior = handler_behavior(handler)
+    serializer = handler.response_serializer
+
+    if handler.response_streaming:
+        def compressed(request, context):
+            for response in behavior(request, context):
+                data = serializer(response)
+                if len(data) < GRPC_COMPRESSION_MIN_BYTES:
+                    context.disable_next_message_compression()
+                yield data
+    else:
+        def compressed(request, context):
+            data = serializer(behavior(request, context))
+            if len(data) < GRPC_COMPRESSION_MIN_BYTES:
+                context.disable_next_message_compression()
+            return data
+
+    return rebuild_handler(handler, compressed, _passthrough(serializer))
+
+
+class AioServerCompressionInterceptor(grpc.aio.ServerInterceptor):
+    """Leaves the small responses of a grpc.aio server uncompressed (must be the innermost interceptor)"""
+
+    def __init__(self):
+        self._handlers = WrappedHandlers()
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None or COMPRESSION is None:
+            return handler
+        return self._handlers.wrap(handler_call_details.method, handler, _compress_aio)
+
+
+class ServerCompressionInterceptor(grpc.ServerInterceptor):
+    """Leaves the small responses of a thread-pool grpc.server uncompressed (must be the innermost interceptor)"""
+
+    def __init__(self):
+        self._handlers = WrappedHandlers()
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None or COMPRESSION is None:
+            return handler
+        return self._handlers.wrap(handler_call_details.method, handler, _compress_threaded)
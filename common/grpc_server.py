@@ -0,0 +1,163 @@
+"""
+gRPC server runners shared by the services.
+
+Two modes, selected with GRPC_SERVER_MODE:
+  aio    - grpc.aio server started on the uvicorn event loop (default)
+  thread - classic grpc.server with a ThreadPoolExecutor in its own thread
+"""
+import asyncio
+import contextvars
+import functools
+import inspect
+import logging
+import os
+from collections import deque
+from concurrent import futures
+
+import grpc
+
+from common.admission import (ADMISSION_CONTROL, ADMISSION_QUEUE_SIZE, AioServerAdmissionInterceptor,
+                              ServerAdmissionInterceptor)
+from common.compression import COMPRESSION, AioServerCompressionInterceptor, ServerCompressionInterceptor
+from common.metrics import GRPC_THREADPOOL_QUEUE, AioServerMetricsInterceptor, ServerMetricsInterceptor
+from common.tracing import AioServerTracingInterceptor, ServerTracingInterceptor
+
+GRPC_SERVER_MODE = os.getenv("GRPC_SERVER_MODE", "aio")
+GRPC_MAX_WORKERS = int(os.getenv("GRPC_MAX_WORKERS", "10"))
+GRPC_SHUTDOWN_GRACE = float(os.getenv("GRPC_SHUTDOWN_GRACE", "5"))
+# Shortest interval between client keepalive pings the server accepts; upstream
+# channels (common.upstream) ping every GRPC_KEEPALIVE_TIME_MS, even when idle
+GRPC_MIN_PING_INTERVAL_MS = int(os.getenv("GRPC_MIN_PING_INTERVAL_MS", "10000"))
+
+SERVER_OPTIONS = [
+    # Worker processes (common.workers) all listen on the same gRPC port
+    ("grpc.so_reuseport", 1),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.min_ping_interval_without_data_ms", GRPC_MIN_PING_INTERVAL_MS),
+]
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncServicer:
+    """Expose a synchronous servicer's handlers as coroutines for grpc.aio.
+
+    The handlers only touch in-memory state, so they run inline on the event
+    loop instead of being handed to a thread pool. Handlers that are already
+    coroutines or async generators are passed through unchanged.
+
+    Client-streaming handlers iterate their requests synchronously, so they
+    run in a worker thread that reads the aio request stream through a
+    StreamReader.
+
+    A server-streaming handler that blocks between messages (decorated with
+    aio_stream) is replaced by its async generator variant.
+    """
+
+    def __init__(self, servicer):
+        self._servicer = servicer
+
+    def __getattr__(self, name):
+        handler = getattr(self._servicer, name)
+        aio_variant = getattr(handler, "aio_variant", None)
+        if aio_variant is not None:
+            async def variant_handler(request, context):
+                async for response in aio_variant(request, context):
+                    yield response
+            return variant_handler
+        if inspect.iscoroutinefunction(handler) or inspect.isasyncgenfunction(handler):
+            return handler
+        if inspect.isgeneratorfunction(handler):
+            async def stream_handler(request, context):
+                for response in handler(request, context):
+                    yield response
+            return stream_handler
+        if callable(handler):
+            async def unary_handler(request, context):
+                if hasattr(request, "__aiter__"):
+                    loop = asyncio.get_running_loop()
+                    run = functools.partial(contextvars.copy_context().run, handler)
+                    return await loop.run_in_executor(None, run, StreamReader(request, loop), context)
+                return handler(request, context)
+            return unary_handler
+        return handler
+
+
+def aio_stream(aio_variant):
+    """Decorator for a server-streaming handler that blocks while waiting for
+    its next message: the aio server calls aio_variant(request, context), an
+    async generator, instead of running the handler on the event loop"""
+    def decorate(handler):
+        handler.aio_variant = aio_variant
+        return handler
+    return decorate
+
+
+class StreamReader:
+    """Blocking iterator over a grpc.aio request stream, used from a worker thread.
+
+    Messages are pulled from the event loop in chunks to keep the number of
+    cross-thread hops low.
+    """
+
+    def __init__(self, request_iterator, loop, chunk_size=256):
+        self._requests = request_iterator.__aiter__()
+        self._loop = loop
+        self._chunk_size = chunk_size
+        self._buffer = deque()
+        self._exhausted = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self._buffer and not self._exhausted:
+            future = asyncio.run_coroutine_threadsafe(self._read_chunk(), self._loop)
+            self._buffer.extend(future.result())
+        if not self._buffer:
+            raise StopIteration
+        return self._buffer.popleft()
+
+    async def _read_chunk(self):
+        chunk = []
+        try:
+            while len(chunk) < self._chunk_size:
+                chunk.append(await self._requests.__anext__())
+        except StopAsyncIteration:
+            self._exhausted = True
+        return chunk
+
+
+def serve_threaded(add_servicer, servicer, port):
+    """Run a thread-pool gRPC server until it terminates (blocks the caller)"""
+    executor = futures.ThreadPoolExecutor(max_workers=GRPC_MAX_WORKERS)
+    GRPC_THREADPOOL_QUEUE.set_function(executor._work_queue.qsize)
+    # With admission control the executor queue is bounded: calls beyond it get RESOURCE_EXHAUSTED
+    max_rpcs = GRPC_MAX_WORKERS + ADMISSION_QUEUE_SIZE if ADMISSION_CONTROL else None
+    interceptors = [ServerTracingInterceptor(), ServerMetricsInterceptor(), ServerAdmissionInterceptor(),
+                    ServerCompressionInterceptor()]
+    server = grpc.server(executor, interceptors=interceptors, options=SERVER_OPTIONS, maximum_concurrent_rpcs=max_rpcs,
+                         compression=COMPRESSION)
+    add_servicer(servicer, server)
+    server.add_insecure_port(f'0.0.0.0:{port}')
+    logger.info(f"gRPC Server started on port {port} (thread mode, {GRPC_MAX_WORKERS} workers)")
+    server.start()
+    server.wait_for_termination()
+
+
+async def start_aio(add_servicer, servicer, port):
+    """Start a grpc.aio server on the running event loop and return it"""
+    interceptors = [AioServerTracingInterceptor(), AioServerMetricsInterceptor(), AioServerAdmissionInterceptor(),
+                    AioServerCompressionInterceptor()]
+    server = grpc.aio.server(interceptors=interceptors, options=SERVER_OPTIONS, compression=COMPRESSION)
+    add_servicer(AsyncServicer(servicer), server)
+    server.add_insecure_port(f'0.0.0.0:{port}')
+    await server.start()
+    logger.info(f"gRPC Server started on port {port} (aio mode)")
+    return server
+
+
+async def stop_aio(server):
+    """Gracefully stop a server returned by start_aio()"""
+    if server is not None:
+        await server.stop(GRPC_SHUTDOWN_GRACE)
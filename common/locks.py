@@ -0,0 +1,70 @@
+"""
+Striped locking for per-key critical sections
+"""
+import fcntl
+import os
+import threading
+import zlib
+
+
+class StripedLock:
+    """Fixed pool of locks where each key maps to one stripe.
+
+    Keys on different stripes never wait for each other, so unrelated
+    products can be updated in parallel without one lock per product.
+
+    With `path`, every stripe is also a one-byte lockf() range of that file,
+    so the stripe locks out the other processes using the same file (worker
+    processes on a shared store). Integer keys map to stripes by value and
+    other keys by crc32 of their repr, which, unlike hash() of a str, is the
+    same in every process.
+    """
+
+    def __init__(self, stripes=64, path=None):
+        self._locks = [threading.Lock() for _ in range(max(1, stripes))]
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600) if path else None
+
+    def stripe(self, key):
+        """Index of the stripe guarding `key`"""
+        if isinstance(key, int):
+            return key % len(self._locks)
+        return zlib.crc32(repr(key).encode()) % len(self._locks)
+
+    def hold(self, keys):
+        """Context holding the stripes of all `keys` at once.
+
+        Stripes are acquired in index order, so two callers locking
+        overlapping key sets cannot deadlock.
+        """
+        return _Held(self, sorted({self.stripe(key) for key in keys}))
+
+
+class _Held:
+    """Stripes of one StripedLock.hold() call"""
+
+    __slots__ = ("_striped", "_stripes", "_held")
+
+    def __init__(self, striped, stripes):
+        self._striped = striped
+        self._stripes = stripes
+        self._held = 0
+
+    def __enter__(self):
+        locks, fd = self._striped._locks, self._striped._fd
+        try:
+            for stripe in self._stripes:
+                locks[stripe].acquire()
+                self._held += 1
+                if fd is not None:
+                    fcntl.lockf(fd, fcntl.LOCK_EX, 1, stripe)
+        except BaseException:
+            self.__exit__(None, None, None)
+            raise
+
+    def __exit__(self, *exc_info):
+        locks, fd = self._striped._locks, self._striped._fd
+        for stripe in reversed(self._stripes[:self._held]):
+            if fd is not None:
+                fcntl.lockf(fd, fcntl.LOCK_UN, 1, stripe)
+            locks[stripe].release()
+        self._held = 0
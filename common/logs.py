@@ -0,0 +1,220 @@
+"""
+Structured logging with formatting and I/O on a background thread.
+
+configure_logging() replaces the root handlers with a queue handler. The
+request thread only builds the LogRecord and puts it on a bounded queue;
+a QueueListener thread formats it (JSON by default) and writes it to
+stderr. Per-call logs of the gRPC handlers go to the "rpc" logger, so they
+can be thinned with LOG_SAMPLING without touching anything else.
+
+Environment:
+  LOG_LEVEL       root level (INFO)
+  LOG_FORMAT      json or text (json)
+  LOG_SAMPLING    comma-separated logger=rate pairs, e.g.
+                  "rpc=0.01,uvicorn.access=0.1"; a rate applies to the
+                  logger and its children, WARNING and above are never dropped
+  LOG_QUEUE_SIZE  records buffered for the writer thread (10000); records
+                  below WARNING that do not fit are dropped and counted in
+                  log_records_dropped_total on /metrics
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+from common.metrics import REGISTRY, Counter
+from common.tracing import current_span
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s [%(trace_id)s] %(message)s"
+
+LOG_RECORDS_DROPPED = REGISTRY.register(Counter(
+    "log_records_dropped_total", "Log records dropped because the log queue was full"))
+
+
+def parse_sampling(value):
+    """Parse "logger=rate,..." into {"logger": rate}"""
+    rates = {}
+    for pair in value.split(","):
+        if "=" in pair:
+            name, rate = pair.split("=", 1)
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+class Sampler:
+    """Per-logger keep rates; a logger uses the rate of its closest configured
+    ancestor ("rpc" also covers "rpc.user"). WARNING and above always pass.
+    """
+
+    def __init__(self, rates):
+        self.rates = rates
+        self._resolved = {}
+
+    def keep(self, name, level):
+        if level >= logging.WARNING:
+            return True
+        rate = self._resolved.get(name)
+        if rate is None:
+            rate = self._resolved[name] = self._rate_for(name)
+        return rate >= 1.0 or random.random() < rate
+
+    def _rate_for(self, name):
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition(".")[0]
+        return 1.0
+
+
+_sampler = Sampler({})
+# Arguments of the last configure_logging() call, reused in forked workers
+_config = None
+
+
+class SampledLogger(logging.Logger):
+    """Logger that samples in isEnabledFor(), before a LogRecord is built.
+
+    configure_logging() makes this the class of every logger created after
+    it, which is where nearly all of the cost of a dropped call would go.
+    """
+
+    def isEnabledFor(self, level):
+        return _sampler.keep(self.name, level) and super().isEnabledFor(level)
+
+
+class SamplingFilter(logging.Filter):
+    """Samples records of loggers created before configure_logging()"""
+
+    def filter(self, record):
+        if isinstance(logging.Logger.manager.loggerDict.get(record.name), SampledLogger):
+            return True
+        return _sampler.keep(record.name, record.levelno)
+
+
+class ContextFilter(logging.Filter):
+    """Stamp records with the service name and the current trace id.
+
+    Runs on the caller's thread, where the trace context is still visible.
+    """
+
+    def __init__(self, service):
+        super().__init__()
+        self.service = service
+
+    def filter(self, record):
+        span = current_span()
+        record.service = self.service
+        record.trace_id = span.trace_id if span else "-"
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "service": getattr(record, "service", None),
+            "msg": record.getMessage(),
+        }
+        trace_id = getattr(record, "trace_id", "-")
+        if trace_id != "-":
+            entry["trace_id"] = trace_id
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread.
+
+    The stock handler merges msg and args on the caller's thread; here the
+    record is queued as is, so its args must not be mutated after the call
+    (true for the ints and strings the services log). When the queue is
+    full, records below WARNING are dropped instead of blocking the request;
+    warnings and errors wait for room.
+    """
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        if record.levelno >= logging.WARNING:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.labels().inc()
+
+
+class BackgroundListener(logging.handlers.QueueListener):
+    """QueueListener whose stop() waits for room on a full queue, may be called
+    twice and does nothing in a forked child (the thread is not there)
+    """
+
+    def start(self):
+        self._pid = os.getpid()
+        super().start()
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+    def stop(self):
+        if self._thread is not None and self._pid == os.getpid():
+            super().stop()
+
+
+def configure_logging(service, stream=None, sampling=None):
+    """Send all logging through a background writer thread; returns the listener.
+
+    Call it before creating loggers so they are SampledLoggers. `sampling`
+    overrides LOG_SAMPLING (same "logger=rate,..." syntax). A process forked
+    afterwards (common.workers) gets its own queue and writer thread.
+    """
+    global _sampler, _config
+    if _config is None:
+        os.register_at_fork(after_in_child=_restart_in_child)
+    _config = (service, stream, sampling)
+    _sampler = Sampler(parse_sampling(LOG_SAMPLING if sampling is None else sampling))
+    logging.setLoggerClass(SampledLogger)
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT))
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter())
+    handler.addFilter(ContextFilter(service))
+
+    # Records never show source location, thread or process, so skip collecting them
+    # (see "Optimization" in the logging HOWTO)
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+
+    listener = BackgroundListener(log_queue, output)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def _restart_in_child():
+    """The writer thread does not survive fork(); start a fresh pipeline in the child"""
+    configure_logging(*_config)
@@ -0,0 +1,432 @@
+"""
+In-process metrics in Prometheus text format.
+
+Everything is collected by wrappers around the servers and channels, not by
+the handlers themselves:
+  MetricsMiddleware             - ASGI middleware for the FastAPI app
+  AioServerMetricsInterceptor   - grpc.aio server interceptor
+  ServerMetricsInterceptor      - thread-pool grpc.server interceptor
+  ClientMetricsInterceptor      - grpc.aio channel interceptor (unary calls)
+common.grpc_server installs the server interceptors; services add the
+middleware, pass the client interceptor to their channels and expose
+metrics_response() on GET /metrics.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+import grpc
+from fastapi import Response
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds in seconds, tuned for sub-millisecond in-memory handlers up to slow upstreams
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    """A metric family; labels(*values) returns (and creates once) the child for a label set"""
+
+    kind = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class _Value:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1.0):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1.0):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    """Monotonic count, e.g. requests handled"""
+
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def _render_child(self, values, child):
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {child.value:g}"]
+
+
+class Gauge(_Metric):
+    """Value that goes up and down, e.g. requests in flight.
+
+    set_function() makes the gauge read its value from a callable at scrape
+    time (used for the thread-pool queue depth).
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set_function(self, function):
+        self._function = function
+
+    def _new_child(self):
+        return _Value()
+
+    def render(self):
+        if self._function is not None:
+            return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge",
+                    f"{self.name} {self._function():g}"]
+        return super().render()
+
+    def _render_child(self, values, child):
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {child.value:g}"]
+
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "_lock")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class Histogram(_Metric):
+    """Distribution of observed values (latencies) over fixed buckets"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def _render_child(self, values, child):
+        with child._lock:
+            counts = list(child.counts)
+            total = child.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else f"{bound:g}"
+            labels = _format_labels(self.labelnames, values, f'le="{le}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {total:g}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Set of metric families rendered together on /metrics"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "http_request_duration_seconds", "REST request latency by route", ("method", "route")))
+HTTP_RESPONSES = REGISTRY.register(Counter(
+    "http_responses_total", "REST responses by route and status", ("method", "route", "status")))
+HTTP_IN_FLIGHT = REGISTRY.register(Gauge(
+    "http_requests_in_flight", "REST requests being handled"))
+GRPC_SERVER_SECONDS = REGISTRY.register(Histogram(
+    "grpc_server_handling_seconds", "gRPC handler latency by method", ("method",)))
+GRPC_SERVER_HANDLED = REGISTRY.register(Counter(
+    "grpc_server_handled_total", "gRPC calls handled by method and status code", ("method", "code")))
+GRPC_SERVER_IN_FLIGHT = REGISTRY.register(Gauge(
+    "grpc_server_in_flight", "gRPC calls being handled by method", ("method",)))
+GRPC_THREADPOOL_QUEUE = REGISTRY.register(Gauge(
+    "grpc_threadpool_queue_depth", "gRPC calls waiting for a worker thread (thread mode only)"))
+GRPC_CLIENT_SECONDS = REGISTRY.register(Histogram(
+    "grpc_client_handling_seconds", "Outbound gRPC call latency by method", ("method",)))
+GRPC_CLIENT_HANDLED = REGISTRY.register(Counter(
+    "grpc_client_handled_total", "Outbound gRPC calls by method and status code", ("method", "code")))
+
+_http_in_flight = HTTP_IN_FLIGHT.labels()
+
+
+def metrics_response():
+    """Response for GET /metrics"""
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every REST request by route template.
+
+    The route is read from the scope after the router matched it, so
+    /users/1 and /users/2 share the /users/{user_id} series; unknown paths
+    are counted as "<unmatched>".
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        _http_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            _http_in_flight.dec()
+            route = scope.get("route")
+            path = getattr(route, "path", "<unmatched>")
+            HTTP_REQUEST_SECONDS.labels(scope["method"], path).observe(elapsed)
+            HTTP_RESPONSES.labels(scope["method"], path, status).inc()
+
+
+def status_name(context, error):
+    """Status of a finished call: the code the handler set on its context (set_code or
+    abort), else OK when it returned and UNKNOWN when it raised"""
+    code = context.code() if hasattr(context, "code") else None
+    if isinstance(code, grpc.StatusCode):
+        return code.name
+    return "OK" if error is None else "UNKNOWN"
+
+
+def rebuild_handler(handler, behavior, response_serializer=None):
+    """Copy of `handler` with its behavior (and optionally its response serializer) replaced"""
+    if handler.request_streaming and handler.response_streaming:
+        factory = grpc.stream_stream_rpc_method_handler
+    elif handler.request_streaming:
+        factory = grpc.stream_unary_rpc_method_handler
+    elif handler.response_streaming:
+        factory = grpc.unary_stream_rpc_method_handler
+    else:
+        factory = grpc.unary_unary_rpc_method_handler
+    return factory(behavior, request_deserializer=handler.request_deserializer,
+                   response_serializer=response_serializer or handler.response_serializer)
+
+
+def handler_behavior(handler):
+    """The one behavior function set on an RpcMethodHandler"""
+    return handler.unary_unary or handler.unary_stream or handler.stream_unary or handler.stream_stream
+
+
+class WrappedHandlers:
+    """Wrapped RpcMethodHandlers of a server interceptor, built once per method.
+
+    wrap(method, handler, build) returns build(method, handler), reusing the
+    last one built for `method` as long as the inner handler is the same
+    object (the servicer's own, or another interceptor's cached one). A
+    race between two first calls only builds it twice.
+    """
+
+    def __init__(self):
+        self._wrapped = {}
+
+    def wrap(self, method, handler, build):
+        cached = self._wrapped.get(method)
+        if cached is None or cached[0] is not handler:
+            cached = self._wrapped[method] = (handler, build(method, handler))
+        return cached[1]
+
+
+class _ServerSeries:
+    """Metric children of one gRPC method, looked up once rather than on every call"""
+
+    __slots__ = ("method", "seconds", "in_flight", "_handled")
+
+    def __init__(self, method):
+        self.method = method
+        self.seconds = GRPC_SERVER_SECONDS.labels(method)
+        self.in_flight = GRPC_SERVER_IN_FLIGHT.labels(method)
+        self._handled = {}
+
+    def record(self, started, context, error):
+        self.seconds.observe(time.perf_counter() - started)
+        code = status_name(context, error)
+        handled = self._handled.get(code)
+        if handled is None:
+            handled = self._handled[code] = GRPC_SERVER_HANDLED.labels(self.method, code)
+        handled.inc()
+        self.in_flight.dec()
+
+
+def _observe_aio(method, handler):
+    series = _ServerSeries(method)
+    behavior = handler_behavior(handler)
+
+    if handler.response_streaming:
+        async def observed(request, context):
+            series.in_flight.inc()
+            started = time.perf_counter()
+            error = None
+            try:
+                async for response in behavior(request, context):
+                    yield response
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                series.record(started, context, error)
+    else:
+        async def observed(request, context):
+            series.in_flight.inc()
+            started = time.perf_counter()
+            error = None
+            try:
+                return await behavior(request, context)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                series.record(started, context, error)
+
+    return rebuild_handler(handler, observed)
+
+
+def _observe_threaded(method, handler):
+    series = _ServerSeries(method)
+    behavior = handler_behavior(handler)
+
+    if handler.response_streaming:
+        def observed(request, context):
+            series.in_flight.inc()
+            started = time.perf_counter()
+            error = None
+            try:
+                yield from behavior(request, context)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                series.record(started, context, error)
+    else:
+        def observed(request, context):
+            series.in_flight.inc()
+            started = time.perf_counter()
+            error = None
+            try:
+                return behavior(request, context)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                series.record(started, context, error)
+
+    return rebuild_handler(handler, observed)
+
+
+class AioServerMetricsInterceptor(grpc.aio.ServerInterceptor):
+    """Times every call handled by a grpc.aio server"""
+
+    def __init__(self):
+        self._handlers = WrappedHandlers()
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None:
+            return None
+        return self._handlers.wrap(handler_call_details.method, handler, _observe_aio)
+
+
+class ServerMetricsInterceptor(grpc.ServerInterceptor):
+    """Times every call handled by a thread-pool grpc.server"""
+
+    def __init__(self):
+        self._handlers = WrappedHandlers()
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None:
+            return None
+        return self._handlers.wrap(handler_call_details.method, handler, _observe_threaded)
+
+
+class ClientMetricsInterceptor(grpc.aio.UnaryUnaryClientInterceptor):
+    """Times outbound unary calls on a grpc.aio channel and counts them by status code.
+
+    The call is awaited here only to observe its outcome; the caller gets
+    the same call object back and sees the same response or error.
+    """
+
+    async def intercept_unary_unary(self, continuation, client_call_details, request):
+        method = client_call_details.method
+        if isinstance(method, bytes):
+            method = method.decode()
+        started = time.perf_counter()
+        call = await continuation(client_call_details, request)
+        code = "CANCELLED"
+        try:
+            await call
+            code = "OK"
+        except grpc.aio.AioRpcError as e:
+            code = e.code().name
+        finally:
+            GRPC_CLIENT_SECONDS.labels(method).observe(time.perf_counter() - started)
+            GRPC_CLIENT_HANDLED.labels(method, code).inc()
+        return call
@@ -0,0 +1,43 @@
+"""
+Cursor pagination over the id-keyed in-memory tables (common.store.Store)
+"""
+from itertools import islice
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def iter_after(db, after_id=0, limit=0, **filters):
+    """Yield up to `limit` records (0 = all) with id > after_id in id order.
+
+    `db` is a common.store.Store: ids are allocated in increasing order and
+    never deleted, so every page is O(page size) lookups starting right after
+    the cursor. Nothing is copied, and records inserted while iterating are
+    either seen or picked up by the next page.
+
+    Equality `filters` on indexed fields are answered from the Store's
+    secondary indexes instead of scanning.
+    """
+    if filters:
+        yield from db.iter_where(after_id, limit, **filters)
+        return
+    if limit > 0:
+        yield from islice(iter_after(db, after_id), limit)
+        return
+    last_id = db.last_id
+    record_id = max(after_id, 0) + 1
+    while record_id <= last_id:
+        record = db.get(record_id)
+        if record is not None:
+            yield record
+        record_id += 1
+
+
+def page_after(db, after_id=0, limit=DEFAULT_PAGE_SIZE, **filters):
+    """Return (records, next_cursor) for one page; next_cursor is None on the last page"""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    records = list(iter_after(db, after_id, limit + 1, **filters))
+    if len(records) > limit:
+        records = records[:limit]
+        return records, records[-1]["id"]
+    return records, None
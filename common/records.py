@@ -0,0 +1,185 @@
+"""
+Compact record types of the users, products and orders tables.
+
+A dict with string keys costs ~220 bytes per product before its values;
+these are slotted dataclasses (~100 bytes, values included for small
+numbers), so a table of millions of orders needs about half the memory.
+Records still read like the dicts they replace (record["price"],
+record.get(...), dict(record), {**record}), so code written against dict
+rows keeps working, but hot paths should use attributes and the direct
+converters:
+  to_dict()          - plain dict (engines)
+  to_dicts(records)  - plain dicts of a page of records of the class
+  to_json()          - compact JSON bytes of to_dict(), kept on the record
+  to_proto(message)  - protobuf message with the same field names
+common.responses.dumps() joins the to_json() bytes of a page of records
+(json_page) instead of encoding dicts built for the page: a record is
+encoded the first time it is sent and only copied after that.
+
+Records are treated as immutable: Store.update() builds a new one, which
+is also what keeps to_json() current.
+"""
+import json
+from dataclasses import dataclass, fields
+
+try:
+    import orjson
+except ImportError:  # orjson is in requirements.txt; fall back to the stdlib encoder
+    orjson = None
+
+
+def encode_json(value):
+    """Compact JSON bytes of plain `value` (orjson when installed)"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":")).encode()
+
+
+class Record:
+    """Dict-style read access for the slotted record dataclasses below"""
+
+    # to_json() without its leading '{"' and closing '}', set on first use;
+    # not a dataclass field, so it is left out of equality, repr, to_dict()
+    # and pickling
+    __slots__ = ("_json_members",)
+    FIELDS = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # dataclass(slots=True) builds a new class; fields are known only on that one
+        if "__dataclass_fields__" in cls.__dict__:
+            cls.FIELDS = tuple(field.name for field in fields(cls))
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build a record from a dict with exactly the record's fields"""
+        return cls(**data)
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field) from None
+
+    def __contains__(self, field):
+        return field in self.FIELDS
+
+    def get(self, field, default=None):
+        return getattr(self, field, default)
+
+    def keys(self):
+        return self.FIELDS
+
+    def items(self):
+        return [(field, getattr(self, field)) for field in self.FIELDS]
+
+    def replace(self, **changes):
+        """New record with `changes` applied"""
+        return type(self)(**{**self.to_dict(), **changes})
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def to_json(self):
+        """to_dict() as compact JSON bytes, encoded once per record"""
+        members = getattr(self, "_json_members", None)
+        if members is None:
+            self._json_members = members = encode_json(self.to_dict())[2:-1]
+        return b'{"' + members + b'}'
+
+    @staticmethod
+    def to_dicts(records):
+        """Plain dicts of a list of records of this type"""
+        return [record.to_dict() for record in records]
+
+
+@dataclass(slots=True)
+class User(Record):
+    id: int
+    name: str
+    email: str
+
+    def to_dict(self):
+        return {"id": self.id, "name": self.name, "email": self.email}
+
+    @staticmethod
+    def to_dicts(records):
+        return [{"id": r.id, "name": r.name, "email": r.email} for r in records]
+
+    def to_proto(self, message_class):
+        return message_class(id=self.id, name=self.name, email=self.email)
+
+
+@dataclass(slots=True)
+class Product(Record):
+    id: int
+    name: str
+    price: float
+    stock: int
+
+    def to_dict(self):
+        return {"id": self.id, "name": self.name, "price": self.price, "stock": self.stock}
+
+    @staticmethod
+    def to_dicts(records):
+        return [{"id": r.id, "name": r.name, "price": r.price, "stock": r.stock} for r in records]
+
+    def to_proto(self, message_class):
+        return message_class(id=self.id, name=self.name, price=self.price, stock=self.stock)
+
+
+@dataclass(slots=True)
+class Order(Record):
+    id: int
+    user_id: int
+    product_id: int
+    quantity: int
+    total_price: float
+    created_at: float = 0.0  # unix time; 0 for orders stored before it was recorded
+
+    def to_dict(self):
+        return {"id": self.id, "user_id": self.user_id, "product_id": self.product_id,
+                "quantity": self.quantity, "total_price": self.total_price, "created_at": self.created_at}
+
+    @staticmethod
+    def to_dicts(records):
+        return [{"id": r.id, "user_id": r.user_id, "product_id": r.product_id, "quantity": r.quantity,
+                 "total_price": r.total_price, "created_at": r.created_at} for r in records]
+
+    def to_proto(self, message_class):
+        return message_class(id=self.id, user_id=self.user_id, product_id=self.product_id,
+                             quantity=self.quantity, total_price=self.total_price, created_at=self.created_at)
+
+
+def is_page(value):
+    """True for a non-empty list of records (pages hold records of one type,
+    so the first row decides)"""
+    return isinstance(value, list) and bool(value) and isinstance(value[0], Record)
+
+
+def json_page(records):
+    """JSON array bytes of a list of records of one type, joined from the
+    members kept by to_json().
+
+    A page with records not encoded yet is encoded whole from to_dicts()
+    instead and split back into each record's members: records hold only
+    numbers, strings and None, and inside a JSON string every quote is
+    escaped, so '},{"' occurs only between two objects.
+    """
+    try:
+        return b'[{"' + b'},{"'.join([record._json_members for record in records]) + b'}]'
+    except AttributeError:
+        pass
+    encoded = encode_json(type(records[0]).to_dicts(records))
+    members = encoded[3:-2].split(b'},{"')
+    if len(members) == len(records):
+        for record, kept in zip(records, members):
+            record._json_members = kept
+    return encoded
+
+
+def to_jsonable(value):
+    """`default` hook for json/orjson: records become dicts"""
+    if isinstance(value, Record):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
@@ -0,0 +1,194 @@
+"""
+Circuit breaker, retry budget and retry policy of one upstream service.
+
+common.upstream.UpstreamPool applies them to every call, above the
+replicas, so that a retry can go to another replica:
+  - while the upstream's breaker is open, calls fail at once with
+    UNAVAILABLE ("circuit open") instead of waiting for a timeout
+  - idempotent reads (Get*, List*, BatchGet*) that fail with UNAVAILABLE
+    are retried with jittered exponential backoff, within the call's
+    deadline and only while the retry budget has tokens
+  - the outcome of each call, after its retries, feeds the breaker
+
+The pools are only used from the event loop, so none of this is locked.
+"""
+import os
+import random
+import time
+
+import grpc
+
+from common.metrics import REGISTRY, Counter, Gauge
+
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "5.0"))
+GRPC_MAX_RETRIES = int(os.getenv("GRPC_MAX_RETRIES", "2"))
+GRPC_RETRY_BACKOFF = float(os.getenv("GRPC_RETRY_BACKOFF", "0.05"))
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.1"))
+
+# Status codes that say the upstream is unhealthy (count against the breaker)
+FAILURE_CODES = frozenset({
+    grpc.StatusCode.UNAVAILABLE,
+    grpc.StatusCode.DEADLINE_EXCEEDED,
+    grpc.StatusCode.RESOURCE_EXHAUSTED,
+    grpc.StatusCode.INTERNAL,
+    grpc.StatusCode.UNKNOWN,
+})
+# Status codes after which a read is retried
+RETRY_CODES = frozenset({grpc.StatusCode.UNAVAILABLE})
+# RPC name prefixes that are safe to send twice
+IDEMPOTENT_PREFIXES = ("Get", "List", "BatchGet")
+
+BREAKER_STATE = REGISTRY.register(Gauge(
+    "grpc_client_breaker_state", "Circuit breaker state per upstream (0 closed, 1 half-open, 2 open)",
+    ("upstream",)))
+FAST_FAILED = REGISTRY.register(Counter(
+    "grpc_client_fast_failed_total", "Outbound calls rejected by an open circuit breaker", ("upstream",)))
+RETRIES = REGISTRY.register(Counter(
+    "grpc_client_retries_total", "Outbound call retries by upstream and method", ("upstream", "method")))
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker for one upstream.
+
+    closed    - calls pass; `failure_threshold` failures in a row open it
+    open      - calls are refused for `reset_timeout` seconds
+    half_open - one probe call passes; success closes, failure re-opens
+    A probe that never reports back (cancelled caller) is replaced after
+    another `reset_timeout`.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+    _STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout=BREAKER_RESET_TIMEOUT, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.times_opened = 0
+        self.rejected = 0
+        self._probe_started = None
+        BREAKER_STATE.labels(name).set(0)
+
+    def allow(self):
+        """True if a call may go out now"""
+        if self.state == self.CLOSED:
+            return True
+        now = self._clock()
+        if self.state == self.OPEN:
+            if now - self.opened_at < self.reset_timeout:
+                return False
+            self._set_state(self.HALF_OPEN)
+        if self._probe_started is None or now - self._probe_started >= self.reset_timeout:
+            self._probe_started = now
+            return True
+        return False
+
+    def reject(self):
+        """Count a call refused because the breaker is open"""
+        self.rejected += 1
+        FAST_FAILED.labels(self.name).inc()
+
+    def retry_after(self):
+        """Seconds until an open breaker lets a probe through (0 when calls may go out)"""
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout - self._clock())
+
+    def record_success(self):
+        self.failures = 0
+        self._probe_started = None
+        if self.state != self.CLOSED:
+            self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe_started = None
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+            self.opened_at = self._clock()
+            self.times_opened += 1
+            self._set_state(self.OPEN)
+
+    def _set_state(self, state):
+        self.state = state
+        BREAKER_STATE.labels(self.name).set(self._STATE_VALUES[state])
+
+    def snapshot(self):
+        """State for the /breakers endpoint"""
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "failure_threshold": self.failure_threshold,
+            "reset_timeout": self.reset_timeout,
+            "retry_in": round(self.retry_after(), 3) if self.state == self.OPEN else None,
+            "times_opened": self.times_opened,
+            "rejected": self.rejected,
+        }
+
+
+class RetryBudget:
+    """Caps retries at a fraction of recent calls.
+
+    Each call adds `ratio` of a token (up to `max_tokens`) and
+    `min_per_second` tokens trickle in over time; a retry spends one token.
+    When an upstream is failing hard the budget runs dry, so retries cannot
+    multiply the load on it.
+    """
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, min_per_second=1.0, max_tokens=10.0, clock=time.monotonic):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._clock = clock
+        self.tokens = max_tokens
+        self._updated = clock()
+
+    def deposit(self):
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        """Spend a token for one retry; False if the budget is exhausted"""
+        now = self._clock()
+        self.tokens = min(self.max_tokens, self.tokens + (now - self._updated) * self.min_per_second)
+        self._updated = now
+        if self.tokens < 1.0:
+            return False
+        self.tokens -= 1.0
+        return True
+
+
+class CircuitOpenError(grpc.aio.AioRpcError):
+    """UNAVAILABLE error of a call refused by an open breaker (never sent)"""
+
+    def __init__(self, upstream):
+        super().__init__(
+            code=grpc.StatusCode.UNAVAILABLE,
+            initial_metadata=grpc.aio.Metadata(),
+            trailing_metadata=grpc.aio.Metadata(),
+            details=f"circuit open for {upstream}",
+        )
+
+
+def is_idempotent(method):
+    """True for read RPCs ("/user.UserService/GetUser" -> "GetUser")"""
+    return method.rpartition("/")[2].startswith(IDEMPOTENT_PREFIXES)
+
+
+class RetryPolicy:
+    """When and how soon a failed call to one upstream is sent again"""
+
+    def __init__(self, budget=None, max_retries=GRPC_MAX_RETRIES, backoff=GRPC_RETRY_BACKOFF):
+        self.budget = budget or RetryBudget()
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+    def delay(self, method, code, attempt):
+        """Jittered backoff before retry number `attempt` + 1, or None if the call must not be retried"""
+        if code not in RETRY_CODES or attempt >= self.max_retries or not is_idempotent(method):
+            return None
+        return random.uniform(0, self.backoff * 2 ** attempt)
@@ -0,0 +1,147 @@
+"""
+Pre-serialized JSON responses with ETag / If-None-Match support, and
+protobuf content negotiation.
+
+Endpoints that return one of the .proto list messages (UserList,
+ProductList, OrderList, ...) pass a `to_message(content)` converter; a
+client sending `Accept: application/x-protobuf` (ranked above
+application/json) then gets that message serialized instead of JSON,
+with the page cursor in an X-Next-Cursor header (absent on the last
+page). These responses carry `Vary: Accept`.
+"""
+import hashlib
+import json
+import os
+
+from fastapi import Response
+
+from common.cache import TTLCache
+from common.records import Record, is_page, json_page, to_jsonable
+
+try:
+    import orjson
+except ImportError:  # orjson is in requirements.txt; fall back to the stdlib encoder
+    orjson = None
+
+# Cached response bodies per service (0 disables the cache)
+RESPONSE_CACHE_ENTRIES = int(os.getenv("RESPONSE_CACHE_ENTRIES", "1024"))
+
+JSON = "application/json"
+PROTOBUF = "application/x-protobuf"
+
+
+def dumps(content):
+    """Encode `content` as compact JSON bytes (orjson when installed).
+
+    Records (common.records) and pages of them, at the top level or one
+    dict level down (a body such as {"data": [records], "next_cursor": ...}),
+    are spliced in from their to_json() bytes rather than encoded again.
+    """
+    if isinstance(content, dict):
+        if not any(isinstance(value, Record) or is_page(value) for value in content.values()):
+            return _encode(content)
+        return b"{" + b",".join([_encode(key) + b":" + _encode_value(value)
+                                 for key, value in content.items()]) + b"}"
+    return _encode_value(content)
+
+
+def _encode_value(value):
+    if isinstance(value, Record):
+        return value.to_json()
+    if is_page(value):
+        return json_page(value)
+    return _encode(value)
+
+
+def _encode(value):
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_PASSTHROUGH_DATACLASS, default=to_jsonable)
+    return json.dumps(value, separators=(",", ":"), default=to_jsonable).encode()
+
+
+def accepts_protobuf(accept):
+    """True if an Accept header value ranks application/x-protobuf above application/json
+    (wildcards and ties give JSON)"""
+    if not accept or PROTOBUF not in accept:
+        return False
+    quality = {}
+    for item in accept.split(","):
+        media_type, *params = item.split(";")
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        media_type = media_type.strip().lower()
+        quality[media_type] = max(q, quality.get(media_type, 0.0))
+    return quality.get(PROTOBUF, 0.0) > quality.get(JSON, 0.0)
+
+
+def encode(content, to_message=None, protobuf=False):
+    """(body, media type, headers) of `content`: JSON, or to_message(content) serialized when `protobuf`"""
+    if not protobuf:
+        return dumps(content), JSON, {}
+    headers = {}
+    if content.get("next_cursor") is not None:
+        headers["X-Next-Cursor"] = str(content["next_cursor"])
+    return to_message(content).SerializeToString(), PROTOBUF, headers
+
+
+def negotiate(request, content, to_message):
+    """Uncached response for `content` in the format the request's Accept header asks for"""
+    body, media_type, headers = encode(content, to_message, accepts_protobuf(request.headers.get("accept")))
+    return Response(content=body, media_type=media_type, headers={**headers, "Vary": "Accept"})
+
+
+def etag_matches(if_none_match, etag):
+    """True if an If-None-Match header value names `etag` (or is "*")"""
+    if not if_none_match:
+        return False
+    return any(tag.strip() in (etag, "W/" + etag, "*") for tag in if_none_match.split(","))
+
+
+class ResponseCache:
+    """Serialized JSON bodies keyed by request, each tagged with a version stamp.
+
+    The stamp is whatever the body was built from: Store.version for a list
+    page, the record itself for a single-item read. A cached body is reused
+    only while the current stamp still equals the stored one, so any write to
+    the store invalidates it without explicit bookkeeping. The ETag is a hash
+    of the body, so it stays valid across restarts.
+    """
+
+    def __init__(self, maxsize=RESPONSE_CACHE_ENTRIES):
+        self._entries = TTLCache(maxsize=maxsize, ttl=float("inf"))
+
+    def respond(self, request, key, stamp, build, to_message=None):
+        """Return the response for `key`, calling `build()` only when `stamp` changed.
+
+        `stamp` must be read before `build()` runs, so a write racing the build
+        leaves an entry that is rebuilt on the next request. Answers 304 when
+        the request's If-None-Match already names the current body. With
+        `to_message`, JSON and protobuf bodies are cached separately.
+        """
+        protobuf = to_message is not None and accepts_protobuf(request.headers.get("accept"))
+        if protobuf:
+            key = (PROTOBUF, key)
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != stamp:
+            body, media_type, headers = encode(build(), to_message, protobuf)
+            headers["ETag"] = '"%s"' % hashlib.blake2b(body, digest_size=12).hexdigest()
+            if to_message is not None:
+                headers["Vary"] = "Accept"
+            entry = (stamp, body, media_type, headers)
+            self._entries.set(key, entry)
+        _, body, media_type, headers = entry
+        if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type=media_type, headers=headers)
+
+    def stats(self):
+        """Counters for the /cache-stats endpoint"""
+        stats = self._entries.stats()
+        del stats["ttl"], stats["expirations"]
+        return stats
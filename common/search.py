@@ -0,0 +1,284 @@
+"""
+In-memory search over a Store: text on one field, a range on another.
+
+SearchIndex subscribes to the Store (Store.subscribe), so every insert
+and update, from any endpoint or worker, is indexed as it happens.
+
+Text is normalized with NFKC and casefold, so full-width letters, ligatures
+and case variants match ("ＡＢＣ", "abc"), and Thai, which has no case, is
+compared code point for code point after NFKC. Words are split on
+whitespace, punctuation and symbols only; combining marks (Thai tone marks
+and vowels above/below) stay part of their word, unlike with \\w.
+
+  substring - a query of 3+ characters is looked up in a trigram index
+              (trigram -> ids in id order); the ids of its rarest trigram
+              are then checked against the normalized text
+  prefix    - matches when a word of the text starts with the query; the
+              first one and two characters of every word are indexed too,
+              so queries shorter than 3 characters always match this way
+Ranges use a sorted (value, id) list kept in chunks, so an insert costs
+O(log n + chunk size) instead of moving the whole list.
+
+A search scans whichever candidate set is smallest: the rarest trigram's
+ids, the ids in the value range (collected, then sorted), or, for a wide
+range, the table in id order. Results are in id order and paginate with
+an id cursor like the list endpoints.
+"""
+import re
+import threading
+import unicodedata
+from array import array
+from bisect import bisect_left, bisect_right, insort
+
+from common.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+
+SEARCH_CHUNK_SIZE = 512
+GRAM = 3
+
+
+def _mark_ranges():
+    """Character-class ranges of the combining marks in the BMP"""
+    ranges = []
+    start = None
+    for code in range(0x10000):
+        if unicodedata.category(chr(code))[0] == "M":
+            if start is None:
+                start = code
+        elif start is not None:
+            ranges.append(f"\\u{start:04x}-\\u{code - 1:04x}")
+            start = None
+    return "".join(ranges)
+
+
+# Runs of anything that is neither a word character nor a combining mark
+SEPARATORS = re.compile(f"[^\\w{_mark_ranges()}]+")
+
+
+def normalize(text):
+    """Comparable form of `text`: NFKC, casefolded, words joined by single spaces"""
+    return " ".join(SEPARATORS.split(unicodedata.normalize("NFKC", text).casefold())).strip()
+
+
+def trigrams(normalized):
+    return {normalized[i:i + GRAM] for i in range(len(normalized) - GRAM + 1)}
+
+
+def text_keys(normalized):
+    """Index keys of a normalized text: its trigrams and its words' first 1 and 2 characters ("\\0"-prefixed)"""
+    keys = trigrams(normalized)
+    for word in normalized.split(" "):
+        keys.add("\0" + word[:1])
+        keys.add("\0" + word[:2])
+    return keys
+
+
+class SortedList:
+    """Sorted list split into chunks of about SEARCH_CHUNK_SIZE items"""
+
+    def __init__(self, items=(), chunk_size=SEARCH_CHUNK_SIZE):
+        self._chunk_size = chunk_size
+        items = sorted(items)
+        self._chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+        self._maxes = [chunk[-1] for chunk in self._chunks]
+        self._len = len(items)
+
+    def __len__(self):
+        return self._len
+
+    def add(self, item):
+        if not self._chunks:
+            self._chunks.append([item])
+            self._maxes.append(item)
+            self._len = 1
+            return
+        i = min(bisect_left(self._maxes, item), len(self._chunks) - 1)
+        chunk = self._chunks[i]
+        insort(chunk, item)
+        self._maxes[i] = chunk[-1]
+        self._len += 1
+        if len(chunk) > 2 * self._chunk_size:
+            half = len(chunk) // 2
+            self._chunks[i:i + 1] = [chunk[:half], chunk[half:]]
+            self._maxes[i:i + 1] = [chunk[half - 1], chunk[-1]]
+
+    def remove(self, item):
+        i = bisect_left(self._maxes, item)
+        chunk = self._chunks[i] if i < len(self._chunks) else []
+        j = bisect_left(chunk, item)
+        if j == len(chunk) or chunk[j] != item:
+            raise ValueError(f"{item!r} not in list")
+        del chunk[j]
+        self._len -= 1
+        if chunk:
+            self._maxes[i] = chunk[-1]
+        else:
+            del self._chunks[i]
+            del self._maxes[i]
+
+    def _position(self, item, bisect):
+        """(chunk index, index in chunk) where `item` would go"""
+        i = bisect_left(self._maxes, item)
+        if i == len(self._chunks):
+            return i, 0
+        return i, bisect(self._chunks[i], item)
+
+    def count(self, low, high):
+        """Number of items with low <= item <= high"""
+        start_chunk, start = self._position(low, bisect_left)
+        end_chunk, end = self._position(high, bisect_right)
+        if start_chunk >= end_chunk or start_chunk == len(self._chunks):
+            return max(0, end - start) if start_chunk == end_chunk else 0
+        return (len(self._chunks[start_chunk]) - start + end
+                + sum(len(chunk) for chunk in self._chunks[start_chunk + 1:end_chunk]))
+
+    def irange(self, low, high):
+        """Items with low <= item <= high, in order"""
+        i, j = self._position(low, bisect_left)
+        while i < len(self._chunks):
+            chunk = self._chunks[i]
+            while j < len(chunk):
+                if chunk[j] > high:
+                    return
+                yield chunk[j]
+                j += 1
+            i += 1
+            j = 0
+
+
+class SearchIndex:
+    """Text index on `text_field` and range index on `range_field` of a Store (see module docstring)"""
+
+    def __init__(self, store, text_field, range_field):
+        self.store = store
+        self.text_field = text_field
+        self.range_field = range_field
+        self._lock = threading.Lock()
+        self._postings = {}
+        self._texts = {}
+        self._values = {}
+        self._sorted = SortedList()
+        # Writes made while the snapshot is indexed are queued and applied after it
+        self._pending = []
+        records = store.subscribe(self._on_write)
+        self._load(records)
+        with self._lock:
+            for old, record in self._pending:
+                self._apply(old, record)
+            self._pending = None
+
+    def __len__(self):
+        return len(self._texts)
+
+    def _load(self, records):
+        """Index `records` (id order) in bulk"""
+        postings = self._postings
+        text_field, range_field = self.text_field, self.range_field
+        for record in records:
+            record_id = record["id"]
+            text = self._texts[record_id] = normalize(record[text_field])
+            self._values[record_id] = record[range_field]
+            for key in text_keys(text):
+                ids = postings.get(key)
+                if ids is None:
+                    ids = postings[key] = array("i")
+                ids.append(record_id)
+        self._sorted = SortedList((value, record_id) for record_id, value in self._values.items())
+
+    def _on_write(self, old, record):
+        if old is not None and old[self.text_field] == record[self.text_field] \
+                and old[self.range_field] == record[self.range_field]:
+            return
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((old, record))
+                return
+            self._apply(old, record)
+
+    def _apply(self, old, record):
+        record_id = record["id"]
+        if record_id in self._texts:
+            self._remove(record_id)
+        text = self._texts[record_id] = normalize(record[self.text_field])
+        value = self._values[record_id] = record[self.range_field]
+        for key in text_keys(text):
+            ids = self._postings.get(key)
+            if ids is None:
+                ids = self._postings[key] = array("i")
+            if not ids or ids[-1] < record_id:
+                ids.append(record_id)
+            else:
+                insort(ids, record_id)
+        self._sorted.add((value, record_id))
+
+    def _remove(self, record_id):
+        for key in text_keys(self._texts.pop(record_id)):
+            ids = self._postings[key]
+            del ids[bisect_left(ids, record_id)]
+            if not ids:
+                del self._postings[key]
+        self._sorted.remove((self._values.pop(record_id), record_id))
+
+    def search(self, query="", prefix=False, low=None, high=None, after_id=0, limit=20):
+        """Up to `limit` records with id > after_id whose text matches `query`
+        (substring, or word prefix with `prefix`) and whose range field is in
+        [low, high] (None = unbounded), in id order. A query with nothing left
+        after normalize() (only punctuation or spaces) matches nothing."""
+        text = normalize(query) if query else ""
+        if query and not text:
+            return []
+        bounded = low is not None or high is not None
+        low = float("-inf") if low is None else low
+        high = float("inf") if high is None else high
+        by_prefix = prefix or len(text) < GRAM
+
+        # A shared store replays other workers' writes (and so calls _on_write) on access
+        self.store.version
+        last_id = self.store.last_id
+        found = []
+        with self._lock:
+            texts, values = self._texts, self._values
+            postings = None
+            if text:
+                keys = trigrams(text) if len(text) >= GRAM else ["\0" + text]
+                lists = [self._postings.get(key) for key in keys]
+                if not all(lists):
+                    return []
+                postings = min(lists, key=len)
+            in_range = self._sorted.count((low, 0), (high, float("inf"))) if bounded else 0
+
+            if bounded and (in_range < len(postings) if postings is not None
+                            else in_range * in_range <= 8 * (limit + 1) * max(1, len(texts))):
+                # Few values in range: collect their ids and sort them
+                candidates = sorted(record_id for _, record_id in self._sorted.irange((low, 0), (high, float("inf")))
+                                    if record_id > after_id)
+            elif postings is not None:
+                candidates = (postings[i] for i in range(bisect_right(postings, after_id), len(postings)))
+            else:
+                # Wide range: walk the table in id order, most rows match
+                candidates = range(after_id + 1, last_id + 1)
+
+            for record_id in candidates:
+                name = texts.get(record_id)
+                if name is None:
+                    continue
+                if text:
+                    if by_prefix:
+                        if not (name.startswith(text) or " " + text in name):
+                            continue
+                    elif text not in name:
+                        continue
+                if bounded and not low <= values[record_id] <= high:
+                    continue
+                found.append(record_id)
+                if len(found) == limit:
+                    break
+        return [self.store[record_id] for record_id in found]
+
+    def page(self, query="", prefix=False, low=None, high=None, after_id=0, limit=DEFAULT_PAGE_SIZE):
+        """Return (records, next_cursor) for one page of search(); next_cursor is None on the last page"""
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        records = self.search(query, prefix, low, high, after_id, limit + 1)
+        if len(records) > limit:
+            records = records[:limit]
+            return records, records[-1]["id"]
+        return records, None
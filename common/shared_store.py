@@ -0,0 +1,297 @@
+"""
+Table shared by the worker processes of one service (STORE_ENGINE=shared).
+
+Each table is an append-only log of records in a memory-mapped file under
+STORE_SHARED_DIR (/dev/shm by default, i.e. RAM). Every process keeps the
+usual dict and indexes of common.store.Store and, before each read, replays
+the log entries it has not seen yet; checking for new entries is two
+integer reads from the mapping. Writes catch up and append under a
+cross-process lock, so ids never collide and a read sees every write that
+finished before it started, whichever worker made it. Listeners added with
+subscribe() hear about the other workers' writes as they are replayed.
+
+Files per table:
+  <table>.shm        - number of the current log generation; also the lock file
+  <table>.locks      - one byte per key_locks() stripe, locked with lockf()
+  <table>.<gen>.log  - header (magic, end offset, version), then entries of a
+                       4-byte length and a JSON record; a record written again
+                       supersedes its earlier copies, and {"id": .., "__deleted__":
+                       true} removes it
+When a log is full (STORE_SHARED_SIZE bytes, allocated sparsely) the writer
+compacts it into the next generation, one entry per record, and the other
+processes reload from the new file.
+
+The files outlive the processes (until they are deleted or /dev/shm is
+cleared), so a restarted service picks up where it stopped; `rows` only
+seed a table that does not exist yet.
+"""
+import fcntl
+import json
+import mmap
+import os
+import struct
+import threading
+from bisect import insort
+from contextlib import contextmanager
+
+from common.locks import StripedLock
+from common.records import to_jsonable
+from common.store import Store
+
+STORE_SHARED_DIR = os.getenv("STORE_SHARED_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else "data")
+STORE_SHARED_SIZE = int(os.getenv("STORE_SHARED_SIZE", str(64 * 1024 * 1024)))
+
+MAGIC = b"SHSTORE1"
+ROOT = struct.Struct("<8sQ")  # magic, generation
+HEADER = struct.Struct("<8sQQ")  # magic, end offset, version
+HEADER_SIZE = 64
+FIELD = struct.Struct("<Q")  # one header field: generation/end at 8, version at 16
+LENGTH = struct.Struct("<I")
+DELETED = "__deleted__"
+
+
+class SharedStore(Store):
+    """Store whose contents are shared through a memory-mapped log (see module docstring)"""
+
+    def __init__(self, table, rows=None, indexes=(), directory=STORE_SHARED_DIR, size=STORE_SHARED_SIZE,
+                 record_type=dict):
+        super().__init__(indexes=indexes, record_type=record_type)
+        self.table = table
+        self._directory = directory
+        self._size = size
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._generation = 0
+        self._log = None
+        self._offset = HEADER_SIZE
+        self._previous = {}
+        os.makedirs(directory, exist_ok=True)
+        self._root_fd = os.open(os.path.join(directory, f"{table}.shm"), os.O_RDWR | os.O_CREAT, 0o600)
+        with self._locked(fcntl.LOCK_EX):
+            if os.fstat(self._root_fd).st_size < ROOT.size:
+                os.ftruncate(self._root_fd, ROOT.size)
+                self._root = mmap.mmap(self._root_fd, ROOT.size)
+                self._write_generation(1, sorted((rows or {}).values(), key=lambda r: r["id"]), 0)
+            else:
+                self._root = mmap.mmap(self._root_fd, ROOT.size)
+                if ROOT.unpack_from(self._root)[0] != MAGIC:
+                    raise ValueError(f"{table}.shm in {directory} is not a shared store file")
+            self._sync_locked()
+
+    # ---- locking and catching up
+
+    @contextmanager
+    def _locked(self, mode):
+        """Hold the process-local lock and, outermost, the cross-process file lock"""
+        with self._lock:
+            outer = self._depth == 0
+            if outer:
+                fcntl.lockf(self._root_fd, mode)
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if outer:
+                    fcntl.lockf(self._root_fd, fcntl.LOCK_UN)
+
+    @contextmanager
+    def exclusive(self):
+        """Hold the table's write lock across all processes, caught up with every write"""
+        with self._locked(fcntl.LOCK_EX):
+            self._sync_locked()
+            yield
+
+    def key_locks(self, stripes=64):
+        """StripedLock whose stripes also lock out the other processes (byte ranges of <table>.locks)"""
+        return StripedLock(stripes, os.path.join(self._directory, f"{self.table}.locks"))
+
+    def _sync(self):
+        """Apply the writes other processes made since the last call"""
+        if (FIELD.unpack_from(self._root, 8)[0] == self._generation
+                and FIELD.unpack_from(self._log, 8)[0] == self._offset):
+            return
+        with self._locked(fcntl.LOCK_SH):
+            self._sync_locked()
+
+    def _sync_locked(self):
+        generation = FIELD.unpack_from(self._root, 8)[0]
+        if generation != self._generation:
+            self._open_generation(generation)
+        end = FIELD.unpack_from(self._log, 8)[0]
+        log = self._log
+        position = self._offset
+        while position < end:
+            (length,) = LENGTH.unpack_from(log, position)
+            position += LENGTH.size
+            data = json.loads(log[position:position + length])
+            if DELETED in data:
+                self._remove(data["id"])
+            else:
+                self._apply(self._record_type(**data))
+            position += length
+        self._offset = end
+        self._version = FIELD.unpack_from(log, 16)[0]
+        self._previous = {}
+
+    def _apply(self, record):
+        """Insert or replace one record in the local dict and indexes, and tell the
+        listeners (whichever process wrote it)"""
+        record_id = record["id"]
+        old = self._rows.get(record_id)
+        self._rows[record_id] = record
+        if old is None:
+            self._index_add(record)
+            self._next_id = max(self._next_id, record_id + 1)
+        else:
+            for field, index in self._indexes.items():
+                if old[field] != record[field]:
+                    index[old[field]].remove(record_id)
+                    insort(index.setdefault(record[field], []), record_id)
+        if self._listeners:
+            # After a compaction every record is replayed; only report real changes
+            before = old if old is not None else self._previous.get(record_id)
+            if before != record:
+                self._notify(before, record)
+
+    def _remove(self, record_id):
+        record = self._rows.pop(record_id, None)
+        if record is not None:
+            self._index_remove(record)
+
+    # ---- log files
+
+    def _log_path(self, generation):
+        return os.path.join(self._directory, f"{self.table}.{generation}.log")
+
+    def _open_generation(self, generation):
+        """Map the log of `generation` and rebuild the local copy from scratch"""
+        with open(self._log_path(generation), "r+b") as f:
+            self._log = mmap.mmap(f.fileno(), 0)
+        self._generation = generation
+        self._offset = HEADER_SIZE
+        self._previous = self._rows
+        self._rows = {}
+        self._indexes = {field: {} for field in self._indexes}
+        self._next_id = 1
+
+    def _write_generation(self, generation, records, version, extra=0):
+        """Write `records` into a fresh log and make it current (caller holds the write lock)"""
+        entries = [_encode(record) for record in records]
+        end = HEADER_SIZE + sum(len(entry) for entry in entries)
+        if end + extra > self._size:
+            raise RuntimeError(f"Shared store {self.table} is full ({self._size} bytes); raise STORE_SHARED_SIZE")
+        path = self._log_path(generation)
+        with open(path, "w+b") as f:
+            f.truncate(self._size)
+            log = mmap.mmap(f.fileno(), 0)
+        log[HEADER_SIZE:end] = b"".join(entries)
+        HEADER.pack_into(log, 0, MAGIC, end, version)
+        old_path = self._log_path(self._generation) if self._generation else None
+        ROOT.pack_into(self._root, 0, MAGIC, generation)
+        if old_path and old_path != path:
+            os.unlink(old_path)
+
+    def _append(self, records):
+        """Append records to the log and apply them locally (caller holds the write lock)"""
+        entries = [_encode(record) for record in records]
+        size = sum(len(entry) for entry in entries)
+        if self._offset + size > len(self._log):
+            self._write_generation(self._generation + 1, list(self._rows.values()), self._version, size)
+            self._sync_locked()
+        start, end = self._offset, self._offset + size
+        self._log[start:end] = b"".join(entries)
+        HEADER.pack_into(self._log, 0, MAGIC, end, self._version + 1)
+        for record in records:
+            if isinstance(record, _Deletion):
+                self._remove(record["id"])
+            else:
+                self._apply(record)
+        self._offset = end
+        self._version += 1
+
+    # ---- Store interface
+
+    def insert(self, fields):
+        return self.insert_many([fields])[0]
+
+    def insert_many(self, fields_list):
+        with self.exclusive():
+            records = []
+            for fields in fields_list:
+                records.append(self._record_type(id=self._next_id + len(records), **fields))
+            if records:
+                self._append(records)
+        return records
+
+    def update(self, record_id, **changes):
+        with self.exclusive():
+            record = self._record_type(**{**self._rows[record_id], **changes})
+            self._append([record])
+        return record
+
+    def delete_many(self, record_ids):
+        with self.exclusive():
+            if self._listeners:
+                raise RuntimeError("Cannot delete from a store with listeners")
+            present = [record_id for record_id in dict.fromkeys(record_ids) if record_id in self._rows]
+            if present:
+                self._append([_Deletion({"id": record_id, DELETED: True}) for record_id in present])
+        return len(present)
+
+    def subscribe(self, listener):
+        with self.exclusive():
+            self._listeners.append(listener)
+            return list(self._rows.values())
+
+    def unsubscribe(self, listener):
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def iter_where(self, after_id=0, limit=0, **filters):
+        self._sync()
+        yield from super().iter_where(after_id, limit, **filters)
+
+    @property
+    def version(self):
+        self._sync()
+        return self._version
+
+    @property
+    def last_id(self):
+        self._sync()
+        return self._next_id - 1
+
+    def get(self, record_id, default=None):
+        self._sync()
+        return self._rows.get(record_id, default)
+
+    def __getitem__(self, record_id):
+        self._sync()
+        return self._rows[record_id]
+
+    def __contains__(self, record_id):
+        self._sync()
+        return record_id in self._rows
+
+    def __len__(self):
+        self._sync()
+        return len(self._rows)
+
+    def keys(self):
+        self._sync()
+        return list(self._rows)
+
+    def values(self):
+        self._sync()
+        return list(self._rows.values())
+
+
+def _encode(record):
+    data = json.dumps(record, ensure_ascii=False, default=to_jsonable).encode()
+    return LENGTH.pack(len(data)) + data
+
+
+class _Deletion(dict):
+    """Log entry removing record `id` (see delete_many)"""
@@ -0,0 +1,150 @@
+"""
+Persistence engines behind common.store.Store.
+
+STORE_ENGINE selects the engine:
+  memory - nothing is persisted (default)
+  sqlite - one SQLite file per table in STORE_DIR, WAL journal, group commits
+  shared - memory-mapped log shared by worker processes (common.shared_store;
+           not an engine here, open_store() builds a SharedStore instead)
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from common.records import to_jsonable
+
+STORE_ENGINE = os.getenv("STORE_ENGINE", "memory")
+STORE_DIR = os.getenv("STORE_DIR", "data")
+STORE_COMMIT_INTERVAL = float(os.getenv("STORE_COMMIT_INTERVAL", "0.05"))
+STORE_COMMIT_BATCH = int(os.getenv("STORE_COMMIT_BATCH", "1000"))
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryEngine:
+    """Engine that keeps nothing; the Store's dict is the only copy"""
+
+    def load(self):
+        return []
+
+    def write(self, record):
+        pass
+
+    def delete(self, record_id):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteEngine:
+    """Write-behind SQLite engine with grouped commits.
+
+    write() and delete() only queue the change; a background thread commits everything
+    queued in one transaction every `commit_interval` seconds, or as soon as
+    `commit_batch` records are waiting. The database runs in WAL mode with
+    synchronous=NORMAL, so a commit is an append to the write-ahead log.
+    Writes acknowledged less than `commit_interval` before a crash can be
+    lost; flush() and close() force them out.
+    """
+
+    def __init__(self, path, table, commit_interval=STORE_COMMIT_INTERVAL, commit_batch=STORE_COMMIT_BATCH):
+        self.path = path
+        self.table = table
+        self.commit_interval = commit_interval
+        self.commit_batch = commit_batch
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._conn_lock = threading.Lock()
+        self._closed = False
+        self._flusher = threading.Thread(target=self._run, name=f"store-{table}-flusher", daemon=True)
+        self._flusher.start()
+
+    def load(self):
+        """Read every stored record in id order (warm start)"""
+        with self._conn_lock:
+            rows = self._conn.execute(f"SELECT data FROM {self.table} ORDER BY id").fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def write(self, record):
+        """Queue an insert or replacement of `record` for the next group commit"""
+        with self._cond:
+            self._pending[record["id"]] = record
+            if len(self._pending) >= self.commit_batch:
+                self._cond.notify()
+
+    def delete(self, record_id):
+        """Queue the removal of record `record_id` for the next group commit"""
+        with self._cond:
+            self._pending[record_id] = None
+            if len(self._pending) >= self.commit_batch:
+                self._cond.notify()
+
+    def flush(self):
+        """Commit everything queued so far"""
+        # Holding the connection lock across the swap keeps batches in order
+        with self._conn_lock:
+            with self._cond:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return
+            params = [(record_id, json.dumps(record, ensure_ascii=False, default=to_jsonable))
+                      for record_id, record in batch.items() if record is not None]
+            deleted = [(record_id,) for record_id, record in batch.items() if record is None]
+            try:
+                self._conn.execute("BEGIN")
+                self._conn.executemany(f"INSERT OR REPLACE INTO {self.table} (id, data) VALUES (?, ?)", params)
+                self._conn.executemany(f"DELETE FROM {self.table} WHERE id = ?", deleted)
+                self._conn.execute("COMMIT")
+            except Exception:
+                if self._conn.in_transaction:
+                    self._conn.execute("ROLLBACK")
+                # Put the batch back unless a newer version was queued meanwhile
+                with self._cond:
+                    for record_id, record in batch.items():
+                        self._pending.setdefault(record_id, record)
+                raise
+
+    def close(self):
+        """Stop the flusher thread, commit pending writes and close the file"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._flusher.join()
+        self.flush()
+        with self._conn_lock:
+            self._conn.close()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and len(self._pending) < self.commit_batch:
+                    self._cond.wait(self.commit_interval)
+                if self._closed:
+                    return
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Failed to commit {self.table}: {e}")
+
+
+def create_engine(table, engine=None):
+    """Build the engine selected by STORE_ENGINE (or `engine`) for one table"""
+    engine = engine or STORE_ENGINE
+    if engine == "memory":
+        return MemoryEngine()
+    if engine == "sqlite":
+        return SQLiteEngine(os.path.join(STORE_DIR, f"{table}.db"), table)
+    raise ValueError(f"Unknown STORE_ENGINE: {engine}")
@@ -0,0 +1,234 @@
+"""
+In-memory id-keyed table shared by the services
+"""
+import threading
+from bisect import bisect_right, insort
+
+from common.locks import StripedLock
+from common.storage import STORE_ENGINE, MemoryEngine, create_engine
+
+
+class Store:
+    """Dict-like table of records keyed by an auto-allocated integer id.
+
+    Ids come from a sequence guarded by a lock, so inserts are O(1) and two
+    writers (REST loop, gRPC worker threads) can never get the same id. Rows
+    are kept in id order, which the cursor pagination relies on. Reads are
+    plain dict lookups and need no lock.
+
+    Every insert/update is also handed to the persistence `engine` (see
+    common.storage). On start the rows come from the engine; `rows` only
+    seed a table the engine has never seen.
+
+    Records are built with `record_type(**fields)`: a dict by default, or
+    one of the compact classes in common.records. Rows coming from the
+    engine or from `rows` are converted the same way.
+
+    Fields named in `indexes` get a secondary index (value -> ids in id
+    order) so iter_where() costs time proportional to the result size.
+
+    `version` goes up on every write, so cached views of the table (see
+    common.responses) can tell whether they are stale.
+
+    Listeners added with subscribe() are called as listener(old, record)
+    for every insert (old is None) and update, under the write lock, so
+    they must be quick and must not write to the store.
+    """
+
+    def __init__(self, rows=None, engine=None, indexes=(), record_type=dict):
+        self._rows = {}
+        self._record_type = record_type
+        # Reentrant, so writes can be made inside exclusive()
+        self._lock = threading.RLock()
+        self._next_id = 1
+        self._version = 0
+        self._engine = engine or MemoryEngine()
+        self._indexes = {field: {} for field in indexes}
+        self._listeners = []
+        stored = self._engine.load()
+        for data in stored or sorted((rows or {}).values(), key=lambda r: r["id"]):
+            record = record_type(**data)
+            self._rows[record["id"]] = record
+            self._index_add(record)
+            self._next_id = max(self._next_id, record["id"] + 1)
+            if not stored:
+                self._engine.write(record)
+
+    def insert(self, fields):
+        """Allocate the next id, store record_type(id=id, **fields) and return the record"""
+        with self._lock:
+            record = self._record_type(id=self._next_id, **fields)
+            try:
+                self._next_id += 1
+                self._rows[record["id"]] = record
+                self._index_add(record)
+                self._engine.write(record)
+                self._notify(None, record)
+            finally:
+                self._version += 1
+        return record
+
+    def insert_many(self, fields_list):
+        """Insert several records under one lock acquisition; returns them in order.
+
+        Every record is built before the table is touched, so a bad one
+        leaves it unchanged. If the engine or a listener fails partway,
+        the rows stored so far stay and the version still goes up, so no
+        cached view keeps serving the table without them.
+        """
+        with self._lock:
+            first_id = self._next_id
+            records = [self._record_type(id=first_id + i, **fields) for i, fields in enumerate(fields_list)]
+            try:
+                for record in records:
+                    self._next_id = record["id"] + 1
+                    self._rows[record["id"]] = record
+                    self._index_add(record)
+                    self._engine.write(record)
+                    self._notify(None, record)
+            finally:
+                if records and self._next_id != first_id:
+                    self._version += 1
+        return records
+
+    def update(self, record_id, **changes):
+        """Apply field changes to an existing record and return it (KeyError if absent)"""
+        with self._lock:
+            old = self._rows[record_id]
+            record = self._record_type(**{**old, **changes})
+            try:
+                self._rows[record_id] = record
+                for field, index in self._indexes.items():
+                    if old[field] != record[field]:
+                        index[old[field]].remove(record_id)
+                        insort(index.setdefault(record[field], []), record_id)
+                self._engine.write(record)
+                self._notify(old, record)
+            finally:
+                self._version += 1
+        return record
+
+    def delete_many(self, record_ids):
+        """Remove the records with these ids (ids not present are skipped) and
+        return how many were removed. Listeners have no way to hear of a
+        delete, so a table with listeners refuses them.
+        """
+        with self._lock:
+            if self._listeners:
+                raise RuntimeError("Cannot delete from a store with listeners")
+            removed = 0
+            for record_id in record_ids:
+                record = self._rows.pop(record_id, None)
+                if record is None:
+                    continue
+                self._index_remove(record)
+                self._engine.delete(record_id)
+                removed += 1
+            if removed:
+                self._version += 1
+        return removed
+
+    def subscribe(self, listener):
+        """Call listener(old, record) on every later write; returns the records
+        present before it, so a listener can start from a consistent snapshot"""
+        with self._lock:
+            self._listeners.append(listener)
+            return list(self._rows.values())
+
+    def unsubscribe(self, listener):
+        """Stop calling `listener` (no-op if it is not subscribed)"""
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def _notify(self, old, record):
+        for listener in self._listeners:
+            listener(old, record)
+
+    def exclusive(self):
+        """Context holding the table's write lock, in which a read-modify-write
+        is not interleaved with any other write (common.shared_store also
+        locks out the other processes)"""
+        return self._lock
+
+    def key_locks(self, stripes=64):
+        """StripedLock for read-modify-writes of single records (e.g. one product's
+        stock): holders of different keys' stripes do not wait for each other,
+        and each write made under it takes the table's write lock only briefly"""
+        return StripedLock(stripes)
+
+    def iter_where(self, after_id=0, limit=0, **filters):
+        """Yield up to `limit` records (0 = all) with id > after_id matching every
+        `field=value` filter, in id order. All filter fields must be indexed.
+        """
+        candidates = min((self._indexes[field].get(value, []) for field, value in filters.items()), key=len)
+        position = bisect_right(candidates, after_id)
+        returned = 0
+        while position < len(candidates):
+            record = self._rows[candidates[position]]
+            position += 1
+            if all(record[field] == value for field, value in filters.items()):
+                yield record
+                returned += 1
+                if returned == limit:
+                    return
+
+    def _index_add(self, record):
+        for field, index in self._indexes.items():
+            index.setdefault(record[field], []).append(record["id"])
+
+    def _index_remove(self, record):
+        for field, index in self._indexes.items():
+            ids = index[record[field]]
+            ids.remove(record["id"])
+            if not ids:
+                del index[record[field]]
+
+    def flush(self):
+        """Force pending writes out to the engine"""
+        self._engine.flush()
+
+    def close(self):
+        """Flush and release the engine (call on shutdown)"""
+        self._engine.close()
+
+    @property
+    def version(self):
+        """Number of writes so far"""
+        return self._version
+
+    @property
+    def last_id(self):
+        """Highest id allocated so far (0 for an empty store)"""
+        return self._next_id - 1
+
+    def get(self, record_id, default=None):
+        return self._rows.get(record_id, default)
+
+    def __getitem__(self, record_id):
+        return self._rows[record_id]
+
+    def __contains__(self, record_id):
+        return record_id in self._rows
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        """Snapshot of all ids"""
+        return list(self._rows)
+
+    def values(self):
+        """Snapshot of all records"""
+        return list(self._rows.values())
+
+
+def open_store(table, rows=None, indexes=(), record_type=dict):
+    """Create the Store for `table` on the engine selected by STORE_ENGINE"""
+    if STORE_ENGINE == "shared":
+        from common.shared_store import SharedStore
+        return SharedStore(table, rows, indexes=indexes, record_type=record_type)
+    return Store(rows, engine=create_engine(table), indexes=indexes, record_type=record_type)
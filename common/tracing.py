@@ -0,0 +1,259 @@
+"""
+Lightweight cross-service tracing.
+
+A trace context travels as a W3C `traceparent` value
+("00-<trace id>-<span id>-<flags>") in the HTTP request headers and in
+gRPC call metadata:
+  TracingMiddleware             - ASGI middleware; starts or continues a trace
+  AioServerTracingInterceptor   - grpc.aio server interceptor
+  ServerTracingInterceptor      - thread-pool grpc.server interceptor
+  TracingClientInterceptor      - grpc.aio channel interceptor; injects the
+                                  current context into outbound metadata
+
+Whether a trace is recorded is decided once, where it starts, with
+probability TRACE_SAMPLE_RATE; downstream services follow the sampled flag.
+Sampled spans go to an in-memory ring buffer of TRACE_BUFFER_SIZE spans,
+read back through recent_spans() (GET /debug/traces).
+"""
+import contextvars
+import os
+import random
+import time
+from collections import deque, namedtuple
+
+import grpc
+
+from common.metrics import handler_behavior, rebuild_handler, status_name
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "10000"))
+
+TRACEPARENT = "traceparent"
+
+SpanContext = namedtuple("SpanContext", "trace_id span_id sampled")
+
+_current = contextvars.ContextVar("trace_span", default=None)
+_spans = deque(maxlen=TRACE_BUFFER_SIZE)
+
+
+def current_span():
+    """SpanContext of the request being handled, or None outside a traced request"""
+    return _current.get()
+
+
+def parse_traceparent(value):
+    """SpanContext from a traceparent value, or None if it is missing or malformed"""
+    if not value:
+        return None
+    parts = value.split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        sampled = bool(int(parts[3], 16) & 1)
+    except ValueError:
+        return None
+    return SpanContext(parts[1], parts[2], sampled)
+
+
+def format_traceparent(span):
+    return f"00-{span.trace_id}-{span.span_id}-{'01' if span.sampled else '00'}"
+
+
+def child_span(parent):
+    """New span under `parent`, or the root of a new trace (sampled at TRACE_SAMPLE_RATE)"""
+    span_id = "%016x" % random.getrandbits(64)
+    if parent is None:
+        return SpanContext("%032x" % random.getrandbits(128), span_id, random.random() < TRACE_SAMPLE_RATE)
+    return SpanContext(parent.trace_id, span_id, parent.sampled)
+
+
+def record_span(span, parent, name, kind, started, elapsed, status):
+    """Append a finished span to the ring buffer (no-op unless sampled)"""
+    if span.sampled:
+        _spans.append({
+            "trace_id": span.trace_id,
+            "span_id": span.span_id,
+            "parent_id": parent.span_id if parent else None,
+            "name": name,
+            "kind": kind,
+            "start": started,
+            "duration_ms": round(elapsed * 1000, 3),
+            "status": status,
+        })
+
+
+def recent_spans(trace_id=None, limit=100):
+    """Newest-first spans from the ring buffer, optionally of one trace"""
+    spans = []
+    for span in reversed(_spans):
+        if trace_id is None or span["trace_id"] == trace_id:
+            spans.append(span)
+            if len(spans) == limit:
+                break
+    return spans
+
+
+class TracingMiddleware:
+    """ASGI middleware giving every REST request a span.
+
+    The span becomes the current context for the handler, so gRPC calls it
+    makes through a TracingClientInterceptor channel are its children. The
+    response carries a traceparent header naming the span.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        parent = None
+        for key, value in scope["headers"]:
+            if key == b"traceparent":
+                parent = parse_traceparent(value.decode("latin-1"))
+                break
+        span = child_span(parent)
+        header = format_traceparent(span).encode()
+        status = 500
+
+        async def send_with_trace(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"traceparent", header)]
+            await send(message)
+
+        token = _current.set(span)
+        started = time.time()
+        began = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_trace)
+        finally:
+            _current.reset(token)
+            route = getattr(scope.get("route"), "path", scope["path"])
+            record_span(span, parent, f"{scope['method']} {route}", "server",
+                        started, time.perf_counter() - began, status)
+
+
+def _incoming_parent(handler_call_details):
+    for key, value in handler_call_details.invocation_metadata or ():
+        if key == TRACEPARENT:
+            return parse_traceparent(value)
+    return None
+
+
+class AioServerTracingInterceptor(grpc.aio.ServerInterceptor):
+    """Gives every call handled by a grpc.aio server a span under the caller's"""
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None:
+            return None
+        method = handler_call_details.method
+        behavior = handler_behavior(handler)
+        parent = _incoming_parent(handler_call_details)
+
+        if handler.response_streaming:
+            async def traced(request, context):
+                span = child_span(parent)
+                started, began, error = time.time(), time.perf_counter(), None
+                try:
+                    async for response in behavior(request, context):
+                        yield response
+                except BaseException as e:
+                    error = e
+                    raise
+                finally:
+                    record_span(span, parent, method, "server", started, time.perf_counter() - began, status_name(context, error))
+        else:
+            async def traced(request, context):
+                span = child_span(parent)
+                token = _current.set(span)
+                started, began, error = time.time(), time.perf_counter(), None
+                try:
+                    return await behavior(request, context)
+                except BaseException as e:
+                    error = e
+                    raise
+                finally:
+                    _current.reset(token)
+                    record_span(span, parent, method, "server", started, time.perf_counter() - began, status_name(context, error))
+
+        return rebuild_handler(handler, traced)
+
+
+class ServerTracingInterceptor(grpc.ServerInterceptor):
+    """Gives every call handled by a thread-pool grpc.server a span under the caller's"""
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None:
+            return None
+        method = handler_call_details.method
+        behavior = handler_behavior(handler)
+        parent = _incoming_parent(handler_call_details)
+
+        if handler.response_streaming:
+            def traced(request, context):
+                span = child_span(parent)
+                started, began, error = time.time(), time.perf_counter(), None
+                try:
+                    yield from behavior(request, context)
+                except BaseException as e:
+                    error = e
+                    raise
+                finally:
+                    record_span(span, parent, method, "server", started, time.perf_counter() - began, status_name(context, error))
+        else:
+            def traced(request, context):
+                span = child_span(parent)
+                token = _current.set(span)
+                started, began, error = time.time(), time.perf_counter(), None
+                try:
+                    return behavior(request, context)
+                except BaseException as e:
+                    error = e
+                    raise
+                finally:
+                    _current.reset(token)
+                    record_span(span, parent, method, "server", started, time.perf_counter() - began, status_name(context, error))
+
+        return rebuild_handler(handler, traced)
+
+
+class TracingClientInterceptor(grpc.aio.UnaryUnaryClientInterceptor):
+    """Sends the current trace context with every outbound unary call and
+    records a client span for it (the time the caller waited, including the
+    network hops that the server span does not see).
+    """
+
+    async def intercept_unary_unary(self, continuation, client_call_details, request):
+        parent = _current.get()
+        if parent is None:
+            return await continuation(client_call_details, request)
+        span = child_span(parent)
+        metadata = list(client_call_details.metadata or ()) + [(TRACEPARENT, format_traceparent(span))]
+        details = grpc.aio.ClientCallDetails(
+            client_call_details.method,
+            client_call_details.timeout,
+            metadata,
+            client_call_details.credentials,
+            client_call_details.wait_for_ready,
+        )
+        started, began = time.time(), time.perf_counter()
+        call = await continuation(details, request)
+        if not span.sampled:
+            return call
+        status = "CANCELLED"
+        try:
+            await call
+            status = "OK"
+        except grpc.aio.AioRpcError as e:
+            status = e.code().name
+        finally:
+            method = client_call_details.method
+            if isinstance(method, bytes):
+                method = method.decode()
+            record_span(span, parent, method, "client", started, time.perf_counter() - began, status)
+        return call
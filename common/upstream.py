@@ -0,0 +1,260 @@
+"""
+Client-side load balancing over the replicas of an upstream gRPC service.
+
+An address setting such as USER_SERVICE_ADDR may list several replicas
+("user-1:50051,user-2:50051"). UpstreamPool opens GRPC_CHANNELS_PER_TARGET
+channels to each one, every channel on its own HTTP/2 connection, and
+BalancedStub sends each unary call to a replica chosen by GRPC_LB_POLICY:
+  least_outstanding - the replica with the fewest calls in flight (default;
+                      ties go round the replicas in turn)
+  round_robin       - replicas in turn
+Within a replica the channels are used in turn.
+
+Health-based ejection: a replica whose channels are all in
+TRANSIENT_FAILURE is skipped. One whose last EJECTION_FAILURES calls
+failed with UNAVAILABLE or DEADLINE_EXCEEDED, or that fails a call once
+its channels are all down, is ejected: skipped for EJECTION_TIME seconds
+(doubled on each repeat ejection, at most 8x, until a call succeeds). If
+every replica is out, the one due back first is used anyway; a single
+target is never ejected.
+
+Retries (common.resilience.RetryPolicy) are made by the pool, not by the
+channels: a failed read goes next to a replica it has not tried yet (the
+same one only when there is no other), and every failed attempt counts
+towards its replica's ejection.
+
+Requests of at least GRPC_COMPRESSION_MIN_BYTES are compressed with
+GRPC_COMPRESSION (common.compression).
+
+Channels keep the connection alive with HTTP/2 pings every
+GRPC_KEEPALIVE_TIME_MS so that idle connections through NAT/proxies are
+not silently dropped and dead peers are noticed within
+GRPC_KEEPALIVE_TIMEOUT_MS.
+"""
+import asyncio
+import logging
+import os
+import time
+
+import grpc
+
+from common.compression import request_compression
+from common.metrics import REGISTRY, Counter
+from common.resilience import FAILURE_CODES, RETRIES, CircuitOpenError
+
+GRPC_LB_POLICY = os.getenv("GRPC_LB_POLICY", "least_outstanding")
+GRPC_CHANNELS_PER_TARGET = int(os.getenv("GRPC_CHANNELS_PER_TARGET", "2"))
+GRPC_KEEPALIVE_TIME_MS = int(os.getenv("GRPC_KEEPALIVE_TIME_MS", "20000"))
+GRPC_KEEPALIVE_TIMEOUT_MS = int(os.getenv("GRPC_KEEPALIVE_TIMEOUT_MS", "10000"))
+EJECTION_FAILURES = int(os.getenv("EJECTION_FAILURES", "3"))
+EJECTION_TIME = float(os.getenv("EJECTION_TIME", "5.0"))
+
+# Failures that say the replica itself is unhealthy
+EJECT_CODES = frozenset({grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED})
+MAX_EJECTION_MULTIPLIER = 8
+
+REPLICA_CALLS = REGISTRY.register(Counter(
+    "grpc_client_replica_calls_total", "Outbound calls by upstream replica", ("upstream", "target")))
+REPLICA_EJECTIONS = REGISTRY.register(Counter(
+    "grpc_client_replica_ejections_total", "Times an upstream replica was taken out of rotation",
+    ("upstream", "target")))
+
+logger = logging.getLogger(__name__)
+
+
+def parse_targets(value):
+    """"host1:port,host2:port" (or a list) -> list of targets"""
+    if isinstance(value, str):
+        value = value.split(",")
+    return [target.strip() for target in value if target.strip()]
+
+
+def channel_options():
+    """Options of every upstream channel"""
+    return [
+        ("grpc.keepalive_time_ms", GRPC_KEEPALIVE_TIME_MS),
+        ("grpc.keepalive_timeout_ms", GRPC_KEEPALIVE_TIMEOUT_MS),
+        ("grpc.keepalive_permit_without_calls", 1),
+        ("grpc.http2.max_pings_without_data", 0),
+        # Without this, channels with the same target and options share one connection
+        ("grpc.use_local_subchannel_pool", 1),
+    ]
+
+
+class Replica:
+    """One upstream target: its channels, stubs and health bookkeeping"""
+
+    def __init__(self, target, channels, stubs):
+        self.target = target
+        self.channels = channels
+        self.stubs = stubs
+        self.outstanding = 0
+        self.calls = 0
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self._next = 0
+
+    def next_stub(self):
+        stub = self.stubs[self._next % len(self.stubs)]
+        self._next += 1
+        return stub
+
+    def connectable(self):
+        """False when every channel has failed to connect (and is backing off)"""
+        return any(channel.get_state() != grpc.ChannelConnectivity.TRANSIENT_FAILURE
+                   for channel in self.channels)
+
+
+class UpstreamPool:
+    """Channels to every replica of one upstream service, with a balancing stub.
+
+    `breaker` (common.resilience.CircuitBreaker) and `retry`
+    (common.resilience.RetryPolicy) cover the upstream as a whole: a read
+    that fails on one replica is retried on another, and the breaker only
+    sees the outcome after the retries. `interceptors` run on every attempt.
+    """
+
+    def __init__(self, name, targets, stub_class, interceptors=(), breaker=None, retry=None,
+                 channels_per_target=GRPC_CHANNELS_PER_TARGET, policy=GRPC_LB_POLICY, clock=time.monotonic):
+        if policy not in ("least_outstanding", "round_robin"):
+            raise ValueError(f"Unknown load balancing policy: {policy}")
+        self.name = name
+        self.breaker = breaker
+        self.retry = retry
+        self.policy = policy
+        self._clock = clock
+        self._next = 0
+        self.replicas = []
+        for target in parse_targets(targets):
+            channels = [
+                grpc.aio.insecure_channel(target, options=channel_options(), interceptors=list(interceptors))
+                for _ in range(max(1, channels_per_target))
+            ]
+            self.replicas.append(Replica(target, channels, [stub_class(channel) for channel in channels]))
+        if not self.replicas:
+            raise ValueError(f"No targets for upstream {name}")
+        self.stub = BalancedStub(self)
+
+    def pick(self, exclude=()):
+        """Replica for the next call, avoiding the replicas in `exclude` while there are others"""
+        now = self._clock()
+        candidates = [r for r in self.replicas if r.ejected_until <= now and r.connectable() and r not in exclude]
+        if not candidates:
+            others = [r for r in self.replicas if r not in exclude] or self.replicas
+            candidates = [min(others, key=lambda r: r.ejected_until)]
+        start = self._next
+        self._next += 1
+        count = len(candidates)
+        if self.policy == "round_robin":
+            return candidates[start % count]
+        best = None
+        for i in range(count):
+            replica = candidates[(start + i) % count]
+            if best is None or replica.outstanding < best.outstanding:
+                best = replica
+        return best
+
+    async def call(self, method, request, timeout=None, **kwargs):
+        """Send one unary call, retrying a failed read on another replica, and feed the outcome back"""
+        breaker = self.breaker
+        if breaker is not None and not breaker.allow():
+            breaker.reject()
+            raise CircuitOpenError(breaker.name)
+        kwargs.setdefault("compression", request_compression(request))
+        if self.retry is not None:
+            self.retry.budget.deposit()
+        deadline = None if timeout is None else self._clock() + timeout
+        tried = []
+        while True:
+            replica = self.pick(exclude=tried)
+            try:
+                response = await self._attempt(replica, method, request, timeout=timeout, **kwargs)
+            except grpc.aio.AioRpcError as e:
+                delay = None if self.retry is None else self.retry.delay(method, e.code(), len(tried))
+                if delay is not None and deadline is not None:
+                    timeout = deadline - self._clock() - delay
+                    if timeout <= 0:
+                        delay = None
+                if delay is None or not self.retry.budget.withdraw():
+                    if breaker is not None:
+                        if e.code() in FAILURE_CODES:
+                            breaker.record_failure()
+                        else:
+                            breaker.record_success()
+                    raise
+                tried.append(replica)
+                RETRIES.labels(self.name, method).inc()
+                await asyncio.sleep(delay)
+                continue
+            if breaker is not None:
+                breaker.record_success()
+            return response
+
+    async def _attempt(self, replica, method, request, **kwargs):
+        """One try of a call on `replica`; UNAVAILABLE/DEADLINE_EXCEEDED count towards its ejection"""
+        replica.outstanding += 1
+        replica.calls += 1
+        REPLICA_CALLS.labels(self.name, replica.target).inc()
+        try:
+            response = await getattr(replica.next_stub(), method)(request, **kwargs)
+        except grpc.aio.AioRpcError as e:
+            if e.code() in EJECT_CODES:
+                self._record_failure(replica)
+            else:
+                replica.failures = 0
+            raise
+        finally:
+            replica.outstanding -= 1
+        replica.failures = 0
+        replica.ejections = 0
+        return response
+
+    def _record_failure(self, replica):
+        replica.failures += 1
+        if (replica.failures < EJECTION_FAILURES and replica.connectable()) or len(self.replicas) == 1:
+            return
+        replica.failures = 0
+        replica.ejections += 1
+        ejected_for = EJECTION_TIME * min(2 ** (replica.ejections - 1), MAX_EJECTION_MULTIPLIER)
+        replica.ejected_until = self._clock() + ejected_for
+        REPLICA_EJECTIONS.labels(self.name, replica.target).inc()
+        logger.warning(f"Ejected {self.name} replica {replica.target} for {ejected_for:g}s")
+
+    def snapshot(self):
+        """State for the /upstreams endpoint"""
+        now = self._clock()
+        return {
+            "policy": self.policy,
+            "replicas": [{
+                "target": r.target,
+                "channels": len(r.channels),
+                "connectivity": [channel.get_state().name for channel in r.channels],
+                "outstanding": r.outstanding,
+                "calls": r.calls,
+                "consecutive_failures": r.failures,
+                "ejected_for": round(max(0.0, r.ejected_until - now), 3),
+            } for r in self.replicas],
+        }
+
+    async def close(self):
+        for replica in self.replicas:
+            for channel in replica.channels:
+                await channel.close()
+
+
+class BalancedStub:
+    """Stand-in for a generated stub whose unary methods go through an UpstreamPool"""
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __getattr__(self, method):
+        pool = self._pool
+
+        async def invoke(request, **kwargs):
+            return await pool.call(method, request, **kwargs)
+
+        invoke.__name__ = method
+        setattr(self, method, invoke)
+        return invoke
@@ -0,0 +1,105 @@
+"""
+Single- and multi-process serving of a service.
+
+serve() with WORKERS=1 (default) runs uvicorn in this process as before.
+With WORKERS > 1 it binds the REST port once and forks WORKERS processes
+that all accept on that socket, so the kernel spreads connections over
+them. Each worker starts its own gRPC server on the same gRPC port; gRPC
+servers bind with SO_REUSEPORT, so gRPC connections are spread by the
+kernel as well.
+
+The workers share their tables only through STORE_ENGINE=shared
+(common.shared_store), which WORKERS > 1 therefore requires. Caches,
+metrics, traces and circuit breakers stay per worker. A worker that dies
+is replaced; SIGTERM to the parent stops all workers gracefully.
+"""
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+
+from common.grpc_server import GRPC_SERVER_MODE
+from common.storage import STORE_ENGINE
+
+WORKERS = int(os.getenv("WORKERS", "1"))
+
+logger = logging.getLogger(__name__)
+
+
+def _run_server(app, port, sock=None, serve_grpc=None):
+    """Run uvicorn (and a thread-mode gRPC server) in this process until it stops"""
+    import uvicorn
+
+    if GRPC_SERVER_MODE == "thread" and serve_grpc is not None:
+        # Start gRPC server in a separate thread (in aio mode it starts from the startup hook)
+        threading.Thread(target=serve_grpc, daemon=True).start()
+    server = uvicorn.Server(uvicorn.Config(app, host="0.0.0.0", port=port, log_level="info", log_config=None))
+    server.run(sockets=[sock] if sock is not None else None)
+
+
+def _bind(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("0.0.0.0", port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def serve(app, port, serve_grpc=None, workers=WORKERS):
+    """Serve `app` on `port` with `workers` processes (blocks until shutdown).
+
+    `serve_grpc` runs the thread-mode gRPC server; it is started in a
+    thread of every worker when GRPC_SERVER_MODE=thread.
+    """
+    if workers <= 1:
+        _run_server(app, port, serve_grpc=serve_grpc)
+        return
+    if STORE_ENGINE != "shared":
+        raise SystemExit(f"WORKERS={workers} needs STORE_ENGINE=shared (got {STORE_ENGINE}); "
+                         "other engines would give every worker its own copy of the data")
+
+    sock = _bind(port)
+    children = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            _run_server(app, port, sock, serve_grpc)
+            sys.exit(0)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        # Ctrl-C already reaches every worker through the process group
+        if signum == signal.SIGTERM:
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+    for _ in range(workers):
+        spawn()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info(f"Serving on port {port} with {workers} worker processes")
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.discard(pid)
+        if not stopping:
+            logger.warning(f"Worker {pid} exited with status {status}; starting a new one")
+            spawn()
+    sock.close()
@@ -1,9 +1,8 @@
 import logging
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import JSONResponse
 import grpc
-from concurrent import futures
-from typing import List
+from typing import List, Optional
 import sys
 import os
 
@@ -11,49 +10,145 @@ import os
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'proto'))
 from proto import user_pb2, user_pb2_grpc
 
+# Import shared helpers
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.admission import AdmissionMiddleware, admission_snapshot
+from common.changefeed import ChangeLog
+from common.grpc_server import GRPC_SERVER_MODE, aio_stream, serve_threaded, start_aio, stop_aio
+from common.logs import configure_logging
+from common.metrics import MetricsMiddleware, metrics_response
+from common.pagination import DEFAULT_PAGE_SIZE, iter_after, page_after
+from common.records import User
+from common.responses import ResponseCache
+from common.store import open_store
+from common.tracing import TracingMiddleware, recent_spans
+from common.workers import serve
+
 # FastAPI app
 app = FastAPI(title="User Service", version="1.0.0")
+app.add_middleware(AdmissionMiddleware, routes=app.routes)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
+
+# Listening ports
+REST_PORT = int(os.getenv("SERVICE_A_PORT", "8001"))
+GRPC_PORT = int(os.getenv("SERVICE_A_GRPC_PORT", "50051"))
+
+# Largest list accepted by the bulk endpoints
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "10000"))
+
+# gRPC server started in aio mode
+grpc_server = None
 
 # Setup logging
-logging.basicConfig(level=logging.INFO)
+configure_logging("user-service")
 logger = logging.getLogger(__name__)
+# Per-call gRPC handler logs (thin them with LOG_SAMPLING=rpc=<rate>)
+rpc_logger = logging.getLogger("rpc")
 
-# Mock database
-users_db = {
+# Database (persistence engine selected by STORE_ENGINE; these rows seed an empty store)
+users_db = open_store("users", {
     1: {"id": 1, "name": "ธราเทพ จันทร์ดำ 335", "email": "bass2545b@gmasil.com"},
     2: {"id": 2, "name": "Bob", "email": "bob@example.com"},
     3: {"id": 3, "name": "Charlie", "email": "charlie@example.com"}
-}
+}, record_type=User)
+
+# Numbered log of the latest user changes, streamed by WatchUsers
+user_changes = ChangeLog(users_db, "users")
+
+# Serialized list/item responses, rebuilt when users_db changes
+response_cache = ResponseCache()
 
 
 # ============= REST API Endpoints =============
 
+@app.on_event("startup")
+async def startup_event():
+    """Start the aio gRPC server on this event loop"""
+    global grpc_server
+    if GRPC_SERVER_MODE == "aio":
+        grpc_server = await start_aio(user_pb2_grpc.add_UserServiceServicer_to_server, UserServiceImpl(), GRPC_PORT)
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop the aio gRPC server and flush the store"""
+    await stop_aio(grpc_server)
+    users_db.close()
+
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "service": "user-service"}
 
 
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics for REST routes and gRPC methods"""
+    return metrics_response()
+
+
+@app.get("/admission")
+async def get_admission():
+    """Concurrency limit, load and shed count of each route and gRPC method"""
+    return admission_snapshot()
+
+
+@app.get("/debug/traces")
+async def get_traces(trace_id: Optional[str] = None, limit: int = 100):
+    """Recently sampled spans, newest first (optionally one trace)"""
+    return {"service": "user-service", "spans": recent_spans(trace_id, limit)}
+
+
 @app.get("/users")
-async def list_users():
-    """Get all users"""
-    return {"data": list(users_db.values())}
+async def list_users(request: Request, cursor: int = 0, limit: int = DEFAULT_PAGE_SIZE):
+    """Get one page of users with id > cursor (cached, ETag/304 aware; UserList protobuf on
+    Accept: application/x-protobuf)"""
+    def build():
+        users, next_cursor = page_after(users_db, cursor, limit)
+        return {"data": users, "next_cursor": next_cursor}
+    return response_cache.respond(request, ("users", cursor, limit), users_db.version, build, user_list_message)
+
+
+def user_list_message(content):
+    """UserList message of a page of users"""
+    return user_pb2.UserList(users=[user.to_proto(user_pb2.User) for user in content["data"]])
 
 
 @app.get("/users/{user_id}")
-async def get_user(user_id: int):
-    """Get user by ID"""
-    if user_id not in users_db:
+async def get_user(request: Request, user_id: int):
+    """Get user by ID (cached, ETag/304 aware)"""
+    user = users_db.get(user_id)
+    if user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    return {"data": users_db[user_id]}
+    return response_cache.respond(request, ("user", user_id), user, lambda: {"data": user})
 
 
 @app.post("/users")
 async def create_user(user: dict):
     """Create new user"""
-    new_id = max(users_db.keys()) + 1 if users_db else 1
-    users_db[new_id] = {"id": new_id, "name": user["name"], "email": user["email"]}
-    return {"data": users_db[new_id], "message": "User created"}
+    new_user = users_db.insert({"name": user["name"], "email": user["email"]})
+    return {"data": new_user, "message": "User created"}
+
+
+@app.post("/users/batch")
+async def create_users_batch(users: List[dict]):
+    """Create many users in one request, reporting success or failure per item"""
+    if len(users) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_ITEMS} users per batch")
+    results = [None] * len(users)
+    valid = []
+    for i, user in enumerate(users):
+        if user.get("name") and user.get("email"):
+            valid.append(i)
+        else:
+            results[i] = {"code": 400, "message": "name and email are required"}
+
+    created = users_db.insert_many({"name": users[i]["name"], "email": users[i]["email"]} for i in valid)
+    for i, new_user in zip(valid, created):
+        results[i] = {"code": 201, "message": "User created", "data": new_user}
+    return {"data": results, "created": len(created), "failed": len(users) - len(created)}
 
 
 # ============= gRPC Service =============
@@ -63,40 +158,73 @@ class UserServiceImpl(user_pb2_grpc.UserServiceServicer):
 
     def GetUser(self, request, context):
         """Get user by ID via gRPC"""
-        logger.info(f"gRPC GetUser called with id={request.id}")
+        rpc_logger.info("gRPC GetUser called with id=%s", request.id)
         if request.id in users_db:
             user = users_db[request.id]
-            user_pb = user_pb2.User(id=user["id"], name=user["name"], email=user["email"])
+            user_pb = user.to_proto(user_pb2.User)
             return user_pb2.UserResponse(code=200, message="Success", user=user_pb)
         else:
             return user_pb2.UserResponse(code=404, message="User not found", user=None)
 
     def ListUsers(self, request, context):
-        """List all users via gRPC"""
-        logger.info("gRPC ListUsers called")
+        """List users via gRPC (all of them unless after_id/limit are set)"""
+        rpc_logger.info("gRPC ListUsers called")
         users_list = []
-        for user in users_db.values():
-            users_list.append(user_pb2.User(id=user["id"], name=user["name"], email=user["email"]))
+        for user in iter_after(users_db, request.after_id, request.limit):
+            users_list.append(user.to_proto(user_pb2.User))
         return user_pb2.UserList(users=users_list)
 
+    def StreamUsers(self, request, context):
+        """Stream users in id order via gRPC, one message per user"""
+        rpc_logger.info("gRPC StreamUsers called with after_id=%s", request.after_id)
+        for user in iter_after(users_db, request.after_id, request.limit):
+            yield user.to_proto(user_pb2.User)
 
-def serve_grpc():
-    """Start gRPC server"""
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    user_pb2_grpc.add_UserServiceServicer_to_server(UserServiceImpl(), server)
-    server.add_insecure_port('0.0.0.0:50051')
-    logger.info("gRPC Server started on port 50051")
-    server.start()
-    server.wait_for_termination()
+    def BatchGetUsers(self, request, context):
+        """Get many users by ID in one call via gRPC (unknown IDs are skipped)"""
+        rpc_logger.info("gRPC BatchGetUsers called with %s ids", len(request.ids))
+        users_list = []
+        for user_id in dict.fromkeys(request.ids):
+            user = users_db.get(user_id)
+            if user is not None:
+                users_list.append(user.to_proto(user_pb2.User))
+        return user_pb2.UserList(users=users_list)
 
+    def CreateUsers(self, request_iterator, context):
+        """Create users from a client stream via gRPC, one result per request"""
+        rpc_logger.info("gRPC CreateUsers called")
+        results = []
+        created = 0
+        for request in request_iterator:
+            if not request.name or not request.email:
+                results.append(user_pb2.UserResponse(code=400, message="name and email are required"))
+                continue
+            user = users_db.insert({"name": request.name, "email": request.email})
+            user_pb = user.to_proto(user_pb2.User)
+            results.append(user_pb2.UserResponse(code=201, message="User created", user=user_pb))
+            created += 1
+        return user_pb2.CreateUsersResponse(created=created, failed=len(results) - created, results=results)
+
+    @aio_stream(lambda request, context: user_changes.follow_async(request, context, user_changes_message))
+    def WatchUsers(self, request, context):
+        """Stream user changes via gRPC: after request.after_seq, or a snapshot and then every change"""
+        yield from user_changes.follow(request, context, user_changes_message)
+
+
+def user_changes_message(epoch, last_seq, changes):
+    """UserChanges message of one batch of user_changes"""
+    return user_pb2.UserChanges(epoch=epoch, last_seq=last_seq, changes=[
+        user_pb2.UserChange(seq=change.seq, kind=change.kind, fields=change.fields,
+                            user=change.record.to_proto(user_pb2.User))
+        for change in changes])
 
-if __name__ == "__main__":
-    import threading
-    import uvicorn
 
-    # Start gRPC server in a separate thread
-    grpc_thread = threading.Thread(target=serve_grpc, daemon=True)
-    grpc_thread.start()
+def serve_grpc():
+    """Start gRPC server in thread-pool mode (blocks the calling thread)"""
+    serve_threaded(user_pb2_grpc.add_UserServiceServicer_to_server, UserServiceImpl(), GRPC_PORT)
+
 
-    # Start FastAPI server
-    uvicorn.run(app, host="0.0.0.0", port=8001, log_level="info")
+if __name__ == "__main__":
+    # Start FastAPI in one process, or WORKERS processes sharing the ports; each
+    # starts gRPC from the startup hook (aio mode) or in a thread (thread mode)
+    serve(app, REST_PORT, serve_grpc)
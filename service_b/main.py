@@ -1,39 +1,112 @@
 import logging
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 import grpc
-from concurrent import futures
 import sys
 import os
+import time
+from typing import List, Optional
 
 # Import proto generated modules
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'proto'))
 from proto import product_pb2, product_pb2_grpc, user_pb2, user_pb2_grpc
 
+# Import shared helpers
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.admission import AdmissionMiddleware, admission_snapshot
+from common.cache import TTLCache
+from common.changefeed import ChangeLog
+from common.coalesce import CoalescingStub
+from common.grpc_server import GRPC_SERVER_MODE, aio_stream, serve_threaded, start_aio, stop_aio
+from common.logs import configure_logging
+from common.metrics import ClientMetricsInterceptor, MetricsMiddleware, metrics_response
+from common.pagination import DEFAULT_PAGE_SIZE, iter_after, page_after
+from common.records import Product
+from common.resilience import CircuitBreaker, RetryPolicy
+from common.responses import ResponseCache, negotiate
+from common.search import SearchIndex, normalize
+from common.store import open_store
+from common.tracing import TracingClientInterceptor, TracingMiddleware, recent_spans
+from common.upstream import UpstreamPool
+from common.workers import serve
+
 # FastAPI app
 app = FastAPI(title="Product Service", version="1.0.0")
+app.add_middleware(AdmissionMiddleware, routes=app.routes)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
+
+# Listening ports
+REST_PORT = int(os.getenv("SERVICE_B_PORT", "8002"))
+GRPC_PORT = int(os.getenv("SERVICE_B_GRPC_PORT", "50052"))
+
+# Largest list accepted by the bulk endpoints
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "10000"))
+
+# gRPC server started in aio mode
+grpc_server = None
 
 # Setup logging
-logging.basicConfig(level=logging.INFO)
+configure_logging("product-service")
 logger = logging.getLogger(__name__)
+# Per-call gRPC handler logs (thin them with LOG_SAMPLING=rpc=<rate>)
+rpc_logger = logging.getLogger("rpc")
 
-# Mock database
-products_db = {
+# Database (persistence engine selected by STORE_ENGINE; these rows seed an empty store)
+products_db = open_store("products", {
     1: {"id": 1, "name": "หมา", "price": 999.99, "stock": 10},
     2: {"id": 2, "name": "Mouse", "price": 29.99, "stock": 50},
     3: {"id": 3, "name": "Keyboard", "price": 79.99, "stock": 30}
-}
-
-# Service A gRPC channel (for inter-service communication)
-user_service_channel = None
+}, record_type=Product)
+
+# ReserveStock calls made with a reservation_id: what each one took and whether it was
+# released, so a repeated or late reserve/release is applied at most once
+reservations_db = open_store("reservations", indexes=("reservation_id",))
+# Seconds a reservation row is kept (well past service_c's RELEASE_ATTEMPTS retries), and
+# most rows kept at all; past that the oldest go first, so released ids cannot fill the table
+RESERVATION_TTL = float(os.getenv("RESERVATION_TTL", "600"))
+RESERVATION_MAX_ROWS = int(os.getenv("RESERVATION_MAX_ROWS", "100000"))
+# time.time() of the next expire_reservations() sweep
+next_reservation_sweep = 0.0
+
+# Per-product stock locks and per-id reservation locks (stripes shared by many keys;
+# with STORE_ENGINE=shared they lock out the other worker processes too)
+STOCK_LOCK_STRIPES = int(os.getenv("STOCK_LOCK_STRIPES", "64"))
+stock_locks = products_db.key_locks(STOCK_LOCK_STRIPES)
+reservation_locks = reservations_db.key_locks(STOCK_LOCK_STRIPES)
+
+# Name (substring/word prefix) and price range index of products_db, kept up to date on every write
+product_search = SearchIndex(products_db, "name", "price")
+
+# Numbered log of the latest product changes (new products, stock moves), streamed by WatchProducts
+product_changes = ChangeLog(products_db, "products")
+
+# Serialized list/item responses, rebuilt when products_db changes
+response_cache = ResponseCache()
+
+# Upstream gRPC target(s, comma-separated replicas) and deadline (seconds)
+USER_SERVICE_ADDR = os.getenv("USER_SERVICE_ADDR", "service_a:50051")
+GRPC_CALL_TIMEOUT = float(os.getenv("GRPC_CALL_TIMEOUT", "2.0"))
+
+# Read-through cache for the User Service user list (TTL in seconds)
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+user_list_cache = TTLCache(maxsize=1, ttl=USER_CACHE_TTL)
+
+# Service A gRPC channels (for inter-service communication), balanced over its
+# replicas and guarded by a circuit breaker; identical concurrent reads share one call
+user_service_pool = None
 user_service_stub = None
+user_breaker = CircuitBreaker("user-service")
+# Last user list fetched, served (marked degraded) while User Service is failing
+last_user_list = None
 
 
 async def init_user_service_connection():
     """Initialize connection to User Service gRPC"""
-    global user_service_channel, user_service_stub
+    global user_service_pool, user_service_stub
     try:
-        user_service_channel = await grpc.aio.insecure_channel('service_a:50051')
-        user_service_stub = user_pb2_grpc.UserServiceStub(user_service_channel)
+        user_service_pool = UpstreamPool("user-service", USER_SERVICE_ADDR, user_pb2_grpc.UserServiceStub, interceptors=[
+            TracingClientInterceptor(), ClientMetricsInterceptor()], breaker=user_breaker, retry=RetryPolicy())
+        user_service_stub = CoalescingStub(user_service_pool.stub, "user-service")
         logger.info("Connected to User Service gRPC")
     except Exception as e:
         logger.error(f"Failed to connect to User Service: {e}")
@@ -43,8 +116,21 @@ async def init_user_service_connection():
 
 @app.on_event("startup")
 async def startup_event():
-    """Initialize connections on startup"""
+    """Initialize connections and start the aio gRPC server on startup"""
+    global grpc_server
     await init_user_service_connection()
+    if GRPC_SERVER_MODE == "aio":
+        grpc_server = await start_aio(product_pb2_grpc.add_ProductServiceServicer_to_server, ProductServiceImpl(), GRPC_PORT)
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop the aio gRPC server, close the upstream channels and flush the store"""
+    await stop_aio(grpc_server)
+    if user_service_pool is not None:
+        await user_service_pool.close()
+    products_db.close()
+    reservations_db.close()
 
 
 @app.get("/health")
@@ -53,52 +139,165 @@ async def health_check():
     return {"status": "healthy", "service": "product-service"}
 
 
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics for REST routes, gRPC methods and outbound calls"""
+    return metrics_response()
+
+
+@app.get("/debug/traces")
+async def get_traces(trace_id: Optional[str] = None, limit: int = 100):
+    """Recently sampled spans, newest first (optionally one trace)"""
+    return {"service": "product-service", "spans": recent_spans(trace_id, limit)}
+
+
 @app.get("/products")
-async def list_products():
-    """Get all products"""
-    return {"data": list(products_db.values())}
+async def list_products(request: Request, cursor: int = 0, limit: int = DEFAULT_PAGE_SIZE):
+    """Get one page of products with id > cursor (cached, ETag/304 aware; ProductList protobuf
+    on Accept: application/x-protobuf)"""
+    def build():
+        products, next_cursor = page_after(products_db, cursor, limit)
+        return {"data": products, "next_cursor": next_cursor}
+    key = ("products", cursor, limit)
+    return response_cache.respond(request, key, products_db.version, build, product_list_message)
+
+
+def product_list_message(content):
+    """ProductList message of a page of products"""
+    return product_pb2.ProductList(products=[product.to_proto(product_pb2.Product) for product in content["data"]])
+
+
+@app.get("/products/search")
+async def search_products(request: Request, q: str = "", mode: str = "substring", min_price: Optional[float] = None,
+                          max_price: Optional[float] = None, cursor: int = 0, limit: int = DEFAULT_PAGE_SIZE):
+    """Search products by name (substring or word prefix) and/or price range, one page in id order
+    (ProductList protobuf on Accept: application/x-protobuf)"""
+    if mode not in ("substring", "prefix"):
+        raise HTTPException(status_code=400, detail="mode must be substring or prefix")
+    if not q and min_price is None and max_price is None:
+        raise HTTPException(status_code=400, detail="q, min_price or max_price is required")
+    if q and not normalize(q):
+        raise HTTPException(status_code=400, detail="q has no letters or digits to search for")
+    products, next_cursor = product_search.page(q, mode == "prefix", min_price, max_price, cursor, limit)
+    return negotiate(request, {"data": products, "next_cursor": next_cursor}, product_list_message)
 
 
 @app.get("/products/{product_id}")
-async def get_product(product_id: int):
-    """Get product by ID"""
-    if product_id not in products_db:
+async def get_product(request: Request, product_id: int):
+    """Get product by ID (cached, ETag/304 aware)"""
+    product = products_db.get(product_id)
+    if product is None:
         raise HTTPException(status_code=404, detail="Product not found")
-    return {"data": products_db[product_id]}
+    return response_cache.respond(request, ("product", product_id), product, lambda: {"data": product})
 
 
 @app.post("/products")
 async def create_product(product: dict):
     """Create new product"""
-    new_id = max(products_db.keys()) + 1 if products_db else 1
-    products_db[new_id] = {
-        "id": new_id,
+    new_product = products_db.insert({
         "name": product["name"],
         "price": product["price"],
         "stock": product["stock"]
-    }
-    return {"data": products_db[new_id], "message": "Product created"}
+    })
+    return {"data": new_product, "message": "Product created"}
+
+
+@app.post("/products/batch")
+async def create_products_batch(products: List[dict]):
+    """Create many products in one request, reporting success or failure per item"""
+    if len(products) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_ITEMS} products per batch")
+    results = [None] * len(products)
+    valid = []
+    for i, product in enumerate(products):
+        error = validate_new_product(product.get("name"), product.get("price"), product.get("stock"))
+        if error:
+            results[i] = {"code": 400, "message": error}
+        else:
+            valid.append(i)
+
+    created = products_db.insert_many({
+        "name": products[i]["name"],
+        "price": products[i]["price"],
+        "stock": products[i]["stock"]
+    } for i in valid)
+    for i, new_product in zip(valid, created):
+        results[i] = {"code": 201, "message": "Product created", "data": new_product}
+    return {"data": results, "created": len(created), "failed": len(products) - len(created)}
+
+
+def validate_new_product(name, price, stock):
+    """Return an error message for an invalid new product, or None"""
+    if not name:
+        return "name is required"
+    if not isinstance(price, (int, float)) or price < 0:
+        return "price must be a non-negative number"
+    if not isinstance(stock, int) or stock < 0:
+        return "stock must be a non-negative integer"
+    return None
 
 
 @app.get("/products-with-users")
 async def get_products_with_users():
-    """Get all products and fetch user info from User Service"""
+    """Get all products and fetch user info from User Service.
+
+    If User Service is failing (or its circuit is open) the products are
+    still returned, with the last user list seen and "degraded": true.
+    """
+    global last_user_list
     try:
-        # Call User Service gRPC
-        if user_service_stub:
-            response = await user_service_stub.ListUsers(user_pb2.ListUsersRequest())
+        # Call User Service gRPC (cached)
+        users = user_list_cache.get("all")
+        if users is None and user_service_stub:
+            response = await user_service_stub.ListUsers(user_pb2.ListUsersRequest(), timeout=GRPC_CALL_TIMEOUT)
             users = [{"id": u.id, "name": u.name, "email": u.email} for u in response.users]
-        else:
+            user_list_cache.set("all", users)
+            last_user_list = users
+        elif users is None:
             users = []
 
         return {
-            "products": list(products_db.values()),
+            "products": [product.to_dict() for product in products_db.values()],
             "users": users,
             "message": "Data from both services"
         }
+    except grpc.aio.AioRpcError as e:
+        logger.warning(f"User Service unavailable, serving degraded response: {e.code().name} {e.details()}")
+        return {
+            "products": [product.to_dict() for product in products_db.values()],
+            "users": last_user_list or [],
+            "degraded": True,
+            "message": f"User Service unavailable ({e.code().name}); users may be stale",
+        }
     except Exception as e:
         logger.error(f"Error calling User Service: {e}")
-        return {"products": list(products_db.values()), "error": str(e)}
+        return {"products": [product.to_dict() for product in products_db.values()], "error": str(e)}
+
+
+@app.get("/cache-stats")
+async def get_cache_stats():
+    """Hit/miss counters for the upstream user list cache and the response cache, and
+    how many upstream reads were coalesced"""
+    return {"users": user_list_cache.stats(), "responses": response_cache.stats(),
+            "coalescing": {user_service_stub.flight.name: user_service_stub.flight.stats()} if user_service_stub else {}}
+
+
+@app.get("/breakers")
+async def get_breakers():
+    """Circuit breaker state of each upstream"""
+    return {user_breaker.name: user_breaker.snapshot()}
+
+
+@app.get("/upstreams")
+async def get_upstreams():
+    """Replicas of each upstream with their load and ejection state"""
+    return {user_service_pool.name: user_service_pool.snapshot()} if user_service_pool else {}
+
+
+@app.get("/admission")
+async def get_admission():
+    """Concurrency limit, load and shed count of each route and gRPC method"""
+    return admission_snapshot()
 
 
 # ============= gRPC Service =============
@@ -108,50 +307,243 @@ class ProductServiceImpl(product_pb2_grpc.ProductServiceServicer):
 
     def GetProduct(self, request, context):
         """Get product by ID via gRPC"""
-        logger.info(f"gRPC GetProduct called with id={request.id}")
+        rpc_logger.info("gRPC GetProduct called with id=%s", request.id)
         if request.id in products_db:
             product = products_db[request.id]
-            product_pb = product_pb2.Product(
-                id=product["id"],
-                name=product["name"],
-                price=product["price"],
-                stock=product["stock"]
-            )
+            product_pb = product.to_proto(product_pb2.Product)
             return product_pb2.ProductResponse(code=200, message="Success", product=product_pb)
         else:
             return product_pb2.ProductResponse(code=404, message="Product not found", product=None)
 
     def ListProducts(self, request, context):
-        """List all products via gRPC"""
-        logger.info("gRPC ListProducts called")
+        """List products via gRPC (all of them unless after_id/limit are set)"""
+        rpc_logger.info("gRPC ListProducts called")
         products_list = []
-        for product in products_db.values():
-            products_list.append(product_pb2.Product(
-                id=product["id"],
-                name=product["name"],
-                price=product["price"],
-                stock=product["stock"]
-            ))
+        for product in iter_after(products_db, request.after_id, request.limit):
+            products_list.append(product.to_proto(product_pb2.Product))
         return product_pb2.ProductList(products=products_list)
 
+    def StreamProducts(self, request, context):
+        """Stream products in id order via gRPC, one message per product"""
+        rpc_logger.info("gRPC StreamProducts called with after_id=%s", request.after_id)
+        for product in iter_after(products_db, request.after_id, request.limit):
+            yield product.to_proto(product_pb2.Product)
 
-def serve_grpc():
-    """Start gRPC server"""
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    product_pb2_grpc.add_ProductServiceServicer_to_server(ProductServiceImpl(), server)
-    server.add_insecure_port('0.0.0.0:50052')
-    logger.info("gRPC Server started on port 50052")
-    server.start()
-    server.wait_for_termination()
+    def BatchGetProducts(self, request, context):
+        """Get many products by ID in one call via gRPC (unknown IDs are skipped)"""
+        rpc_logger.info("gRPC BatchGetProducts called with %s ids", len(request.ids))
+        products_list = []
+        for product_id in dict.fromkeys(request.ids):
+            product = products_db.get(product_id)
+            if product is not None:
+                products_list.append(product.to_proto(product_pb2.Product))
+        return product_pb2.ProductList(products=products_list)
 
+    def SearchProducts(self, request, context):
+        """Search products by name and/or price range via gRPC, one page in id order"""
+        rpc_logger.info("gRPC SearchProducts called with query=%r", request.query)
+        if request.query and not normalize(request.query):
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details("query has no letters or digits to search for")
+            return product_pb2.ProductList()
+        products, _ = product_search.page(
+            request.query, request.prefix,
+            request.min_price if request.HasField("min_price") else None,
+            request.max_price if request.HasField("max_price") else None,
+            request.after_id, request.limit or DEFAULT_PAGE_SIZE)
+        return product_pb2.ProductList(products=[product.to_proto(product_pb2.Product) for product in products])
+
+    def CreateProducts(self, request_iterator, context):
+        """Create products from a client stream via gRPC, one result per request"""
+        rpc_logger.info("gRPC CreateProducts called")
+        results = []
+        created = 0
+        for request in request_iterator:
+            error = validate_new_product(request.name, request.price, request.stock)
+            if error:
+                results.append(product_pb2.ProductResponse(code=400, message=error))
+                continue
+            product = products_db.insert({"name": request.name, "price": request.price, "stock": request.stock})
+            product_pb = product.to_proto(product_pb2.Product)
+            results.append(product_pb2.ProductResponse(code=201, message="Product created", product=product_pb))
+            created += 1
+        return product_pb2.CreateProductsResponse(created=created, failed=len(results) - created, results=results)
+
+    def ReserveStock(self, request, context):
+        """Atomically take stock for every item (or only those that fit, with allow_partial) via gRPC"""
+        rpc_logger.info("gRPC ReserveStock called with %s items", len(request.items))
+        if request.reservation_id:
+            return reserve_once(request.reservation_id, request.items, request.allow_partial)
+        return change_stock(request.items, -1, request.allow_partial)
+
+    def ReleaseStock(self, request, context):
+        """Give back stock taken by ReserveStock (the given items, or a whole reservation by id) via gRPC"""
+        rpc_logger.info("gRPC ReleaseStock called with %s items", len(request.items))
+        if request.reservation_id:
+            return release_once(request.reservation_id)
+        return change_stock(request.items, 1, request.allow_partial)
+
+    @aio_stream(lambda request, context: product_changes.follow_async(request, context, product_changes_message))
+    def WatchProducts(self, request, context):
+        """Stream product changes via gRPC: after request.after_seq, or a snapshot and then every change"""
+        yield from product_changes.follow(request, context, product_changes_message)
+
+
+def product_changes_message(epoch, last_seq, changes):
+    """ProductChanges message of one batch of product_changes"""
+    return product_pb2.ProductChanges(epoch=epoch, last_seq=last_seq, changes=[
+        product_pb2.ProductChange(seq=change.seq, kind=change.kind, fields=change.fields,
+                                  product=change.record.to_proto(product_pb2.Product))
+        for change in changes])
+
+
+def change_stock(items, direction, allow_partial=False):
+    """Check and apply stock changes for a batch of items as one atomic step.
+
+    Every item gets its own code in `item_codes` (200, 400 bad quantity, 404
+    unknown product, 409 not enough stock). By default nothing is applied if
+    any item fails; with `allow_partial` the items that fit are applied.
+
+    Only the stripes of the products involved are held while stock is
+    checked and written, so concurrent reservations of a product cannot
+    oversell it and orders for different products do not wait for each
+    other (in other worker processes either, with STORE_ENGINE=shared).
+    """
+    item_codes = []
+    with stock_locks.hold({item.product_id for item in items}):
+        stock = {}
+        for item in items:
+            product = products_db.get(item.product_id)
+            if item.quantity <= 0:
+                item_codes.append(400)
+            elif product is None:
+                item_codes.append(404)
+            else:
+                current = stock.get(item.product_id, product["stock"])
+                if direction < 0 and current < item.quantity:
+                    item_codes.append(409)
+                else:
+                    stock[item.product_id] = current + direction * item.quantity
+                    item_codes.append(200)
+
+        failed = [(item, code) for item, code in zip(items, item_codes) if code != 200]
+        if failed and not allow_partial:
+            item, code = failed[0]
+            return product_pb2.StockResponse(code=code, message=stock_error(item, code), item_codes=item_codes)
+        updated = [products_db.update(product_id, stock=value) for product_id, value in stock.items()]
+
+    return product_pb2.StockResponse(code=200, message="Success", item_codes=item_codes, products=[
+        product.to_proto(product_pb2.Product)
+        for product in updated
+    ])
+
+
+def find_reservation(reservation_id):
+    """The reservations_db row of `reservation_id`, or None"""
+    return next(reservations_db.iter_where(reservation_id=reservation_id, limit=1), None)
+
+
+def reserve_once(reservation_id, items, allow_partial=False):
+    """change_stock() for a reservation, applied only the first time its id is seen.
+
+    A repeat gets the first call's item codes back; a reservation released
+    before it arrived (release_once of an unknown id) is refused with 410.
+    """
+    expire_reservations()
+    with reservation_locks.hold([reservation_id]):
+        reservation = find_reservation(reservation_id)
+        if reservation is None:
+            response = change_stock(items, -1, allow_partial)
+            if response.code == 200:
+                reservations_db.insert({
+                    "reservation_id": reservation_id,
+                    "items": [[item.product_id, item.quantity]
+                              for item, code in zip(items, response.item_codes) if code == 200],
+                    "item_codes": list(response.item_codes),
+                    "released": False,
+                    "created_at": time.time(),
+                })
+            return response
+        if reservation["released"]:
+            return product_pb2.StockResponse(code=410, message=f"Reservation {reservation_id} was released")
+        return product_pb2.StockResponse(code=200, message="Already reserved", item_codes=reservation["item_codes"],
+                                         products=reserved_products(reservation))
+
+
+def release_once(reservation_id):
+    """Give back what reservation `reservation_id` took, once.
+
+    An id not reserved yet is recorded as released, so that a ReserveStock
+    still on its way cannot take the stock afterwards.
+    """
+    expire_reservations()
+    with reservation_locks.hold([reservation_id]):
+        reservation = find_reservation(reservation_id)
+        if reservation is None:
+            reservations_db.insert({"reservation_id": reservation_id, "items": [], "item_codes": [], "released": True,
+                                    "created_at": time.time()})
+            return product_pb2.StockResponse(code=200, message="Nothing reserved")
+        if reservation["released"]:
+            return product_pb2.StockResponse(code=200, message="Already released", products=reserved_products(reservation))
+        response = change_stock([product_pb2.StockItem(product_id=product_id, quantity=quantity)
+                                 for product_id, quantity in reservation["items"]], 1)
+        if response.code == 200:
+            reservations_db.update(reservation["id"], released=True)
+        return response
+
+
+def expire_reservations():
+    """Delete reservation rows older than RESERVATION_TTL, and the oldest beyond
+    RESERVATION_MAX_ROWS (down to 90% of it).
+
+    Runs every RESERVATION_TTL / 10 seconds, or at once when the table is
+    full. Rows are kept in id order, which is also age order, so the sweep
+    stops at the first row it keeps. Called before a reservation stripe is
+    held: deleting takes the stripes of the expired ids.
+    """
+    global next_reservation_sweep
+    now = time.time()
+    if now < next_reservation_sweep and len(reservations_db) < RESERVATION_MAX_ROWS:
+        return
+    next_reservation_sweep = now + RESERVATION_TTL / 10
+    excess = len(reservations_db) - RESERVATION_MAX_ROWS * 9 // 10
+    cutoff = now - RESERVATION_TTL
+    expired = {}
+    for record_id in reservations_db.keys():
+        reservation = reservations_db.get(record_id)
+        if reservation is None:
+            continue
+        if reservation.get("created_at", 0) > cutoff and len(expired) >= excess:
+            break
+        expired[record_id] = reservation["reservation_id"]
+    if expired:
+        with reservation_locks.hold(expired.values()):
+            removed = reservations_db.delete_many(expired)
+        if excess > 0:
+            logger.warning(f"Reservations table full: dropped {removed} rows, oldest first")
+
+
+def reserved_products(reservation):
+    """Current Product messages of the products a reservation covers"""
+    product_ids = dict.fromkeys(product_id for product_id, _ in reservation["items"])
+    return [products_db[product_id].to_proto(product_pb2.Product) for product_id in product_ids]
+
+
+def stock_error(item, code):
+    """Message for a failed stock item"""
+    if code == 400:
+        return f"Invalid quantity for product {item.product_id}"
+    if code == 404:
+        return f"Product {item.product_id} not found"
+    return f"Insufficient stock for product {item.product_id}"
 
-if __name__ == "__main__":
-    import threading
-    import uvicorn
 
-    # Start gRPC server in a separate thread
-    grpc_thread = threading.Thread(target=serve_grpc, daemon=True)
-    grpc_thread.start()
+def serve_grpc():
+    """Start gRPC server in thread-pool mode (blocks the calling thread)"""
+    serve_threaded(product_pb2_grpc.add_ProductServiceServicer_to_server, ProductServiceImpl(), GRPC_PORT)
+
 
-    # Start FastAPI server
-    uvicorn.run(app, host="0.0.0.0", port=8002, log_level="info")
+if __name__ == "__main__":
+    # Start FastAPI in one process, or WORKERS processes sharing the ports; each
+    # starts gRPC from the startup hook (aio mode) or in a thread (thread mode)
+    serve(app, REST_PORT, serve_grpc)
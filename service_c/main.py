@@ -1,48 +1,118 @@
+import asyncio
 import logging
-from fastapi import FastAPI, HTTPException
+import math
+from fastapi import FastAPI, HTTPException, Request
 import grpc
-from concurrent import futures
 import sys
 import os
+import time
+import uuid
+from typing import List, Optional
 
 # Import proto generated modules
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'proto'))
 from proto import order_pb2, order_pb2_grpc, user_pb2, user_pb2_grpc, product_pb2, product_pb2_grpc
 
+# Import shared helpers
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.admission import AdmissionMiddleware, admission_snapshot
+from common.analytics import OrderAnalytics
+from common.cache import TTLCache
+from common.coalesce import CoalescingStub
+from common.grpc_server import GRPC_SERVER_MODE, serve_threaded, start_aio, stop_aio
+from common.logs import configure_logging
+from common.metrics import ClientMetricsInterceptor, MetricsMiddleware, metrics_response
+from common.pagination import DEFAULT_PAGE_SIZE, iter_after, page_after
+from common.records import Order
+from common.resilience import CircuitBreaker, RetryPolicy
+from common.responses import ResponseCache, negotiate
+from common.store import open_store
+from common.tracing import TracingClientInterceptor, TracingMiddleware, recent_spans
+from common.upstream import UpstreamPool
+from common.workers import serve
+
 # FastAPI app
 app = FastAPI(title="Order Service", version="1.0.0")
+app.add_middleware(AdmissionMiddleware, routes=app.routes)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
+
+# Listening ports
+REST_PORT = int(os.getenv("SERVICE_C_PORT", "8003"))
+GRPC_PORT = int(os.getenv("SERVICE_C_GRPC_PORT", "50053"))
+
+# Largest list accepted by the bulk endpoints (also the chunk size of CreateOrders)
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "10000"))
+
+# gRPC server started in aio mode
+grpc_server = None
+
+# Event loop owning the upstream channels; gRPC handlers running in worker threads submit calls to it
+event_loop = None
 
 # Setup logging
-logging.basicConfig(level=logging.INFO)
+configure_logging("order-service")
 logger = logging.getLogger(__name__)
+# Per-call gRPC handler logs (thin them with LOG_SAMPLING=rpc=<rate>)
+rpc_logger = logging.getLogger("rpc")
 
-# Mock database
-orders_db = {
+# Database (persistence engine selected by STORE_ENGINE; these rows seed an empty store)
+orders_db = open_store("orders", {
     1: {"id": 1, "user_id": 1, "product_id": 1, "quantity": 2, "total_price": 1999.98},
     2: {"id": 2, "user_id": 2, "product_id": 2, "quantity": 5, "total_price": 149.95}
-}
-
-# gRPC channels
-user_service_channel = None
+}, indexes=("user_id", "product_id"), record_type=Order)
+
+# Sales rollups kept up to date on every order write (rebuilt from the stored orders here)
+order_analytics = OrderAnalytics(orders_db)
+order_analytics.rebuild()
+
+# Serialized list/item responses, rebuilt when orders_db changes
+response_cache = ResponseCache()
+
+# Upstream gRPC targets (comma-separated replicas) and deadlines (seconds)
+USER_SERVICE_ADDR = os.getenv("USER_SERVICE_ADDR", "service_a:50051")
+PRODUCT_SERVICE_ADDR = os.getenv("PRODUCT_SERVICE_ADDR", "service_b:50052")
+GRPC_CALL_TIMEOUT = float(os.getenv("GRPC_CALL_TIMEOUT", "2.0"))
+ORDER_REQUEST_BUDGET = float(os.getenv("ORDER_REQUEST_BUDGET", "3.0"))
+# Tries of a ReleaseStock by reservation id (safe to repeat) before it is logged as not released
+RELEASE_ATTEMPTS = int(os.getenv("RELEASE_ATTEMPTS", "5"))
+
+# Releases still running after the request that started them has answered
+background_releases = set()
+
+# Read-through caches for upstream lookups (TTL in seconds)
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+PRODUCT_CACHE_TTL = float(os.getenv("PRODUCT_CACHE_TTL", "10"))
+user_cache = TTLCache(maxsize=CACHE_MAX_ENTRIES, ttl=USER_CACHE_TTL)
+product_cache = TTLCache(maxsize=CACHE_MAX_ENTRIES, ttl=PRODUCT_CACHE_TTL)
+
+# gRPC channel pools, balanced over each upstream's replicas and guarded by a circuit breaker;
+# identical concurrent reads share one call (common.coalesce)
+user_service_pool = None
 user_service_stub = None
-product_service_channel = None
+product_service_pool = None
 product_service_stub = None
+user_breaker = CircuitBreaker("user-service")
+product_breaker = CircuitBreaker("product-service")
 
 
 async def init_service_connections():
     """Initialize connections to other services"""
-    global user_service_channel, user_service_stub
-    global product_service_channel, product_service_stub
+    global user_service_pool, user_service_stub
+    global product_service_pool, product_service_stub
     
     try:
         # Connect to User Service
-        user_service_channel = await grpc.aio.insecure_channel('service_a:50051')
-        user_service_stub = user_pb2_grpc.UserServiceStub(user_service_channel)
+        user_service_pool = UpstreamPool("user-service", USER_SERVICE_ADDR, user_pb2_grpc.UserServiceStub, interceptors=[
+            TracingClientInterceptor(), ClientMetricsInterceptor()], breaker=user_breaker, retry=RetryPolicy())
+        user_service_stub = CoalescingStub(user_service_pool.stub, "user-service")
         logger.info("Connected to User Service gRPC")
         
         # Connect to Product Service
-        product_service_channel = await grpc.aio.insecure_channel('service_b:50052')
-        product_service_stub = product_pb2_grpc.ProductServiceStub(product_service_channel)
+        product_service_pool = UpstreamPool("product-service", PRODUCT_SERVICE_ADDR, product_pb2_grpc.ProductServiceStub, interceptors=[
+            TracingClientInterceptor(), ClientMetricsInterceptor()], breaker=product_breaker, retry=RetryPolicy())
+        product_service_stub = CoalescingStub(product_service_pool.stub, "product-service")
         logger.info("Connected to Product Service gRPC")
     except Exception as e:
         logger.error(f"Failed to connect to services: {e}")
@@ -52,8 +122,22 @@ async def init_service_connections():
 
 @app.on_event("startup")
 async def startup_event():
-    """Initialize connections on startup"""
+    """Initialize connections and start the aio gRPC server on startup"""
+    global grpc_server, event_loop
+    event_loop = asyncio.get_running_loop()
     await init_service_connections()
+    if GRPC_SERVER_MODE == "aio":
+        grpc_server = await start_aio(order_pb2_grpc.add_OrderServiceServicer_to_server, OrderServiceImpl(), GRPC_PORT)
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop the aio gRPC server, close the upstream channels and flush the store"""
+    await stop_aio(grpc_server)
+    for pool in (user_service_pool, product_service_pool):
+        if pool is not None:
+            await pool.close()
+    orders_db.close()
 
 
 @app.get("/health")
@@ -62,102 +146,482 @@ async def health_check():
     return {"status": "healthy", "service": "order-service"}
 
 
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics for REST routes, gRPC methods and outbound calls"""
+    return metrics_response()
+
+
+@app.get("/debug/traces")
+async def get_traces(trace_id: Optional[str] = None, limit: int = 100):
+    """Recently sampled spans, newest first (optionally one trace)"""
+    return {"service": "order-service", "spans": recent_spans(trace_id, limit)}
+
+
 @app.get("/orders")
-async def list_orders():
-    """Get all orders"""
-    return {"data": list(orders_db.values())}
+async def list_orders(request: Request, cursor: int = 0, limit: int = DEFAULT_PAGE_SIZE,
+                      user_id: Optional[int] = None, product_id: Optional[int] = None):
+    """Get one page of orders with id > cursor, optionally filtered by user and/or product
+    (cached, ETag/304 aware; OrderList protobuf on Accept: application/x-protobuf)"""
+    def build():
+        orders, next_cursor = page_after(orders_db, cursor, limit, **order_filters(user_id, product_id))
+        return {"data": orders, "next_cursor": next_cursor}
+    key = ("orders", cursor, limit, user_id, product_id)
+    return response_cache.respond(request, key, orders_db.version, build, order_list_message)
+
+
+def order_list_message(content):
+    """OrderList message of a page of orders"""
+    return order_pb2.OrderList(orders=[order.to_proto(order_pb2.Order) for order in content["data"]])
+
+
+def order_filters(user_id, product_id):
+    """Index filters for the given user/product ids (None or 0 means no filter)"""
+    filters = {}
+    if user_id:
+        filters["user_id"] = user_id
+    if product_id:
+        filters["product_id"] = product_id
+    return filters
 
 
 @app.get("/orders/{order_id}")
-async def get_order(order_id: int):
-    """Get order by ID"""
-    if order_id not in orders_db:
+async def get_order(request: Request, order_id: int):
+    """Get order by ID (cached, ETag/304 aware)"""
+    order = orders_db.get(order_id)
+    if order is None:
         raise HTTPException(status_code=404, detail="Order not found")
-    return {"data": orders_db[order_id]}
+    return response_cache.respond(request, ("order", order_id), order, lambda: {"data": order})
 
 
 @app.post("/orders")
 async def create_order(order: dict):
-    """Create new order with validation from User and Product services"""
+    """Create new order: validate the user and reserve stock in the Product service"""
     try:
         user_id = order["user_id"]
         product_id = order["product_id"]
         quantity = order["quantity"]
+        fail_fast_if_open(product_breaker)
 
-        # Validate user exists (via gRPC)
-        if user_service_stub:
-            user_response = await user_service_stub.GetUser(user_pb2.GetUserRequest(id=user_id))
-            if user_response.code != 200:
-                raise HTTPException(status_code=404, detail="User not found")
-
-        # Validate product exists and has stock (via gRPC)
-        if product_service_stub:
-            product_response = await product_service_stub.GetProduct(product_pb2.GetProductRequest(id=product_id))
-            if product_response.code != 200:
-                raise HTTPException(status_code=404, detail="Product not found")
-            if product_response.product.stock < quantity:
-                raise HTTPException(status_code=400, detail="Insufficient stock")
+        # Validate user and reserve stock concurrently (via gRPC), bounded by the request budget.
+        # A reservation cut off by the budget, or failed in transit, may still be applied
+        # upstream: it is released by its id, which also stops it if it has not arrived yet.
+        reservation_id = uuid.uuid4().hex
+        try:
+            user_result, reserve_result = await asyncio.wait_for(
+                asyncio.gather(fetch_user(user_id), reserve_stock([(product_id, quantity)], reservation_id=reservation_id),
+                               return_exceptions=True),
+                timeout=ORDER_REQUEST_BUDGET,
+            )
+        except asyncio.TimeoutError:
+            release_in_background(reservation_id)
+            raise HTTPException(status_code=504, detail="Upstream validation timed out")
+
+        reserved = isinstance(reserve_result, product_pb2.StockResponse) and reserve_result.code == 200
+        user_valid = user_result is None or (isinstance(user_result, user_pb2.UserResponse) and user_result.code == 200)
+        if isinstance(reserve_result, BaseException):
+            release_in_background(reservation_id)
+        elif reserved and not user_valid:
+            await release_stock(reservation_id)
+
+        for result in (user_result, reserve_result):
+            if isinstance(result, BaseException):
+                raise upstream_http_error(result)
+        if not user_valid:
+            raise HTTPException(status_code=404, detail="User not found")
+        if reserve_result is None:
+            raise HTTPException(status_code=503, detail="Product service unavailable")
+        if reserve_result.code == 404:
+            raise HTTPException(status_code=404, detail="Product not found")
+        if reserve_result.code == 409:
+            raise HTTPException(status_code=400, detail="Insufficient stock")
+        if reserve_result.code != 200:
+            raise HTTPException(status_code=400, detail=reserve_result.message)
 
         # Create order
-        new_id = max(orders_db.keys()) + 1 if orders_db else 1
-        total_price = product_response.product.price * quantity
-        orders_db[new_id] = {
-            "id": new_id,
-            "user_id": user_id,
-            "product_id": product_id,
-            "quantity": quantity,
-            "total_price": total_price
-        }
+        product = reserve_result.products[0]
+        total_price = product.price * quantity
+        try:
+            new_order = orders_db.insert({
+                "user_id": user_id,
+                "product_id": product_id,
+                "quantity": quantity,
+                "total_price": total_price,
+                "created_at": time.time()
+            })
+        except Exception:
+            await release_stock(reservation_id)
+            raise
         
         return {
-            "data": orders_db[new_id],
+            "data": new_order,
             "message": "Order created successfully",
             "user": {"id": user_id},
-            "product": {"id": product_id, "price": product_response.product.price}
+            "product": {"id": product_id, "price": product.price}
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error creating order: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def fail_fast_if_open(breaker):
+    """Reject with 503 (and Retry-After) while the upstream's circuit is open.
+
+    Used where the upstream is certain to be needed; calls that may be
+    served from a cache go through and are refused by the channel only on a miss.
+    """
+    wait = breaker.retry_after()
+    if wait:
+        breaker.reject()
+        raise HTTPException(status_code=503, detail=f"Circuit open for {breaker.name}",
+                            headers={"Retry-After": str(math.ceil(wait))})
+
+
+def upstream_http_error(error):
+    """Map a failed upstream call to the HTTP error returned to the client"""
+    if isinstance(error, grpc.aio.AioRpcError):
+        if error.code() == grpc.StatusCode.DEADLINE_EXCEEDED:
+            return HTTPException(status_code=504, detail="Upstream validation timed out")
+        return HTTPException(status_code=503, detail=f"Upstream unavailable: {error.code().name}")
+    return error
+
+
+async def fetch_user(user_id):
+    """Get a single user, served from the user cache when possible (None when not connected)"""
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        return user_pb2.UserResponse(code=200, message="Success", user=cached)
+    if not user_service_stub:
+        return None
+    response = await user_service_stub.GetUser(user_pb2.GetUserRequest(id=user_id), timeout=GRPC_CALL_TIMEOUT)
+    if response.code == 200:
+        user_cache.set(user_id, response.user)
+    return response
+
+
+async def reserve_stock(items, allow_partial=False, reservation_id=""):
+    """Atomically reserve [(product_id, quantity)] in Product Service (None when not connected);
+    with a `reservation_id`, release_stock(reservation_id) can undo it"""
+    if not product_service_stub:
+        return None
+    request = product_pb2.StockRequest(items=[
+        product_pb2.StockItem(product_id=product_id, quantity=quantity)
+        for product_id, quantity in items
+    ], allow_partial=allow_partial, reservation_id=reservation_id)
+    response = await product_service_stub.ReserveStock(request, timeout=GRPC_CALL_TIMEOUT)
+    if response.code == 200:
+        for product in response.products:
+            product_cache.set(product.id, product)
+    return response
+
+
+async def release_stock(reservation_id):
+    """Give back everything reservation `reservation_id` took, retrying while the Product
+    Service cannot be reached, and refresh the cached products; failures are logged, not raised"""
+    if not product_service_stub:
+        return
+    request = product_pb2.StockRequest(reservation_id=reservation_id)
+    error = None
+    for attempt in range(RELEASE_ATTEMPTS):
+        if attempt:
+            await asyncio.sleep(min(GRPC_CALL_TIMEOUT, 0.1 * 2 ** attempt))
+        try:
+            response = await product_service_stub.ReleaseStock(request, timeout=GRPC_CALL_TIMEOUT)
+        except grpc.aio.AioRpcError as e:
+            error = f"{e.code().name} {e.details()}"
+            continue
+        if response.code != 200:
+            logger.error(f"Failed to release reservation {reservation_id}: {response.message}")
+        # The stock went back up; reserve_stock() left the lower count in the cache
+        for product in response.products:
+            product_cache.set(product.id, product)
+        return
+    logger.error(f"Reservation {reservation_id} not released after {RELEASE_ATTEMPTS} attempts: {error}")
+
+
+def release_in_background(reservation_id):
+    """release_stock() without holding up the response"""
+    task = asyncio.ensure_future(release_stock(reservation_id))
+    background_releases.add(task)
+    task.add_done_callback(background_releases.discard)
+
+
+@app.post("/orders/batch")
+async def create_orders_batch_endpoint(orders: List[dict]):
+    """Create many orders in one request, reporting success or failure per item"""
+    if len(orders) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_ITEMS} orders per batch")
+    results = await create_orders_batch(orders)
+    created = sum(1 for result in results if result["code"] == 201)
+    return {"data": results, "created": created, "failed": len(results) - created}
+
+
+# Per-item ReserveStock codes -> order result for the batch path
+STOCK_ITEM_ERRORS = {
+    400: (400, "Invalid quantity"),
+    404: (404, "Product not found"),
+    409: (400, "Insufficient stock"),
+}
+
+
+async def create_orders_batch(orders):
+    """Validate and create a batch of orders with one user lookup and one stock reservation.
+
+    Returns one {"code", "message"[, "data"]} result per order, in order.
+    Upstream failures fail the whole batch with an HTTPException.
+    """
+    results = [None] * len(orders)
+    pending = []
+    reservation_id = uuid.uuid4().hex
+    for i, order in enumerate(orders):
+        if not all(isinstance(order.get(field), int) for field in ("user_id", "product_id", "quantity")):
+            results[i] = {"code": 400, "message": "user_id, product_id and quantity are required"}
+        else:
+            pending.append(i)
+
+    async def validate():
+        users = await fetch_users_by_id({orders[i]["user_id"] for i in pending})
+        known = [i for i in pending if orders[i]["user_id"] in users or not user_service_stub]
+        for i in pending:
+            if orders[i]["user_id"] not in users and user_service_stub:
+                results[i] = {"code": 404, "message": "User not found"}
+        response = await reserve_stock(
+            [(orders[i]["product_id"], orders[i]["quantity"]) for i in known], allow_partial=True,
+            reservation_id=reservation_id)
+        return known, response
+
+    if not pending:
+        return results
+    try:
+        known, reserve_result = await asyncio.wait_for(validate(), timeout=ORDER_REQUEST_BUDGET)
+    except asyncio.TimeoutError:
+        release_in_background(reservation_id)
+        raise HTTPException(status_code=504, detail="Upstream validation timed out")
+    except grpc.aio.AioRpcError as e:
+        release_in_background(reservation_id)
+        raise upstream_http_error(e)
+    if reserve_result is None:
+        raise HTTPException(status_code=503, detail="Product service unavailable")
+    if reserve_result.code != 200:
+        raise HTTPException(status_code=400, detail=reserve_result.message)
+
+    prices = {product.id: product.price for product in reserve_result.products}
+    reserved = []
+    for i, code in zip(known, reserve_result.item_codes):
+        if code == 200:
+            reserved.append(i)
+        else:
+            status, message = STOCK_ITEM_ERRORS.get(code, (400, f"Stock error {code}"))
+            results[i] = {"code": status, "message": message}
+
+    created_at = time.time()
+    try:
+        new_orders = orders_db.insert_many({
+            "user_id": orders[i]["user_id"],
+            "product_id": orders[i]["product_id"],
+            "quantity": orders[i]["quantity"],
+            "total_price": prices[orders[i]["product_id"]] * orders[i]["quantity"],
+            "created_at": created_at
+        } for i in reserved)
+    except Exception:
+        await release_stock(reservation_id)
+        raise
+    for i, new_order in zip(reserved, new_orders):
+        results[i] = {"code": 201, "message": "Order created", "data": new_order}
+    return results
+
+
 @app.get("/orders-detail")
-async def get_orders_detail():
-    """Get all orders with detailed user and product information"""
+async def get_orders_detail(request: Request):
+    """Get all orders with detailed user and product information
+    (OrderDetailList protobuf on Accept: application/x-protobuf).
+
+    If an upstream is failing (or its circuit is open) the orders are still
+    returned, with only the details found in the local caches and the
+    failed upstreams listed under "degraded".
+    """
     try:
+        orders = list(orders_db.values())
+        user_ids = {order["user_id"] for order in orders}
+        product_ids = {order["product_id"] for order in orders}
+        users, products = await asyncio.gather(
+            fetch_users_by_id(user_ids),
+            fetch_products_by_id(product_ids),
+            return_exceptions=True,
+        )
+        degraded = []
+        if isinstance(users, grpc.aio.AioRpcError):
+            logger.warning(f"User Service unavailable, serving cached users: {users.code().name} {users.details()}")
+            users = await fetch_users_by_id(user_ids, cached_only=True)
+            degraded.append(user_breaker.name)
+        if isinstance(products, grpc.aio.AioRpcError):
+            logger.warning(f"Product Service unavailable, serving cached products: {products.code().name} {products.details()}")
+            products = await fetch_products_by_id(product_ids, cached_only=True)
+            degraded.append(product_breaker.name)
+        for result in (users, products):
+            if isinstance(result, BaseException):
+                raise result
+
         result = []
-        
-        for order in orders_db.values():
-            order_detail = order.copy()
-            
-            # Get user info
-            if user_service_stub:
-                user_resp = await user_service_stub.GetUser(user_pb2.GetUserRequest(id=order["user_id"]))
-                if user_resp.code == 200:
-                    order_detail["user"] = {
-                        "id": user_resp.user.id,
-                        "name": user_resp.user.name,
-                        "email": user_resp.user.email
-                    }
-            
-            # Get product info
-            if product_service_stub:
-                product_resp = await product_service_stub.GetProduct(product_pb2.GetProductRequest(id=order["product_id"]))
-                if product_resp.code == 200:
-                    order_detail["product"] = {
-                        "id": product_resp.product.id,
-                        "name": product_resp.product.name,
-                        "price": product_resp.product.price,
-                        "stock": product_resp.product.stock
-                    }
-            
+        for order in orders:
+            order_detail = order.to_dict()
+            if order["user_id"] in users:
+                order_detail["user"] = users[order["user_id"]]
+            if order["product_id"] in products:
+                order_detail["product"] = products[order["product_id"]]
             result.append(order_detail)
-        
-        return {"data": result}
+
+        content = {"data": result, "degraded": degraded} if degraded else {"data": result}
+        return negotiate(request, content, order_details_message)
     except Exception as e:
         logger.error(f"Error fetching orders detail: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def order_details_message(content):
+    """OrderDetailList message of an /orders-detail result"""
+    message = order_pb2.OrderDetailList(degraded=content.get("degraded", ()))
+    # Filling the nested messages from dicts in place is ~3x faster than building and copying them
+    add = message.orders.add
+    for detail in content["data"]:
+        add(order={field: detail[field] for field in Order.FIELDS}, user=detail.get("user"),
+            product=detail.get("product"))
+    return message
+
+
+async def fetch_users_by_id(user_ids, cached_only=False):
+    """Fetch users from the user cache, batching all misses into one gRPC call
+    (or leaving them out with cached_only)"""
+    found = {}
+    missing = []
+    for user_id in user_ids:
+        cached = user_cache.get(user_id)
+        if cached is not None:
+            found[user_id] = cached
+        else:
+            missing.append(user_id)
+
+    if missing and user_service_stub and not cached_only:
+        response = await user_service_stub.BatchGetUsers(user_pb2.BatchGetUsersRequest(ids=missing), timeout=GRPC_CALL_TIMEOUT)
+        for u in response.users:
+            user_cache.set(u.id, u)
+            found[u.id] = u
+
+    return {
+        u.id: {"id": u.id, "name": u.name, "email": u.email}
+        for u in found.values()
+    }
+
+
+async def fetch_products_by_id(product_ids, cached_only=False):
+    """Fetch products from the product cache, batching all misses into one gRPC call
+    (or leaving them out with cached_only).
+
+    Stock in the result may be up to PRODUCT_CACHE_TTL seconds old; orders
+    check stock through reserve_stock() instead.
+    """
+    found = {}
+    missing = []
+    for product_id in product_ids:
+        cached = product_cache.get(product_id)
+        if cached is not None:
+            found[product_id] = cached
+        else:
+            missing.append(product_id)
+
+    if missing and product_service_stub and not cached_only:
+        response = await product_service_stub.BatchGetProducts(product_pb2.BatchGetProductsRequest(ids=missing), timeout=GRPC_CALL_TIMEOUT)
+        for p in response.products:
+            product_cache.set(p.id, p)
+            found[p.id] = p
+
+    return {
+        p.id: {"id": p.id, "name": p.name, "price": p.price, "stock": p.stock}
+        for p in found.values()
+    }
+
+
+@app.get("/analytics")
+async def get_analytics_summary():
+    """Sales totals over all orders and the state of the rollups"""
+    return order_analytics.summary()
+
+
+@app.get("/analytics/products/top")
+async def get_top_products(limit: int = 10, by: str = "revenue"):
+    """Best-selling products by revenue or units"""
+    return {"data": analytics_top("products", by, limit)}
+
+
+@app.get("/analytics/products/{product_id}")
+async def get_product_sales(product_id: int):
+    """Revenue, units and order count of one product"""
+    return {"data": order_analytics.sales("products", product_id)}
+
+
+@app.get("/analytics/users/top")
+async def get_top_users(limit: int = 10, by: str = "revenue"):
+    """Users who spent or bought the most"""
+    return {"data": analytics_top("users", by, limit)}
+
+
+@app.get("/analytics/users/{user_id}")
+async def get_user_sales(user_id: int):
+    """Revenue, units and order count of one user"""
+    return {"data": order_analytics.sales("users", user_id)}
+
+
+@app.get("/analytics/timeline")
+async def get_sales_timeline(bucket_seconds: int = 0, since: float = 0, until: float = 0):
+    """Sales totals per time bucket, oldest first"""
+    try:
+        return {"data": order_analytics.timeline(bucket_seconds, since, until)}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.post("/analytics/rebuild")
+async def rebuild_analytics(vectorized: bool = True):
+    """Recompute the rollups from all stored orders (NumPy when installed)"""
+    return await asyncio.to_thread(order_analytics.rebuild, vectorized)
+
+
+def analytics_top(kind, by, limit):
+    try:
+        return order_analytics.top(kind, by, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/cache-stats")
+async def get_cache_stats():
+    """Hit/miss counters for the upstream lookup caches and the response cache, and
+    how many upstream reads were coalesced"""
+    return {"users": user_cache.stats(), "products": product_cache.stats(), "responses": response_cache.stats(),
+            "coalescing": {stub.flight.name: stub.flight.stats()
+                           for stub in (user_service_stub, product_service_stub) if stub is not None}}
+
+
+@app.get("/breakers")
+async def get_breakers():
+    """Circuit breaker state of each upstream"""
+    return {breaker.name: breaker.snapshot() for breaker in (user_breaker, product_breaker)}
+
+
+@app.get("/upstreams")
+async def get_upstreams():
+    """Replicas of each upstream with their load and ejection state"""
+    return {pool.name: pool.snapshot() for pool in (user_service_pool, product_service_pool) if pool is not None}
+
+
+@app.get("/admission")
+async def get_admission():
+    """Concurrency limit, load and shed count of each route and gRPC method"""
+    return admission_snapshot()
+
+
 # ============= gRPC Service =============
 
 class OrderServiceImpl(order_pb2_grpc.OrderServiceServicer):
@@ -165,64 +629,121 @@ class OrderServiceImpl(order_pb2_grpc.OrderServiceServicer):
 
     def CreateOrder(self, request, context):
         """Create order via gRPC"""
-        logger.info(f"gRPC CreateOrder called with user_id={request.user_id}, product_id={request.product_id}")
+        rpc_logger.info("gRPC CreateOrder called with user_id=%s, product_id=%s", request.user_id, request.product_id)
         
         try:
-            new_id = max(orders_db.keys()) + 1 if orders_db else 1
             total_price = 0.0
             
-            orders_db[new_id] = {
-                "id": new_id,
+            new_order = orders_db.insert({
                 "user_id": request.user_id,
                 "product_id": request.product_id,
                 "quantity": request.quantity,
-                "total_price": total_price
-            }
+                "total_price": total_price,
+                "created_at": time.time()
+            })
             
-            order_pb = order_pb2.Order(
-                id=new_id,
-                user_id=request.user_id,
-                product_id=request.product_id,
-                quantity=request.quantity,
-                total_price=total_price
-            )
+            order_pb = new_order.to_proto(order_pb2.Order)
             return order_pb2.OrderResponse(code=201, message="Order created", order=order_pb)
         except Exception as e:
             logger.error(f"Error creating order: {e}")
             return order_pb2.OrderResponse(code=500, message=str(e), order=None)
 
+    def CreateOrders(self, request_iterator, context):
+        """Create validated orders from a client stream via gRPC, one result per request.
+
+        Requests are validated and stored in chunks of BATCH_MAX_ITEMS through
+        create_orders_batch() on the service event loop.
+        """
+        rpc_logger.info("gRPC CreateOrders called")
+        results = []
+        chunk = []
+        for request in request_iterator:
+            chunk.append({"user_id": request.user_id, "product_id": request.product_id, "quantity": request.quantity})
+            if len(chunk) == BATCH_MAX_ITEMS:
+                results.extend(self._create_chunk(chunk))
+                chunk = []
+        if chunk:
+            results.extend(self._create_chunk(chunk))
+        created = sum(1 for result in results if result.code == 201)
+        return order_pb2.CreateOrdersResponse(created=created, failed=len(results) - created, results=results)
+
+    def _create_chunk(self, orders):
+        """Run create_orders_batch() on the event loop and convert its results"""
+        try:
+            results = asyncio.run_coroutine_threadsafe(create_orders_batch(orders), event_loop).result()
+        except HTTPException as e:
+            return [order_pb2.OrderResponse(code=e.status_code, message=e.detail) for _ in orders]
+        except Exception as e:
+            logger.error(f"Error creating orders: {e}")
+            return [order_pb2.OrderResponse(code=500, message=str(e)) for _ in orders]
+        responses = []
+        for result in results:
+            order = result.get("data")
+            responses.append(order_pb2.OrderResponse(
+                code=result["code"],
+                message=result["message"],
+                order=order.to_proto(order_pb2.Order) if order else None
+            ))
+        return responses
+
     def ListOrders(self, request, context):
-        """List all orders via gRPC"""
-        logger.info("gRPC ListOrders called")
+        """List orders via gRPC (all of them unless after_id/limit are set)"""
+        rpc_logger.info("gRPC ListOrders called")
         orders_list = []
-        for order in orders_db.values():
-            orders_list.append(order_pb2.Order(
-                id=order["id"],
-                user_id=order["user_id"],
-                product_id=order["product_id"],
-                quantity=order["quantity"],
-                total_price=order["total_price"]
-            ))
+        filters = order_filters(request.user_id, request.product_id)
+        for order in iter_after(orders_db, request.after_id, request.limit, **filters):
+            orders_list.append(order.to_proto(order_pb2.Order))
         return order_pb2.OrderList(orders=orders_list)
 
+    def StreamOrders(self, request, context):
+        """Stream orders in id order via gRPC, one message per order"""
+        rpc_logger.info("gRPC StreamOrders called with after_id=%s", request.after_id)
+        filters = order_filters(request.user_id, request.product_id)
+        for order in iter_after(orders_db, request.after_id, request.limit, **filters):
+            yield order.to_proto(order_pb2.Order)
 
-def serve_grpc():
-    """Start gRPC server"""
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    order_pb2_grpc.add_OrderServiceServicer_to_server(OrderServiceImpl(), server)
-    server.add_insecure_port('0.0.0.0:50053')
-    logger.info("gRPC Server started on port 50053")
-    server.start()
-    server.wait_for_termination()
+    def GetProductSales(self, request, context):
+        """Sales totals of one product via gRPC"""
+        return order_pb2.SalesStats(**order_analytics.sales("products", request.id))
 
+    def GetUserSales(self, request, context):
+        """Sales totals of one user via gRPC"""
+        return order_pb2.SalesStats(**order_analytics.sales("users", request.id))
 
-if __name__ == "__main__":
-    import threading
-    import uvicorn
+    def TopProducts(self, request, context):
+        """Best-selling products via gRPC"""
+        return self._top("products", request, context)
 
-    # Start gRPC server in a separate thread
-    grpc_thread = threading.Thread(target=serve_grpc, daemon=True)
-    grpc_thread.start()
+    def TopUsers(self, request, context):
+        """Users who spent or bought the most via gRPC"""
+        return self._top("users", request, context)
 
-    # Start FastAPI server
-    uvicorn.run(app, host="0.0.0.0", port=8003, log_level="info")
+    def _top(self, kind, request, context):
+        try:
+            stats = order_analytics.top(kind, request.by or "revenue", request.limit or 10)
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+            return order_pb2.SalesStatsList()
+        return order_pb2.SalesStatsList(stats=[order_pb2.SalesStats(**entry) for entry in stats])
+
+    def GetSalesTimeline(self, request, context):
+        """Sales totals per time bucket via gRPC"""
+        try:
+            buckets = order_analytics.timeline(request.bucket_seconds, request.since, request.until)
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+            return order_pb2.SalesTimeline()
+        return order_pb2.SalesTimeline(buckets=[order_pb2.SalesBucket(**bucket) for bucket in buckets])
+
+
+def serve_grpc():
+    """Start gRPC server in thread-pool mode (blocks the calling thread)"""
+    serve_threaded(order_pb2_grpc.add_OrderServiceServicer_to_server, OrderServiceImpl(), GRPC_PORT)
+
+
+if __name__ == "__main__":
+    # Start FastAPI in one process, or WORKERS processes sharing the ports; each
+    # starts gRPC from the startup hook (aio mode) or in a thread (thread mode)
+    serve(app, REST_PORT, serve_grpc)